@@ -3,9 +3,13 @@ from .python.spi import PandaSpiException, PandaProtocolMismatch, STBootloaderSP
 from .python.serial import PandaSerial  # noqa: F401
 from .python.canhandle import CanHandle # noqa: F401
 from .python.utils import logger # noqa: F401
+from .python.asyncpanda import AsyncPanda # noqa: F401
+from .python.discovery import UsbDiscovery, UsbDeviceInfo, PandaDevice # noqa: F401
+from .python.pool import PandaPool, PoolResult # noqa: F401
 from .python import (Panda, PandaDFU, isotp, # noqa: F401
-                     pack_can_buffer, unpack_can_buffer, calculate_checksum,
-                     DLC_TO_LEN, LEN_TO_DLC, CANPACKET_HEAD_SIZE)
+                     pack_can_buffer, unpack_can_buffer, unpack_can_buffer_array, calculate_checksum, CanStreamDecoder, CanPacker,
+                     DLC_TO_LEN, LEN_TO_DLC, CANPACKET_HEAD_SIZE, CAN_FRAME_DTYPE,
+                     Telemetry, HealthRecord, CanHealthRecord)
 
 
 # panda jungle
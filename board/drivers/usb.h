@@ -2,7 +2,7 @@
 
 bool usb_enumerated = false;
 
-static uint8_t response[USBPACKET_MAX_SIZE];
+static uint8_t response[CONTROL_RESPONSE_MAX_SIZE] __attribute__((aligned(4)));
 
 // current packet
 static USB_Setup_TypeDef setup;
@@ -513,8 +513,7 @@ static void usb_setup(void) {
       resp_len = comms_control_handler(&control_req, response);
       // response pending if -1 was returned
       if (resp_len != -1) {
-        USB_WritePacket(response, MIN(resp_len, setup.b.wLength.w), 0);
-        USBx_OUTEP(0U)->DOEPCTL |= USB_OTG_DOEPCTL_CNAK;
+        USB_WritePacket_EP0(response, MIN(resp_len, setup.b.wLength.w));
       }
   }
 }
@@ -59,3 +59,23 @@ typedef struct __attribute__((packed)) {
   uint32_t irq2_call_rate;
   uint32_t can_core_reset_cnt;
 } can_health_t;
+
+// CAN settings of a bus, as returned for all buses by the 0xc7 control request
+typedef struct __attribute__((packed)) {
+  uint16_t can_speed;
+  uint16_t can_data_speed;
+  uint8_t canfd_auto;
+  uint8_t canfd_non_iso;
+} can_bus_config_t;
+
+#define TELEMETRY_PACKET_VERSION 1
+#define TELEMETRY_CAN_BUS_CNT 3U
+// health and the CAN health of all buses, as returned by the 0xc8 control request
+struct __attribute__((packed)) telemetry_t {
+  uint8_t version;
+  uint8_t health_version;
+  uint8_t can_health_version;
+  uint8_t can_bus_cnt;
+  struct health_t health;
+  can_health_t can_health[TELEMETRY_CAN_BUS_CNT];
+};
@@ -26,6 +26,7 @@
 #include "obj/gitversion.h"
 
 #include "can_comms.h"
+#include "telemetry.h"
 #include "main_comms.h"
 
 
@@ -47,6 +47,15 @@ static int get_health_pkt(void *dat) {
   return sizeof(*health);
 }
 
+static void refresh_can_health_pkt(uint8_t can_number) {
+  update_can_health_pkt(can_number, 0U);
+  can_health[can_number].can_speed = (bus_config[can_number].can_speed / 10U);
+  can_health[can_number].can_data_speed = (bus_config[can_number].can_data_speed / 10U);
+  can_health[can_number].canfd_enabled = bus_config[can_number].canfd_enabled;
+  can_health[can_number].brs_enabled = bus_config[can_number].brs_enabled;
+  can_health[can_number].canfd_non_iso = bus_config[can_number].canfd_non_iso;
+}
+
 // send on serial, first byte to select the ring
 void comms_endpoint2_write(const uint8_t *data, uint32_t len) {
   uart_ring *ur = get_ring_by_number(data[0]);
@@ -110,12 +119,7 @@ int comms_control_handler(ControlPacket_t *req, uint8_t *resp) {
     case 0xc2:
       COMPILE_TIME_ASSERT(sizeof(can_health_t) <= USBPACKET_MAX_SIZE);
       if (req->param1 < 3U) {
-        update_can_health_pkt(req->param1, 0U);
-        can_health[req->param1].can_speed = (bus_config[req->param1].can_speed / 10U);
-        can_health[req->param1].can_data_speed = (bus_config[req->param1].can_data_speed / 10U);
-        can_health[req->param1].canfd_enabled = bus_config[req->param1].canfd_enabled;
-        can_health[req->param1].brs_enabled = bus_config[req->param1].brs_enabled;
-        can_health[req->param1].canfd_non_iso = bus_config[req->param1].canfd_non_iso;
+        refresh_can_health_pkt(req->param1);
         resp_len = sizeof(can_health[req->param1]);
         (void)memcpy(resp, (uint8_t*)(&can_health[req->param1]), resp_len);
       }
@@ -145,6 +149,31 @@ int comms_control_handler(ControlPacket_t *req, uint8_t *resp) {
       resp[0] = current_board->read_som_gpio();
       resp_len = 1;
       break;
+    // **** 0xc7: CAN bus config of all buses
+    case 0xc7:
+      COMPILE_TIME_ASSERT((sizeof(can_bus_config_t) * 3U) <= USBPACKET_MAX_SIZE);
+      for (uint8_t i = 0U; i < 3U; i++) {
+        can_bus_config_t bus_cfg = {
+          .can_speed = (uint16_t)(bus_config[i].can_speed / 10U),
+          .can_data_speed = (uint16_t)(bus_config[i].can_data_speed / 10U),
+          .canfd_auto = bus_config[i].canfd_auto,
+          .canfd_non_iso = bus_config[i].canfd_non_iso,
+        };
+        (void)memcpy(&resp[resp_len], (uint8_t*)(&bus_cfg), sizeof(bus_cfg));
+        resp_len += sizeof(bus_cfg);
+      }
+      break;
+    // **** 0xc8: health and CAN health of all buses, in one transfer
+    case 0xc8:
+      {
+        struct health_t health;
+        (void)get_health_pkt(&health);
+        for (uint8_t i = 0U; i < TELEMETRY_CAN_BUS_CNT; i++) {
+          refresh_can_health_pkt(i);
+        }
+        resp_len = get_telemetry_pkt(resp, &health, can_health);
+      }
+      break;
     // **** 0xd0: fetch serial (aka the provisioned dongle ID)
     case 0xd0:
       // addresses are OTP
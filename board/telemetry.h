@@ -0,0 +1,15 @@
+// Packs a telemetry_t from the health packet and the CAN health of all buses.
+// Kept apart from main_comms.h so it's part of the libpanda host build.
+int get_telemetry_pkt(uint8_t *dat, const struct health_t *health, const can_health_t *can) {
+  COMPILE_TIME_ASSERT(sizeof(struct telemetry_t) <= CONTROL_RESPONSE_MAX_SIZE);
+  struct telemetry_t pkt = {
+    .version = TELEMETRY_PACKET_VERSION,
+    .health_version = HEALTH_PACKET_VERSION,
+    .can_health_version = CAN_HEALTH_PACKET_VERSION,
+    .can_bus_cnt = TELEMETRY_CAN_BUS_CNT,
+  };
+  (void)memcpy((uint8_t*)&pkt.health, (const uint8_t*)health, sizeof(struct health_t));
+  (void)memcpy((uint8_t*)pkt.can_health, (const uint8_t*)can, sizeof(can_health_t) * TELEMETRY_CAN_BUS_CNT);
+  (void)memcpy(dat, (uint8_t*)&pkt, sizeof(struct telemetry_t));
+  return sizeof(struct telemetry_t);
+}
@@ -23,5 +23,5 @@ echo "loaded"
 ls -la /dev/spi*
 sudo chmod 666 /dev/spi*
 ipython -c "from panda import Panda; print(Panda.list())"
-KERN=1 ipython -c "from panda import Panda; print(Panda.list())"
+PANDA_SPI_MODE=kernel ipython -c "from panda import Panda; print(Panda.list())"
 dmesg
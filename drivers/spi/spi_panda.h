@@ -25,6 +25,20 @@ struct spi_panda_transfer {
   __u8 expect_disconnect;
 };
 
+// several transfers submitted with one ioctl. results gets the rx length,
+// or the error, of each transfer that was attempted
+#define SPI_PANDA_BATCH_STOP_ON_SHORT_READ (1U << 0)
+
+struct spi_panda_batch {
+  __u64 transfers;
+  __u64 results;
+  __u32 count;
+  __u32 flags;
+};
+
+#define SPI_IOC_PANDA_BATCH _IOWR(SPI_IOC_MAGIC, 0x50, struct spi_panda_batch)
+#define SPI_PANDA_BATCH_MAX 64U
+
 static u8 panda_calc_checksum(u8 *buf, u16 length) {
   int i;
   u8 checksum = SPI_CHECKSUM_START;
@@ -53,11 +67,10 @@ static long panda_wait_for_ack(struct spidev_data *spidev, u8 ack_val, u8 length
   return -1;
 }
 
-static long panda_transfer_raw(struct spidev_data *spidev, struct spi_device *spi, unsigned long arg) {
+static long panda_transfer_raw(struct spidev_data *spidev, struct spi_device *spi, const struct spi_panda_transfer *pt) {
   u16 rx_len;
   long retval = -1;
   struct spi_header header;
-  struct spi_panda_transfer pt;
 
   struct spi_transfer t = {
     .len = 0,
@@ -70,20 +83,18 @@ static long panda_transfer_raw(struct spidev_data *spidev, struct spi_device *sp
   spi_message_init(&m);
   spi_message_add_tail(&t, &m);
 
-  // read struct from user
-  if (!access_ok(VERIFY_WRITE, arg, sizeof(pt))) {
-    return -1;
-  }
-  if (copy_from_user(&pt, (void __user *)arg, sizeof(pt))) {
-    return -1;
+  dev_dbg(&spi->dev, "ep: %d, tx len: %d\n", pt->endpoint, pt->tx_length);
+
+  // data + checksum, and ack + length + data + checksum, have to fit the buffers
+  if (((pt->tx_length + 1U) > bufsiz) || ((pt->rx_length_max + 4U) > bufsiz)) {
+    return -EMSGSIZE;
   }
-  dev_dbg(&spi->dev, "ep: %d, tx len: %d\n", pt.endpoint, pt.tx_length);
 
   // send header
   header.sync = 0x5a;
-  header.endpoint = pt.endpoint;
-  header.tx_len = pt.tx_length;
-  header.max_rx_len = pt.rx_length_max;
+  header.endpoint = pt->endpoint;
+  header.tx_len = pt->tx_length;
+  header.max_rx_len = pt->rx_length_max;
   memcpy(spidev->tx_buffer, &header, sizeof(header));
   spidev->tx_buffer[sizeof(header)] = panda_calc_checksum(spidev->tx_buffer, sizeof(header));
 
@@ -103,12 +114,14 @@ static long panda_transfer_raw(struct spidev_data *spidev, struct spi_device *sp
 
   // send data
   dev_dbg(&spi->dev, "sending data\n");
-  retval = copy_from_user(spidev->tx_buffer, (const u8 __user *)(uintptr_t)pt.tx_buf, pt.tx_length);
-  spidev->tx_buffer[pt.tx_length] = panda_calc_checksum(spidev->tx_buffer, pt.tx_length);
-  t.len = pt.tx_length + 1;
+  if (copy_from_user(spidev->tx_buffer, (const u8 __user *)(uintptr_t)pt->tx_buf, pt->tx_length)) {
+    return -EFAULT;
+  }
+  spidev->tx_buffer[pt->tx_length] = panda_calc_checksum(spidev->tx_buffer, pt->tx_length);
+  t.len = pt->tx_length + 1;
   retval = spidev_sync(spidev, &m);
 
-  if (pt.expect_disconnect) {
+  if (pt->expect_disconnect) {
     return 0;
   }
 
@@ -123,7 +136,7 @@ static long panda_transfer_raw(struct spidev_data *spidev, struct spi_device *sp
   t.rx_buf = spidev->rx_buffer + 3;
   rx_len = (spidev->rx_buffer[2] << 8) | (spidev->rx_buffer[1]);
   dev_dbg(&spi->dev, "rx len %u\n", rx_len);
-  if (rx_len > pt.rx_length_max) {
+  if (rx_len > pt->rx_length_max) {
     dev_dbg(&spi->dev, "RX len greater than max\n");
     return -1;
   }
@@ -140,21 +153,71 @@ static long panda_transfer_raw(struct spidev_data *spidev, struct spi_device *sp
     return -1;
   }
 
-  retval = copy_to_user((u8 __user *)(uintptr_t)pt.rx_buf, spidev->rx_buffer + 3, rx_len);
+  if (copy_to_user((u8 __user *)(uintptr_t)pt->rx_buf, spidev->rx_buffer + 3, rx_len)) {
+    return -EFAULT;
+  }
 
   return rx_len;
 }
 
-static long panda_transfer(struct spidev_data *spidev, struct spi_device *spi, unsigned long arg) {
+static long panda_transfer_retry(struct spidev_data *spidev, struct spi_device *spi, const struct spi_panda_transfer *pt) {
   int i;
-  int ret;
+  long ret;
   dev_dbg(&spi->dev, "=== XFER start ===\n");
   for (i = 0; i < 20; i++) {
-    ret = panda_transfer_raw(spidev, spi, arg);
-    if (ret >= 0) {
+    ret = panda_transfer_raw(spidev, spi, pt);
+    if ((ret >= 0) || (ret == -EMSGSIZE) || (ret == -EFAULT)) {
       break;
     }
   }
   dev_dbg(&spi->dev, "took %d tries\n", i+1);
   return ret;
 }
+
+static long panda_transfer(struct spidev_data *spidev, struct spi_device *spi, unsigned long arg) {
+  struct spi_panda_transfer pt;
+
+  // read struct from user
+  if (copy_from_user(&pt, (void __user *)arg, sizeof(pt))) {
+    return -EFAULT;
+  }
+  return panda_transfer_retry(spidev, spi, &pt);
+}
+
+// runs the transfers in order, until one fails or, with STOP_ON_SHORT_READ,
+// one returns less than its rx_length_max. returns the number completed
+static long panda_transfer_batch(struct spidev_data *spidev, struct spi_device *spi, unsigned long arg) {
+  u32 i;
+  long ret;
+  struct spi_panda_batch batch;
+  struct spi_panda_transfer pt;
+  struct spi_panda_transfer __user *transfers;
+  __s32 __user *results;
+
+  if (copy_from_user(&batch, (void __user *)arg, sizeof(batch))) {
+    return -EFAULT;
+  }
+  if (batch.count > SPI_PANDA_BATCH_MAX) {
+    return -EINVAL;
+  }
+  transfers = (struct spi_panda_transfer __user *)(uintptr_t)batch.transfers;
+  results = (__s32 __user *)(uintptr_t)batch.results;
+
+  for (i = 0U; i < batch.count; i++) {
+    if (copy_from_user(&pt, &transfers[i], sizeof(pt))) {
+      return -EFAULT;
+    }
+    ret = panda_transfer_retry(spidev, spi, &pt);
+    if (put_user((__s32)ret, &results[i])) {
+      return -EFAULT;
+    }
+    if (ret < 0) {
+      break;
+    }
+    if (((batch.flags & SPI_PANDA_BATCH_STOP_ON_SHORT_READ) != 0U) && (ret < pt.rx_length_max)) {
+      i++;
+      break;
+    }
+  }
+  return i;
+}
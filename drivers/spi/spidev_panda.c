@@ -494,6 +494,10 @@ spidev_ioctl(struct file *filp, unsigned int cmd, unsigned long arg)
 		}
 		break;
 
+	case SPI_IOC_PANDA_BATCH:
+		retval = panda_transfer_batch(spidev, spi, arg);
+		break;
+
 	default:
 		/* segmented and/or full-duplex I/O request */
 		/* Check message and copy into scratch area */
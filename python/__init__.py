@@ -6,16 +6,30 @@ import usb1
 import struct
 import hashlib
 import binascii
+import threading
+from bisect import bisect_right
+from collections import namedtuple
+from contextlib import nullcontext
 from functools import wraps, partial
 from itertools import accumulate
+from typing import NamedTuple
 
 from .base import BaseHandle
 from .constants import FW_PATH, McuType
 from .dfu import PandaDFU
+from .discovery import UsbDiscovery, PandaDevice, bcd_hw_type, probe_concurrently, spi_negative_cache
 from .isotp import isotp_send, isotp_recv
-from .spi import PandaSpiHandle, PandaSpiException, PandaProtocolMismatch
-from .usb import PandaUsbHandle
-from .utils import logger
+from .rxthread import CanRxThread
+from .spi import PandaSpiHandle, PandaSpiException, PandaProtocolMismatch, XFER_SIZE, SPI_MAX_HOLD_MS
+from .stats import TransportStats, StatsSnapshot, instrument, uninstrument
+from .tracing import traced
+from .usb import PandaUsbHandle, AsyncBulkReader
+from .utils import logger, xor_checksum
+
+try:
+  import numpy as np
+except ImportError:
+  np = None  # type: ignore[assignment]
 
 __version__ = '0.0.10'
 
@@ -23,13 +37,59 @@ CANPACKET_HEAD_SIZE = 0x6
 DLC_TO_LEN = [0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64]
 LEN_TO_DLC = {length: dlc for (dlc, length) in enumerate(DLC_TO_LEN)}
 PANDA_BUS_CNT = 3
+USB_CAN_CHUNK_SIZE = 256
+# the firmware only takes an SPI bulk write with this many free TX slots, see board/config.h
+MAX_CAN_MSGS_PER_SPI_BULK_TRANSFER = 170
+
+# field order matches health_t and can_health_t in board/health.h
+HealthRecord = namedtuple("HealthRecord", [
+  "uptime", "voltage", "current", "safety_tx_blocked", "safety_rx_invalid", "tx_buffer_overflow",
+  "rx_buffer_overflow", "faults", "ignition_line", "ignition_can", "controls_allowed", "car_harness_status",
+  "safety_mode", "safety_param", "fault_status", "power_save_enabled", "heartbeat_lost",
+  "alternative_experience", "interrupt_load", "fan_power", "safety_rx_checks_invalid",
+  "spi_checksum_error_count", "fan_stall_count", "sbu1_voltage_mV", "sbu2_voltage_mV", "som_reset_triggered",
+])
+CanHealthRecord = namedtuple("CanHealthRecord", [
+  "bus_off", "bus_off_cnt", "error_warning", "error_passive", "last_error", "last_stored_error",
+  "last_data_error", "last_data_stored_error", "receive_error_cnt", "transmit_error_cnt", "total_error_cnt",
+  "total_tx_lost_cnt", "total_rx_lost_cnt", "total_tx_cnt", "total_rx_cnt", "total_fwd_cnt",
+  "total_tx_checksum_error_cnt", "can_speed", "can_data_speed", "canfd_enabled", "brs_enabled",
+  "canfd_non_iso", "irq0_call_rate", "irq1_call_rate", "irq2_call_rate", "can_core_reset_count",
+])
+
+LEC_ERROR_CODE = {
+  0: "No error",
+  1: "Stuff error",
+  2: "Form error",
+  3: "AckError",
+  4: "Bit1Error",
+  5: "Bit0Error",
+  6: "CRCError",
+  7: "NoChange",
+}
+
+
+class Telemetry(NamedTuple):
+  health: HealthRecord
+  can_health: tuple  # a CanHealthRecord per bus
+
+# one record per CAN packet, see unpack_can_buffer_array
+CAN_FRAME_DTYPE = None
+if np is not None:
+  CAN_FRAME_DTYPE = np.dtype([
+    ('address', '<u4'),
+    ('bus', 'u1'),
+    ('returned', '?'),
+    ('rejected', '?'),
+    ('dlc', 'u1'),
+    ('fd', '?'),
+    ('data', 'u1', (64, )),
+    ('length', 'u1'),
+  ])
 
 
 def calculate_checksum(data):
-  res = 0
-  for b in data:
-    res ^= b
-  return res
+  return xor_checksum(data)
 
 def pack_can_buffer(arr, fd=False):
   snds = [b'']
@@ -49,11 +109,144 @@ def pack_can_buffer(arr, fd=False):
     header[5] = calculate_checksum(header[:5] + dat)
 
     snds[-1] += header + dat
-    if len(snds[-1]) > 256: # Limit chunks to 256 bytes
+    if len(snds[-1]) > USB_CAN_CHUNK_SIZE: # Limit chunks to 256 bytes
       snds.append(b'')
 
   return snds
 
+
+class CanPacker:
+  """
+    Packs CAN messages for comms_can_write into one reusable buffer and
+    splits it into chunks of at most chunk_size bytes, and max_packets
+    packets if set, on packet boundaries.
+
+    Accepts a list of (address, dat, bus) like pack_can_buffer, a numpy
+    array of CAN_FRAME_DTYPE (packed without a per-message loop), or an
+    already packed buffer, which is only split into chunks.
+
+    The returned chunks are memoryviews into the packer's buffer and are
+    only valid until the next call to pack().
+  """
+
+  MAX_PACKET_SIZE = CANPACKET_HEAD_SIZE + 64
+
+  def __init__(self, chunk_size: int = USB_CAN_CHUNK_SIZE, size: int = 0x4000, max_packets: int | None = None):
+    assert chunk_size >= self.MAX_PACKET_SIZE
+    assert max_packets is None or max_packets > 0
+    self.chunk_size = chunk_size
+    self.max_packets = max_packets
+    self._ends: list[int] = []
+    self._alloc(size)
+    self._packed = self._view[0:0]
+
+  def _alloc(self, size: int) -> None:
+    # a new buffer rather than a resize, chunks from the last call may still be around
+    self._buf = bytearray(size)
+    self._view = memoryview(self._buf)
+
+  def _chunks(self, view, ends) -> list[memoryview]:
+    self._ends = ends
+    self._packed = view
+    ret = []
+    start = 0
+    i = 0
+    while i < len(ends):
+      n = bisect_right(ends, start + self.chunk_size, lo=i)
+      i = n if self.max_packets is None else min(n, i + self.max_packets)
+      end = int(ends[i - 1])
+      ret.append(view[start:end])
+      start = end
+    return ret
+
+  @property
+  def packet_count(self) -> int:
+    return len(self._ends)
+
+  def packets_in(self, length: int) -> tuple[int, memoryview]:
+    """
+      For the first length bytes of the last pack(), returns the number of
+      complete packets and the rest of the packet that was cut off, if any.
+    """
+    n = bisect_right(self._ends, length)
+    start = int(self._ends[n - 1]) if n > 0 else 0
+    if length > start:
+      return n, self._packed[length:int(self._ends[n])]
+    return n, self._packed[length:length]
+
+  def pack(self, arr, fd: bool = False) -> list[memoryview]:
+    if isinstance(arr, (bytes, bytearray, memoryview)):
+      return self._pack_buffer(memoryview(arr).cast('B'))
+    elif np is not None and isinstance(arr, np.ndarray):
+      return self._pack_array(arr, fd)
+
+    arr = arr if isinstance(arr, (list, tuple)) else list(arr)
+    if len(self._buf) < len(arr) * self.MAX_PACKET_SIZE:
+      self._alloc(len(arr) * self.MAX_PACKET_SIZE)
+    buf, view = self._buf, self._view
+
+    ends = []
+    pos = 0
+    fd_bit = int(fd)
+    for address, dat, bus in arr:
+      assert len(dat) in LEN_TO_DLC
+
+      extended = 1 if address >= 0x800 else 0
+      word_4b = address << 3 | extended << 2
+      header_0 = (LEN_TO_DLC[len(dat)] << 4) | (bus << 1) | fd_bit
+      data_end = pos + CANPACKET_HEAD_SIZE + len(dat)
+
+      # header XOR is folded from the address word, only the payload is scanned
+      cksum = word_4b ^ (word_4b >> 16)
+      cksum = (cksum ^ (cksum >> 8) ^ header_0) & 0xFF
+      struct.pack_into("<BIB", buf, pos, header_0, word_4b, xor_checksum(dat, cksum))
+      buf[pos + CANPACKET_HEAD_SIZE:data_end] = dat
+
+      ends.append(data_end)
+      pos = data_end
+
+    return self._chunks(view, ends)
+
+  def _pack_array(self, arr, fd: bool) -> list[memoryview]:
+    lut = np.full(65, 0xFF, dtype=np.uint8)
+    lut[DLC_TO_LEN] = np.arange(len(DLC_TO_LEN))
+    data_len = arr['length'].astype(np.intp)
+    data_len_code = lut[data_len]
+    assert not (data_len_code == 0xFF).any(), "invalid CAN data length"
+
+    ends = np.cumsum(data_len + CANPACKET_HEAD_SIZE)
+    total = int(ends[-1]) if len(ends) > 0 else 0
+    if len(self._buf) < total:
+      self._alloc(total)
+    buf = np.frombuffer(self._buf, dtype=np.uint8, count=total)
+    offs = ends - (data_len + CANPACKET_HEAD_SIZE)
+
+    address = arr['address'].astype(np.uint32)
+    word_4b = (address << 3) | ((address >= 0x800).astype(np.uint32) << 2)
+    header = np.empty((len(arr), CANPACKET_HEAD_SIZE), dtype=np.uint8)
+    header[:, 0] = (data_len_code << 4) | (arr['bus'].astype(np.uint8) << 1) | (arr['fd'] | fd)
+    header[:, 1:5] = word_4b.astype('<u4').view(np.uint8).reshape(-1, 4)
+
+    cols = np.arange(64)
+    data_mask = cols < data_len[:, None]
+    data = np.where(data_mask, arr['data'], 0)
+    header[:, 5] = np.bitwise_xor.reduce(header[:, :5], axis=1) ^ np.bitwise_xor.reduce(data, axis=1)
+
+    buf[offs[:, None] + np.arange(CANPACKET_HEAD_SIZE)] = header
+    buf[(offs[:, None] + CANPACKET_HEAD_SIZE + cols)[data_mask]] = data[data_mask]
+
+    return self._chunks(self._view, ends)
+
+  def _pack_buffer(self, view) -> list[memoryview]:
+    # already packed, just find the packet boundaries
+    ends = []
+    pos = 0
+    while pos < len(view):
+      pos += CANPACKET_HEAD_SIZE + DLC_TO_LEN[view[pos] >> 4]
+      ends.append(pos)
+    assert pos == len(view), "partial CAN packet in buffer"
+    return self._chunks(view, ends)
+
 def unpack_can_buffer(dat):
   ret = []
 
@@ -85,6 +278,166 @@ def unpack_can_buffer(dat):
 
   return (ret, dat)
 
+def unpack_can_buffer_array(dat):
+  """
+    Same as unpack_can_buffer, but decodes the whole batch into a single
+    numpy structured array of CAN_FRAME_DTYPE. Unlike unpack_can_buffer,
+    the returned/rejected flags aren't folded into the bus number.
+  """
+  ret, pos = _unpack_can_buffer_array(dat)
+  return (ret, bytes(dat[pos:]))
+
+def _unpack_can_buffer_array(dat):
+  # returns the array and the length of the complete packets in dat
+  if np is None:
+    raise RuntimeError("numpy is required for unpack_can_buffer_array")
+
+  # the packet boundaries depend on the previous packets, so walk the
+  # headers once. everything else is done on the whole batch at once
+  offsets = []
+  pos = 0
+  end = len(dat)
+  while (end - pos) >= CANPACKET_HEAD_SIZE:
+    pckt_len = CANPACKET_HEAD_SIZE + DLC_TO_LEN[dat[pos] >> 4]
+    # we need more from the next transfer
+    if (pos + pckt_len) > end:
+      break
+    offsets.append(pos)
+    pos += pckt_len
+
+  ret = np.zeros(len(offsets), dtype=CAN_FRAME_DTYPE)
+  if len(offsets) > 0:
+    buf = np.frombuffer(dat, dtype=np.uint8, count=pos)
+    offs = np.array(offsets, dtype=np.intp)
+
+    # XOR over each packet, including the checksum byte, must be zero
+    assert not np.bitwise_xor.reduceat(buf, offs).any(), "CAN packet checksum incorrect"
+
+    header = [buf[offs + i].astype(np.uint32) for i in range(5)]
+    data_len_code = header[0] >> 4
+    data_len = np.array(DLC_TO_LEN, dtype=np.uint8)[data_len_code]
+    ret['address'] = (header[4] << 24 | header[3] << 16 | header[2] << 8 | header[1]) >> 3
+    ret['bus'] = (header[0] >> 1) & 0x7
+    ret['fd'] = header[0] & 0x1
+    ret['returned'] = (header[1] >> 1) & 0x1
+    ret['rejected'] = header[1] & 0x1
+    ret['dlc'] = data_len_code
+    ret['length'] = data_len
+
+    # gather payloads, zero-padded to 64 bytes
+    cols = np.arange(64)
+    idx = np.minimum(offs[:, None] + CANPACKET_HEAD_SIZE + cols, pos - 1)
+    ret['data'] = np.where(cols < data_len[:, None], buf[idx], 0)
+
+  return (ret, pos)
+
+
+class CanStreamDecoder:
+  """
+    Incremental decoder for the CAN stream produced by comms_can_read.
+
+    A CANPacket_t can be split across transfers at any byte. Instead of
+    concatenating the partial tail with every new transfer, the tail is
+    kept at the start of a reusable buffer and the new transfer is copied
+    in right behind it. Packets are then sliced out using memoryview offsets.
+
+    With copy=False, payloads are memoryviews into the decoder's buffer and
+    are only valid until the next call to feed().
+  """
+
+  MAX_PACKET_SIZE = CANPACKET_HEAD_SIZE + 64
+
+  def __init__(self, size: int = 16384, copy: bool = True):
+    self._copy = copy
+    self._size = size
+    self._tail_start = 0
+    self._tail_len = 0
+    self._buf = bytearray()
+    self._alloc(size)
+
+  def _alloc(self, size: int) -> None:
+    # previously handed out views keep the old buffer alive
+    buf = bytearray(size + self.MAX_PACKET_SIZE)
+    if self._tail_len > 0:
+      buf[:self._tail_len] = self._buf[self._tail_start:self._tail_start + self._tail_len]
+    self._buf = buf
+    self._view = memoryview(buf)
+    self._tail_start = 0
+
+  @property
+  def tail(self) -> bytes:
+    return bytes(self._buf[self._tail_start:self._tail_start + self._tail_len])
+
+  @tail.setter
+  def tail(self, dat) -> None:
+    self._tail_len = 0
+    self._alloc(max(self._size, len(dat)))
+    self._buf[:len(dat)] = dat
+    self._tail_len = len(dat)
+
+  def reset(self) -> None:
+    self._tail_len = 0
+
+  def _append(self, dat) -> int:
+    # puts dat behind the tail, returns the end of the data
+    end = self._tail_len + len(dat)
+    if end > len(self._buf) or self._tail_start > 0 or not self._copy:
+      # views handed out by the previous transfer must not be overwritten
+      self._alloc(max(self._size, end))
+    self._view[self._tail_len:end] = dat
+    return end
+
+  def _keep_tail(self, pos: int, end: int) -> None:
+    # keep the partial packet for the next transfer. without views
+    # pointing into the buffer, it can just be moved to the front
+    self._tail_len = end - pos
+    self._tail_start = pos
+    if self._copy:
+      self._buf[:self._tail_len] = self._buf[pos:end]
+      self._tail_start = 0
+
+  def feed(self, dat) -> list:
+    end = self._append(dat)
+    buf, view = self._buf, self._view
+
+    ret = []
+    pos = 0
+    while (end - pos) >= CANPACKET_HEAD_SIZE:
+      data_len = DLC_TO_LEN[buf[pos] >> 4]
+      pckt_end = pos + CANPACKET_HEAD_SIZE + data_len
+
+      # we need more from the next transfer
+      if pckt_end > end:
+        break
+
+      assert calculate_checksum(view[pos:pckt_end]) == 0, "CAN packet checksum incorrect"
+
+      bus = (buf[pos] >> 1) & 0x7
+      address = (buf[pos + 4] << 24 | buf[pos + 3] << 16 | buf[pos + 2] << 8 | buf[pos + 1]) >> 3
+      if (buf[pos + 1] >> 1) & 0x1:
+        # returned
+        bus += 128
+      if buf[pos + 1] & 0x1:
+        # rejected
+        bus += 192
+
+      data = view[pos + CANPACKET_HEAD_SIZE:pckt_end]
+      ret.append((address, bytes(data) if self._copy else data, bus))
+      pos = pckt_end
+
+    self._keep_tail(pos, end)
+    return ret
+
+  def feed_array(self, dat):
+    """
+      Same as feed, but returns the packets as a numpy array
+      of CAN_FRAME_DTYPE, see unpack_can_buffer_array.
+    """
+    end = self._append(dat)
+    ret, pos = _unpack_can_buffer_array(self._view[:end])
+    self._keep_tail(pos, end)
+    return ret
+
 
 def ensure_version(desc, lib_field, panda_field, fn):
   @wraps(fn)
@@ -99,6 +452,13 @@ ensure_can_packet_version = partial(ensure_version, "CAN", "CAN_PACKET_VERSION",
 ensure_can_health_packet_version = partial(ensure_version, "CAN health", "CAN_HEALTH_PACKET_VERSION", "can_health_version")
 ensure_health_packet_version = partial(ensure_version, "health", "HEALTH_PACKET_VERSION", "health_version")
 
+def ensure_configured(fn):
+  @wraps(fn)
+  def wrapper(self, *args, **kwargs):
+    if self._config_pending:
+      self.configure()
+    return fn(self, *args, **kwargs)
+  return wrapper
 
 
 class Panda:
@@ -131,6 +491,10 @@ class Panda:
   CAN_HEALTH_PACKET_VERSION = 5
   HEALTH_STRUCT = struct.Struct("<IIIIIIIIBBBBBHBBBHfBBHBHHB")
   CAN_HEALTH_STRUCT = struct.Struct("<BIBBBBBBBBIIIIIIIHHBBBIIII")
+  CAN_BUS_CONFIG_STRUCT = struct.Struct("<HHBB")
+  TELEMETRY_PACKET_VERSION = 1
+  TELEMETRY_HEADER_STRUCT = struct.Struct("<BBBB")
+  TELEMETRY_SIZE = TELEMETRY_HEADER_STRUCT.size + HEALTH_STRUCT.size + CAN_HEALTH_STRUCT.size * PANDA_BUS_CNT
 
   F4_DEVICES = [HW_TYPE_WHITE_PANDA, HW_TYPE_GREY_PANDA, HW_TYPE_BLACK_PANDA, HW_TYPE_UNO, HW_TYPE_DOS]
   H7_DEVICES = [HW_TYPE_RED_PANDA, HW_TYPE_RED_PANDA_V2, HW_TYPE_TRES, HW_TYPE_CUATRO]
@@ -149,13 +513,26 @@ class Panda:
   HARNESS_STATUS_NORMAL = 1
   HARNESS_STATUS_FLIPPED = 2
 
-  def __init__(self, serial: str | None = None, claim: bool = True, disable_checks: bool = True, can_speed_kbps: int = 500, cli: bool = True):
+  def __init__(self, serial: str | None = None, claim: bool = True, disable_checks: bool = True, can_speed_kbps: int = 500, cli: bool = True,
+               lazy: bool = False, usb_context=None, stats: bool = False):
     self._disable_checks = disable_checks
+    # a USB context shared with other pandas, owned by the caller
+    self._usb_context = usb_context
+    self._lazy = lazy
+    self._config_pending = False
 
     self._handle: BaseHandle
     self._handle_open = False
-    self.can_rx_overflow_buffer = b''
+    self._can_rx_decoder = CanStreamDecoder()
+    self._can_packer = CanPacker()
+    self._can_tx_lock = threading.Lock()
+    self._can_rx_thread: CanRxThread | None = None
+    self._can_rx_reader: AsyncBulkReader | None = None
     self._can_speed_kbps = can_speed_kbps
+    # immutable device info, read once per connection
+    self._identity: dict = {}
+    # transfer stats, kept across reconnects
+    self._stats: TransportStats | None = TransportStats() if stats else None
 
     if cli and serial is None:
         self._connect_serial = self._cli_select_panda()
@@ -195,19 +572,22 @@ class Panda:
     self.close()
 
   def close(self):
+    self.stop_rx_thread()
     if self._handle_open:
       self._handle.close()
       self._handle_open = False
-      if self._context is not None:
+      if self._context is not None and self._context is not self._usb_context:
         self._context.close()
 
+  @traced("panda")
   def connect(self, claim=True, wait=False):
     self.close()
+    self._identity.clear()
 
     self._handle = None
     while self._handle is None:
       # try USB first, then SPI
-      self._context, self._handle, serial, self.bootstub, bcd = self.usb_connect(self._connect_serial, claim=claim, no_error=wait)
+      self._context, self._handle, serial, self.bootstub, bcd = self.usb_connect(self._connect_serial, claim=claim, no_error=wait, context=self._usb_context)
       if self._handle is None:
         self._context, self._handle, serial, self.bootstub, bcd = self.spi_connect(self._connect_serial)
       if not wait:
@@ -215,6 +595,8 @@ class Panda:
 
     if self._handle is None:
       raise Exception("failed to connect to panda")
+    if self._stats is not None:
+      instrument(self._handle, self._stats)
 
     # Some fallback logic to determine panda and MCU type for old bootstubs,
     # since we now support multiple MCUs and need to know which fw to flash.
@@ -232,29 +614,56 @@ class Panda:
 
     # For case A, we assume F4 MCU type, since all H7 pandas should be case B at worst
     self._assume_f4_mcu = (self._bcd_hw_type is None) and missing_hw_type_endpoint
+    self._identity["hw_type"] = self._hw_type_from(ret)
 
     self._serial = serial
     self._connect_serial = serial
     self._handle_open = True
+    self._can_packer.chunk_size = XFER_SIZE if self.spi else USB_CAN_CHUNK_SIZE
+    self._can_packer.max_packets = MAX_CAN_MSGS_PER_SPI_BULK_TRANSFER if self.spi else None
     self._mcu_type = self.get_mcu_type()
     self.health_version, self.can_version, self.can_health_version = self.get_packets_versions()
     logger.debug("connected")
 
-    # disable openpilot's heartbeat checks
+    # disable openpilot's heartbeat checks. not deferred in lazy mode,
+    # the panda drops back to SILENT without heartbeats otherwise
     if self._disable_checks:
       self.set_heartbeat_disabled()
       self.set_power_save(0)
 
+    # in lazy mode, the CAN setup waits for the first CAN call
+    self._config_pending = True
+    if not self._lazy:
+      self.configure()
+
+  @traced("panda")
+  def configure(self):
+    """
+      Applies the connect-time CAN settings. Bus settings the panda
+      already has are read back first and not sent again.
+    """
+    self._config_pending = False
+
     # reset comms
     self.can_reset_communications()
 
-    # disable automatic CAN-FD switching
+    current = self.get_can_bus_config()
     for bus in range(PANDA_BUS_CNT):
-      self.set_canfd_auto(bus, False)
+      # disable automatic CAN-FD switching
+      if current[bus]["canfd_auto"] is not False:
+        self.set_canfd_auto(bus, False)
 
-    # set CAN speed
-    for bus in range(PANDA_BUS_CNT):
-      self.set_can_speed_kbps(bus, self._can_speed_kbps)
+      # set CAN speed
+      if current[bus]["can_speed"] != self._can_speed_kbps:
+        self.set_can_speed_kbps(bus, self._can_speed_kbps)
+
+  @property
+  def can_rx_overflow_buffer(self) -> bytes:
+    return self._can_rx_decoder.tail
+
+  @can_rx_overflow_buffer.setter
+  def can_rx_overflow_buffer(self, dat) -> None:
+    self._can_rx_decoder.tail = dat
 
   @property
   def spi(self) -> bool:
@@ -303,10 +712,12 @@ class Panda:
     return None, handle, spi_serial, bootstub, None
 
   @classmethod
-  def usb_connect(cls, serial, claim=True, no_error=False):
+  def usb_connect(cls, serial, claim=True, no_error=False, context=None):
     handle, usb_serial, bootstub, bcd = None, None, None, None
-    context = usb1.USBContext()
-    context.open()
+    own_context = context is None
+    if own_context:
+      context = usb1.USBContext()
+      context.open()
     try:
       for device in context.getDeviceList(skip_on_error=True):
         if device.getVendorID() in cls.USB_VIDS and device.getProductID() in cls.USB_PIDS:
@@ -341,8 +752,8 @@ class Panda:
 
     usb_handle = None
     if handle is not None:
-      usb_handle = PandaUsbHandle(handle)
-    else:
+      usb_handle = PandaUsbHandle(handle, context)
+    elif own_context:
       context.close()
 
     return context, usb_handle, usb_serial, bootstub, bcd
@@ -355,37 +766,71 @@ class Panda:
 
   @classmethod
   def list(cls):
-    ret = cls.usb_list()
-    ret += cls.spi_list()
-    return list(set(ret))
+    return list(dict.fromkeys(d.serial for d in cls.list_devices()))
 
   @classmethod
-  def usb_list(cls):
+  def list_devices(cls, usb_timeout: float | None = None, spi_timeout: float | None = None):
+    """
+      Returns a PandaDevice record for every device found. USB and SPI are
+      probed at the same time, each with its own deadline in seconds, None
+      for no deadline. Both return on their own, so neither has one by
+      default. A transport that doesn't answer in time contributes nothing,
+      and its probe keeps running in the background, an SPI one holding
+      the SPI device until it's done.
+    """
+    ret = probe_concurrently({
+      "usb": (cls.usb_list_devices, usb_timeout),
+      "spi": (cls.spi_list_devices, spi_timeout),
+    })
+    return ret["usb"] + ret["spi"]
+
+  @classmethod
+  def usb_list(cls, context=None):
+    return [d.serial for d in cls.usb_list_devices(context)]
+
+  @classmethod
+  def usb_list_devices(cls, context=None):
     ret = []
+    own_context = context is None
     try:
-      with usb1.USBContext() as context:
-        for device in context.getDeviceList(skip_on_error=True):
-          if device.getVendorID() in cls.USB_VIDS and device.getProductID() in cls.USB_PIDS:
-            try:
-              serial = device.getSerialNumber()
-              if len(serial) == 24:
-                ret.append(serial)
-              else:
-                logger.warning(f"found device with panda descriptors but invalid serial: {serial}", RuntimeWarning)
-            except Exception:
-              logger.exception("error connecting to panda")
+      if own_context:
+        context = usb1.USBContext()
+        context.open()
+      for device in context.getDeviceList(skip_on_error=True):
+        if device.getVendorID() in cls.USB_VIDS and device.getProductID() in cls.USB_PIDS:
+          try:
+            serial = device.getSerialNumber()
+            if len(serial) == 24:
+              bootstub = (device.getProductID() & 0xF0) == 0xe0
+              ret.append(PandaDevice(serial, "usb", bootstub, False, bcd_hw_type(device.getbcdDevice())))
+            else:
+              logger.warning(f"found device with panda descriptors but invalid serial: {serial}", RuntimeWarning)
+          except Exception:
+            logger.exception("error connecting to panda")
     except Exception:
       logger.exception("exception while listing pandas")
+    finally:
+      if own_context and context is not None:
+        context.close()
     return ret
 
   @classmethod
   def spi_list(cls):
-    _, _, serial, _, _ = cls.spi_connect(None, ignore_version=True)
+    return [d.serial for d in cls.spi_list_devices()]
+
+  @classmethod
+  def spi_list_devices(cls):
+    cache = spi_negative_cache(cls)
+    if cache.absent():
+      return []
+    _, _, serial, bootstub, _ = cls.spi_connect(None, ignore_version=True)
+    cache.update(serial is not None)
     if serial is not None:
-      return [serial, ]
+      return [PandaDevice(serial, "spi", bootstub, False, None), ]
     return []
 
   def reset(self, enter_bootstub=False, enter_bootloader=False, reconnect=True):
+    self._identity.clear()
     # no response is expected since it resets right away
     timeout = 5000 if isinstance(self._handle, PandaSpiHandle) else 15000
     try:
@@ -407,22 +852,32 @@ class Panda:
   def connected(self) -> bool:
     return self._handle_open
 
+  @traced("panda")
   def reconnect(self):
+    was_usb = self.is_connected_usb()
     if self._handle_open:
       self.close()
 
-    success = False
+    # over USB, only try to connect once the panda shows up
+    discovery = UsbDiscovery.shared() if was_usb else None
+
     # wait up to 15 seconds
-    for _ in range(15*10):
-      try:
-        self.connect(claim=False, wait=True)
-        success = True
-        break
-      except Exception:
-        pass
-      time.sleep(0.1)
-    if not success:
-      raise Exception("reconnect failed")
+    deadline = time.monotonic() + 15
+    while True:
+      if discovery is None or discovery.find(self._connect_serial, product_ids=self.USB_PIDS) is not None:
+        try:
+          self.connect(claim=False, wait=True)
+          return
+        except Exception:
+          pass
+
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        raise Exception("reconnect failed")
+      if discovery is not None:
+        discovery.wait_for_change(min(remaining, 0.1))
+      else:
+        time.sleep(0.1)
 
   @staticmethod
   def flasher_present(handle: BaseHandle) -> bool:
@@ -464,6 +919,7 @@ class Panda:
     except Exception:
       pass
 
+  @traced("panda")
   def flash(self, fn=None, code=None, reconnect=True):
     if self.up_to_date(fn=fn):
       logger.info("flash: already up to date")
@@ -486,6 +942,7 @@ class Panda:
 
     # do flash
     Panda.flash_static(self._handle, code, mcu_type=self._mcu_type)
+    self._identity.clear()
 
     # reconnect
     if reconnect:
@@ -501,7 +958,7 @@ class Panda:
     if not self.wait_for_dfu(dfu_serial, timeout=timeout):
       return False
 
-    dfu = PandaDFU(dfu_serial)
+    dfu = PandaDFU(dfu_serial, usb_context=self._usb_context)
     dfu.recover()
 
     # reflash after recover
@@ -511,27 +968,33 @@ class Panda:
 
   @staticmethod
   def wait_for_dfu(dfu_serial: str | None, timeout: int | None = None) -> bool:
-    t_start = time.monotonic()
-    dfu_list = PandaDFU.list()
-    while (dfu_serial is None and len(dfu_list) == 0) or (dfu_serial is not None and dfu_serial not in dfu_list):
-      logger.debug("waiting for DFU...")
-      time.sleep(0.1)
-      if timeout is not None and (time.monotonic() - t_start) > timeout:
-        return False
-      dfu_list = PandaDFU.list()
-    return True
+    return Panda._wait_for_device(dfu_serial, True, timeout, PandaDFU.spi_list)
 
   @staticmethod
   def wait_for_panda(serial: str | None, timeout: int) -> bool:
-    t_start = time.monotonic()
-    serials = Panda.list()
-    while (serial is None and len(serials) == 0) or (serial is not None and serial not in serials):
-      logger.debug("waiting for panda...")
-      time.sleep(0.1)
-      if timeout is not None and (time.monotonic() - t_start) > timeout:
-        return False
-      serials = Panda.list()
-    return True
+    return Panda._wait_for_device(serial, False, timeout, Panda.spi_list)
+
+  @staticmethod
+  def _wait_for_device(serial: str | None, dfu: bool, timeout: int | None, spi_list) -> bool:
+    # USB devices are reported by the discovery service as soon as they show up,
+    # SPI can only be probed
+    discovery = UsbDiscovery.shared()
+    product_ids = None if dfu else Panda.USB_PIDS
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+      if discovery.find(serial, dfu=dfu, product_ids=product_ids) is not None:
+        return True
+      spi_serials = spi_list()
+      if (serial is None and len(spi_serials) > 0) or serial in spi_serials:
+        return True
+
+      logger.debug("waiting for DFU..." if dfu else "waiting for panda...")
+      wait = 0.1
+      if deadline is not None:
+        wait = min(deadline - time.monotonic(), wait)
+        if wait <= 0:
+          return False
+      discovery.wait_for_change(wait)
 
   def up_to_date(self, fn=None) -> bool:
     current = self.get_signature()
@@ -543,83 +1006,131 @@ class Panda:
   def call_control_api(self, msg):
     self._handle.controlWrite(Panda.REQUEST_OUT, msg, 0, 0, b'')
 
+  def transaction(self, max_hold_ms: float = SPI_MAX_HOLD_MS):
+    """
+      Makes the transfers in the block share one lock of the SPI device,
+      instead of locking it per transfer. Does nothing over USB.
+
+        with p.transaction():
+          msgs = p.can_recv()
+          health = p.health()
+    """
+    if isinstance(self._handle, PandaSpiHandle):
+      return self._handle.transaction(max_hold_ms)
+    return nullcontext()
+
+  # ******************* stats *******************
+
+  def enable_stats(self, enabled: bool = True) -> None:
+    """
+      Turns transfer stats on or off. They're off by default, and then
+      the handle isn't instrumented at all.
+    """
+    if enabled and self._stats is None:
+      self._stats = TransportStats()
+      if self._handle_open:
+        instrument(self._handle, self._stats)
+    elif not enabled and self._stats is not None:
+      self._stats = None
+      if self._handle_open:
+        uninstrument(self._handle)
+
+  def stats(self, since: StatsSnapshot | None = None) -> StatsSnapshot:
+    """
+      Returns call counts, bytes, errors, timeouts, retries and latency
+      histograms per (op, request or endpoint). With since, an earlier
+      snapshot, only what happened after it is returned.
+
+        before = p.stats()
+        p.can_send_many(msgs)
+        print(p.stats(since=before)[("bulk_write", 3)].percentile_us(99))
+    """
+    snapshot = self._stats.snapshot() if self._stats is not None else StatsSnapshot()
+    return snapshot if since is None else snapshot - since
+
   # ******************* health *******************
 
+  @traced("panda")
   @ensure_health_packet_version
   def health(self):
     dat = self._handle.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, self.HEALTH_STRUCT.size)
-    a = self.HEALTH_STRUCT.unpack(dat)
-    return {
-      "uptime": a[0],
-      "voltage": a[1],
-      "current": a[2],
-      "safety_tx_blocked": a[3],
-      "safety_rx_invalid": a[4],
-      "tx_buffer_overflow": a[5],
-      "rx_buffer_overflow": a[6],
-      "faults": a[7],
-      "ignition_line": a[8],
-      "ignition_can": a[9],
-      "controls_allowed": a[10],
-      "car_harness_status": a[11],
-      "safety_mode": a[12],
-      "safety_param": a[13],
-      "fault_status": a[14],
-      "power_save_enabled": a[15],
-      "heartbeat_lost": a[16],
-      "alternative_experience": a[17],
-      "interrupt_load": a[18],
-      "fan_power": a[19],
-      "safety_rx_checks_invalid": a[20],
-      "spi_checksum_error_count": a[21],
-      "fan_stall_count": a[22],
-      "sbu1_voltage_mV": a[23],
-      "sbu2_voltage_mV": a[24],
-      "som_reset_triggered": a[25],
-    }
+    return self._parse_health(dat)
+
+  def _parse_health(self, dat):
+    return self._health_record(dat)._asdict()
 
+  def _health_record(self, dat, offset=0):
+    return HealthRecord._make(self.HEALTH_STRUCT.unpack_from(dat, offset))
+
+  @traced("panda")
   @ensure_can_health_packet_version
   def can_health(self, can_number):
-    LEC_ERROR_CODE = {
-      0: "No error",
-      1: "Stuff error",
-      2: "Form error",
-      3: "AckError",
-      4: "Bit1Error",
-      5: "Bit0Error",
-      6: "CRCError",
-      7: "NoChange",
-    }
     dat = self._handle.controlRead(Panda.REQUEST_IN, 0xc2, int(can_number), 0, self.CAN_HEALTH_STRUCT.size)
-    a = self.CAN_HEALTH_STRUCT.unpack(dat)
-    return {
-      "bus_off": a[0],
-      "bus_off_cnt": a[1],
-      "error_warning": a[2],
-      "error_passive": a[3],
-      "last_error": LEC_ERROR_CODE[a[4]],
-      "last_stored_error": LEC_ERROR_CODE[a[5]],
-      "last_data_error": LEC_ERROR_CODE[a[6]],
-      "last_data_stored_error": LEC_ERROR_CODE[a[7]],
-      "receive_error_cnt": a[8],
-      "transmit_error_cnt": a[9],
-      "total_error_cnt": a[10],
-      "total_tx_lost_cnt": a[11],
-      "total_rx_lost_cnt": a[12],
-      "total_tx_cnt": a[13],
-      "total_rx_cnt": a[14],
-      "total_fwd_cnt": a[15],
-      "total_tx_checksum_error_cnt": a[16],
-      "can_speed": a[17],
-      "can_data_speed": a[18],
-      "canfd_enabled": a[19],
-      "brs_enabled": a[20],
-      "canfd_non_iso": a[21],
-      "irq0_call_rate": a[22],
-      "irq1_call_rate": a[23],
-      "irq2_call_rate": a[24],
-      "can_core_reset_count": a[25],
-    }
+    return self._parse_can_health(dat)
+
+  def _parse_can_health(self, dat):
+    return self._can_health_record(dat)._asdict()
+
+  def _can_health_record(self, dat, offset=0):
+    a = list(self.CAN_HEALTH_STRUCT.unpack_from(dat, offset))
+    a[4:8] = (LEC_ERROR_CODE[e] for e in a[4:8])
+    return CanHealthRecord._make(a)
+
+  @traced("panda")
+  def telemetry(self):
+    """
+      Health and the CAN health of all buses, read in one transfer so
+      they're from the same moment. Falls back to separate reads on
+      firmware without the telemetry request.
+    """
+    dat = self._handle.controlRead(Panda.REQUEST_IN, 0xc8, 0, 0, self.TELEMETRY_SIZE)
+    if len(dat) == 0:
+      return Telemetry(HealthRecord(**self.health()), tuple(CanHealthRecord(**self.can_health(bus)) for bus in range(PANDA_BUS_CNT)))
+    return self._parse_telemetry(dat)
+
+  def _parse_telemetry(self, dat):
+    version, health_version, can_health_version, bus_cnt = self.TELEMETRY_HEADER_STRUCT.unpack_from(dat)
+    panda_versions = (version, health_version, can_health_version)
+    lib_versions = (self.TELEMETRY_PACKET_VERSION, self.HEALTH_PACKET_VERSION, self.CAN_HEALTH_PACKET_VERSION)
+    if panda_versions != lib_versions:
+      raise RuntimeError(f"telemetry packet version mismatch: panda's firmware v{panda_versions}, library v{lib_versions}. Reflash panda.")
+    assert len(dat) == self.TELEMETRY_SIZE and bus_cnt == PANDA_BUS_CNT, f"bad telemetry packet: {len(dat)} bytes, {bus_cnt} buses"
+
+    offset = self.TELEMETRY_HEADER_STRUCT.size
+    health = self._health_record(dat, offset)
+    offset += self.HEALTH_STRUCT.size
+    can_health = tuple(self._can_health_record(dat, offset + bus * self.CAN_HEALTH_STRUCT.size) for bus in range(bus_cnt))
+    return Telemetry(health, can_health)
+
+  def get_can_bus_config(self):
+    """
+      Returns the current CAN settings of each bus. Firmware without the
+      bus config request falls back to can_health, which lacks canfd_auto.
+      Settings that can't be read are None.
+    """
+    size = self.CAN_BUS_CONFIG_STRUCT.size
+    dat = self._handle.controlRead(Panda.REQUEST_IN, 0xc7, 0, 0, size * PANDA_BUS_CNT)
+    if len(dat) == size * PANDA_BUS_CNT:
+      ret = []
+      for bus in range(PANDA_BUS_CNT):
+        a = self.CAN_BUS_CONFIG_STRUCT.unpack_from(dat, bus * size)
+        ret.append({
+          "can_speed": a[0],
+          "can_data_speed": a[1],
+          "canfd_auto": bool(a[2]),
+          "canfd_non_iso": bool(a[3]),
+        })
+      return ret
+
+    ret = []
+    for bus in range(PANDA_BUS_CNT):
+      cfg = {"can_speed": None, "can_data_speed": None, "canfd_auto": None, "canfd_non_iso": None}
+      if self.can_health_version == self.CAN_HEALTH_PACKET_VERSION:
+        health = self.can_health(bus)
+        cfg.update(can_speed=health["can_speed"], can_data_speed=health["can_data_speed"],
+                   canfd_non_iso=bool(health["canfd_non_iso"]))
+      ret.append(cfg)
+    return ret
 
   # ******************* control *******************
 
@@ -632,14 +1143,35 @@ class Panda:
       f.seek(-128, 2)  # Seek from end of file
       return f.read(128)
 
+  def _cached(self, key, read_fn):
+    if key not in self._identity:
+      self._identity[key] = read_fn()
+    return self._identity[key]
+
+  def refresh(self):
+    """
+      Drops the cached device identity (hw type, UID, serial,
+      signature, versions) and reads it again.
+    """
+    self._identity.clear()
+    self._mcu_type = self.get_mcu_type()
+    self.health_version, self.can_version, self.can_health_version = self.get_packets_versions()
+
   def get_signature(self) -> bytes:
+    return bytes(self._cached("signature", self._read_signature))
+
+  def _read_signature(self) -> bytes:
     part_1 = self._handle.controlRead(Panda.REQUEST_IN, 0xd3, 0, 0, 0x40)
     part_2 = self._handle.controlRead(Panda.REQUEST_IN, 0xd4, 0, 0, 0x40)
     return bytes(part_1 + part_2)
 
   def get_type(self):
-    ret = self._handle.controlRead(Panda.REQUEST_IN, 0xc1, 0, 0, 0x40)
+    return self._cached("hw_type", self._read_type)
 
+  def _read_type(self):
+    return self._hw_type_from(self._handle.controlRead(Panda.REQUEST_IN, 0xc1, 0, 0, 0x40))
+
+  def _hw_type_from(self, ret):
     # old bootstubs don't implement this endpoint, see comment in Panda.device
     if self._bcd_hw_type is not None and (ret is None or len(ret) != 1):
       ret = self._bcd_hw_type
@@ -648,6 +1180,9 @@ class Panda:
 
   # Returns tuple with health packet version and CAN packet/USB packet version
   def get_packets_versions(self):
+    return self._cached("packets_versions", self._read_packets_versions)
+
+  def _read_packets_versions(self):
     dat = self._handle.controlRead(Panda.REQUEST_IN, 0xdd, 0, 0, 3)
     if dat and len(dat) == 3:
       a = struct.unpack("BBB", dat)
@@ -678,6 +1213,9 @@ class Panda:
     """
       Returns the comma-issued dongle ID from our provisioning
     """
+    return list(self._cached("serial", self._read_serial))
+
+  def _read_serial(self):
     dat = self._handle.controlRead(Panda.REQUEST_IN, 0xd0, 0, 0, 0x20)
     hashsig, calc_hash = dat[0x1c:], hashlib.sha1(dat[0:0x1c]).digest()[0:4]
     assert(hashsig == calc_hash)
@@ -697,6 +1235,9 @@ class Panda:
     """
       Returns the UID from the MCU
     """
+    return self._cached("uid", self._read_uid)
+
+  def _read_uid(self):
     dat = self._handle.controlRead(Panda.REQUEST_IN, 0xc3, 0, 0, 12)
     return binascii.hexlify(dat).decode()
 
@@ -726,15 +1267,19 @@ class Panda:
     # sets the can transceiver enable pin
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xf4, int(bus_num), int(enable), b'')
 
+  @ensure_configured
   def set_can_speed_kbps(self, bus, speed):
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xde, bus, int(speed * 10), b'')
 
+  @ensure_configured
   def set_can_data_speed_kbps(self, bus, speed):
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xf9, bus, int(speed * 10), b'')
 
+  @ensure_configured
   def set_canfd_non_iso(self, bus, non_iso):
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xfc, bus, int(non_iso), b'')
 
+  @ensure_configured
   def set_canfd_auto(self, bus, auto):
       self._handle.controlWrite(Panda.REQUEST_OUT, 0xe8, bus, int(auto), b'')
 
@@ -755,22 +1300,74 @@ class Panda:
   # Timeout is in ms. If set to 0, the timeout is infinite.
   CAN_SEND_TIMEOUT_MS = 10
 
+  @ensure_configured
   def can_reset_communications(self):
+    if self._can_rx_thread is not None:
+      raise RuntimeError("can't reset comms while the RX thread is reading, see stop_rx_thread()")
     self._handle.controlWrite(Panda.REQUEST_OUT, 0xc0, 0, 0, b'')
+    # the panda drops its partial packet, so drop ours too
+    self._can_rx_decoder.reset()
 
+  @traced("panda")
+  @ensure_configured
   @ensure_can_packet_version
-  def can_send_many(self, arr, *, fd=False, timeout=CAN_SEND_TIMEOUT_MS):
-    snds = pack_can_buffer(arr, fd=fd)
-    for tx in snds:
-      while len(tx) > 0:
-        bs = self._handle.bulkWrite(3, tx, timeout=timeout)
-        tx = tx[bs:]
+  def can_send_many(self, arr, *, fd=False, timeout=CAN_SEND_TIMEOUT_MS, pipeline_depth=0):
+    """
+      Send a batch of CAN messages. arr is a list of (address, dat, bus),
+      a numpy array of CAN_FRAME_DTYPE, or an already packed buffer.
+
+      With pipeline_depth > 0, up to that many bulk transfers are kept in
+      flight. Instead of raising once the panda has been NAKing for timeout
+      ms, the call then returns the number of messages that were accepted.
+      A message cut off at that point gets another timeout ms to go out,
+      after which usb1.USBErrorTimeout is raised.
+    """
+    # the packer's buffer is reused between calls
+    with self._can_tx_lock:
+      chunks = self._can_packer.pack(arr, fd=fd)
+      if pipeline_depth > 0:
+        return self._can_send_pipelined(chunks, timeout, pipeline_depth)
+
+      for tx in chunks:
+        while len(tx) > 0:
+          bs = self._handle.bulkWrite(3, tx, timeout=timeout)
+          tx = tx[bs:]
+      return self._can_packer.packet_count
+
+  def _can_send_pipelined(self, chunks, timeout, depth):
+    if isinstance(self._handle, PandaUsbHandle):
+      sent = self._handle.bulk_write_pipelined(3, chunks, timeout=timeout, depth=depth)
+    else:
+      # every chunk is a single SPI transfer, so a chunk is either sent or not
+      sent = 0
+      for tx in chunks:
+        try:
+          self._handle.bulkWrite(3, tx, timeout=timeout)
+        except PandaSpiException:
+          break
+        sent += len(tx)
+
+    count, rest = self._can_packer.packets_in(sent)
+    if len(rest) > 0:
+      # the panda holds on to the start of a cut off packet, so it has to be
+      # completed. it gets another timeout for that, then the stream is broken
+      deadline = None if timeout == 0 else time.monotonic() + timeout * 1e-3
+      while len(rest) > 0:
+        remaining = 0 if deadline is None else max(1, int((deadline - time.monotonic()) * 1e3))
+        try:
+          rest = rest[self._handle.bulkWrite(3, rest, timeout=remaining):]
+        except usb1.USBErrorTimeout as e:
+          rest = rest[e.transferred:]
+          if len(rest) > 0 and deadline is not None and time.monotonic() >= deadline:
+            logger.error("CAN: panda didn't take the rest of a cut off packet, %d of %d sent", count, self._can_packer.packet_count)
+            raise
+      count += 1
+    return count
 
   def can_send(self, addr, dat, bus, *, fd=False, timeout=CAN_SEND_TIMEOUT_MS):
     self.can_send_many([[addr, dat, bus]], fd=fd, timeout=timeout)
 
-  @ensure_can_packet_version
-  def can_recv(self):
+  def _can_bulk_read(self):
     dat = bytearray()
     while True:
       try:
@@ -778,10 +1375,80 @@ class Panda:
         break
       except (usb1.USBErrorIO, usb1.USBErrorOverflow):
         logger.error("CAN: BAD RECV, RETRYING")
+        if self._handle.stats is not None:
+          self._handle.stats.retry("bulk_read", 1)
         time.sleep(0.1)
-    msgs, self.can_rx_overflow_buffer = unpack_can_buffer(self.can_rx_overflow_buffer + dat)
-    return msgs
+    return dat
+
+  @traced("panda")
+  @ensure_configured
+  @ensure_can_packet_version
+  def can_recv(self):
+    if self._can_rx_thread is not None:
+      return self._can_rx_thread.recv()
+
+    dat = self._can_bulk_read()
+    return self._can_rx_decoder.feed(dat)
+
+  @ensure_configured
+  @ensure_can_packet_version
+  def can_recv_array(self):
+    """
+      Same as can_recv, but returns the batch as a numpy array
+      of CAN_FRAME_DTYPE. See unpack_can_buffer_array.
+    """
+    if self._can_rx_thread is not None:
+      raise RuntimeError("the RX thread is reading, use can_recv() or stop_rx_thread()")
+    return self._can_rx_decoder.feed_array(self._can_bulk_read())
+
+  @ensure_configured
+  @ensure_can_packet_version
+  def start_rx_thread(self, maxlen: int = 1024, usb_transfers: int = 0, transfer_size: int = 16384) -> CanRxThread:
+    """
+      Start draining CAN RX on a background thread. Until stop_rx_thread()
+      or close(), can_recv() returns the queued messages without touching
+      the panda, and iter_frames() can be used to block for new ones.
+      can_recv_array() and can_reset_communications() raise meanwhile.
+
+      With usb_transfers > 0, USB pandas keep that many bulk transfers
+      of transfer_size bytes in flight instead of reading synchronously.
+    """
+    if self._can_rx_thread is None:
+      read_fn = self._can_bulk_read
+      if usb_transfers > 0 and isinstance(self._handle, PandaUsbHandle):
+        self._can_rx_reader = self._handle.bulk_reader(1, usb_transfers, transfer_size)
+        read_fn = self._can_rx_reader.read
+
+      self._can_rx_thread = CanRxThread(lambda: self._can_rx_decoder.feed(read_fn()), maxlen=maxlen)
+      self._can_rx_thread.start()
+    return self._can_rx_thread
+
+  def stop_rx_thread(self) -> None:
+    if self._can_rx_thread is not None:
+      self._can_rx_thread.stop()
+      self._can_rx_thread = None
+    if self._can_rx_reader is not None:
+      self._can_rx_reader.close()
+      self._can_rx_reader = None
+
+  def iter_frames(self, timeout: float | None = None):
+    """
+      Yields (timestamp, address, dat, bus) from the RX thread, where timestamp
+      is the host's time.monotonic() when the batch was read. Stops once nothing
+      arrived within timeout seconds, or when the RX thread is stopped.
+    """
+    rx_thread = self._can_rx_thread
+    assert rx_thread is not None, "RX thread not running, see start_rx_thread()"
+    while rx_thread.running:
+      batches = rx_thread.get_batches(timeout)
+      if len(batches) == 0 and timeout is not None:
+        break
+      for t, msgs in batches:
+        for address, dat, bus in msgs:
+          yield t, address, dat, bus
 
+  @traced("panda")
+  @ensure_configured
   def can_clear(self, bus):
     """Clears all messages from the specified internal CAN ringbuffer as
     though it were drained.
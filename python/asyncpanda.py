@@ -0,0 +1,355 @@
+import time
+import asyncio
+import select
+from functools import partial
+
+import usb1
+
+from . import (Panda, CanPacker, USB_CAN_CHUNK_SIZE, ensure_can_packet_version,
+               ensure_health_packet_version, ensure_can_health_packet_version)
+from .base import TIMEOUT
+from .stats import INSTRUMENTED_METHODS
+from .tracing import active_tracer
+from .usb import PandaUsbHandle
+from .utils import logger
+
+TRANSFER_ERRORS = {
+  usb1.TRANSFER_TIMED_OUT: usb1.USBErrorTimeout,
+  usb1.TRANSFER_STALL: usb1.USBErrorPipe,
+  usb1.TRANSFER_NO_DEVICE: usb1.USBErrorNoDevice,
+  usb1.TRANSFER_OVERFLOW: usb1.USBErrorOverflow,
+  usb1.TRANSFER_CANCELLED: usb1.USBErrorInterrupted,
+}
+
+
+class UsbEventLoopWatcher:
+  """
+    Lets an asyncio loop drive a libusb context. The context's pollable
+    file descriptors are watched with add_reader/add_writer, and libusb's
+    events are handled on the loop thread as soon as one becomes ready.
+  """
+
+  def __init__(self, loop: asyncio.AbstractEventLoop, context):
+    self._loop = loop
+    self._context = context
+    self._fds: dict[int, int] = {}
+    self._timer: asyncio.TimerHandle | None = None
+
+    # raises NotImplementedError where libusb can't expose its fds (Windows)
+    for fd, events in context.getPollFDList():
+      self._add_fd(fd, events)
+    context.setPollFDNotifiers(self._on_fd_added, self._on_fd_removed)
+
+  # libusb can add or remove fds from any thread that calls into it
+  def _on_fd_added(self, fd, events, user_data=None) -> None:
+    self._loop.call_soon_threadsafe(self._add_fd, fd, events)
+
+  def _on_fd_removed(self, fd, user_data=None) -> None:
+    self._loop.call_soon_threadsafe(self._remove_fd, fd)
+
+  def _add_fd(self, fd: int, events: int) -> None:
+    self._remove_fd(fd)
+    self._fds[fd] = events
+    if events & select.POLLIN:
+      self._loop.add_reader(fd, self.handle_events)
+    if events & select.POLLOUT:
+      self._loop.add_writer(fd, self.handle_events)
+
+  def _remove_fd(self, fd: int) -> None:
+    events = self._fds.pop(fd, 0)
+    if events & select.POLLIN:
+      self._loop.remove_reader(fd)
+    if events & select.POLLOUT:
+      self._loop.remove_writer(fd)
+
+  def handle_events(self) -> None:
+    try:
+      self._context.handleEventsTimeout(tv=0)
+    except usb1.USBErrorInterrupted:
+      pass
+    except usb1.USBError:
+      logger.exception("USB: handling events failed")
+    self.schedule_timeout()
+
+  def schedule_timeout(self) -> None:
+    """
+      Without timerfd support, libusb's transfer timeouts aren't signaled
+      through an fd, so handle events again once the next one expires.
+    """
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    timeout = self._context.getNextTimeout()
+    if timeout is not None:
+      self._timer = self._loop.call_later(timeout, self.handle_events)
+
+  def close(self) -> None:
+    self._context.setPollFDNotifiers(None, None)
+    for fd in list(self._fds):
+      self._remove_fd(fd)
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+
+
+class AsyncPanda:
+  """
+    asyncio interface to a Panda.
+
+    Over USB, every call is an async libusb transfer whose completion is
+    picked up by the event loop, so there is no thread hop. Transfers on
+    different endpoints are independent, so a slow control read doesn't
+    hold up CAN traffic. SPI pandas, and USB without pollable fds, fall
+    back to running the blocking calls in the loop's default executor.
+    Either way, transfers show up in Panda.stats() and in traces like
+    the synchronous ones.
+
+    Don't mix with the synchronous CAN calls or the RX thread of the same Panda,
+    both sides would consume the same CAN stream.
+  """
+
+  CAN_PACKET_VERSION = Panda.CAN_PACKET_VERSION
+  HEALTH_PACKET_VERSION = Panda.HEALTH_PACKET_VERSION
+  CAN_HEALTH_PACKET_VERSION = Panda.CAN_HEALTH_PACKET_VERSION
+  CAN_SEND_TIMEOUT_MS = Panda.CAN_SEND_TIMEOUT_MS
+
+  def __init__(self, panda: Panda):
+    self.panda = panda
+    self._loop = asyncio.get_running_loop()
+    self._watcher: UsbEventLoopWatcher | None = None
+    self._usb_handle: PandaUsbHandle | None = None
+    self._in_flight: set = set()
+    self._can_packer = CanPacker(USB_CAN_CHUNK_SIZE)
+    self._can_tx_lock = asyncio.Lock()
+    self._can_rx_lock = asyncio.Lock()
+    self._attach()
+
+  @classmethod
+  async def create(cls, serial: str | None = None, **kwargs) -> "AsyncPanda":
+    loop = asyncio.get_running_loop()
+    panda = await loop.run_in_executor(None, partial(Panda, serial, cli=False, **kwargs))
+    return cls(panda)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *args):
+    await self.close()
+
+  @property
+  def can_version(self):
+    return self.panda.can_version
+
+  @property
+  def health_version(self):
+    return self.panda.health_version
+
+  @property
+  def can_health_version(self):
+    return self.panda.can_health_version
+
+  @property
+  def is_async_usb(self) -> bool:
+    return self._watcher is not None
+
+  def _attach(self) -> None:
+    handle = self.panda._handle
+    if self.panda.connected and isinstance(handle, PandaUsbHandle):
+      try:
+        self._watcher = UsbEventLoopWatcher(self._loop, handle.context)
+        self._usb_handle = handle
+      except NotImplementedError:
+        logger.warning("libusb has no pollable fds, falling back to executor")
+
+  def _detach(self) -> None:
+    if self._watcher is None:
+      return
+    # the handle can't be closed with transfers still submitted
+    for transfer in list(self._in_flight):
+      try:
+        transfer.cancel()
+      except usb1.USBError:
+        pass
+    assert self._usb_handle is not None
+    for _ in range(100):
+      if len(self._in_flight) == 0:
+        break
+      self._usb_handle.context.handleEventsTimeout(tv=0.01)
+    self._in_flight.clear()
+    self._watcher.close()
+    self._watcher = None
+    self._usb_handle = None
+
+  async def _run(self, fn, *args, **kwargs):
+    return await self._loop.run_in_executor(None, partial(fn, *args, **kwargs))
+
+  async def _ensure_configured(self) -> None:
+    # a lazy Panda's connect-time setup
+    if self.panda._config_pending:
+      await self._run(self.panda.configure)
+
+  # ******************* transfers *******************
+
+  async def _submit(self, name: str, code: int, setup):
+    """
+      Submits a transfer set up by setup(transfer, callback) and waits
+      for it. Returns (actual length, IN data). name is the handle method
+      it stands in for, for the stats and the trace.
+    """
+    assert self._watcher is not None and self._usb_handle is not None
+    fut = self._loop.create_future()
+    loop = self._loop
+
+    def on_transfer(transfer):
+      # this can run on any thread handling events for the context
+      status = transfer.getStatus()
+      length = transfer.getActualLength()
+      data = None
+      if transfer.getType() == usb1.TRANSFER_TYPE_CONTROL:
+        data = bytes(transfer.getBuffer()[usb1.CONTROL_SETUP_SIZE:usb1.CONTROL_SETUP_SIZE + length])
+      elif transfer.getEndpoint() & usb1.ENDPOINT_IN:
+        data = bytes(transfer.getBuffer()[:length])
+      self._in_flight.discard(transfer)
+      transfer.doom()
+      loop.call_soon_threadsafe(_set_result, fut, (status, length, data))
+
+    st = time.perf_counter_ns()
+    transfer = self._usb_handle.libusb_handle.getTransfer()
+    setup(transfer, on_transfer)
+    self._in_flight.add(transfer)
+    transfer.submit()
+    self._watcher.schedule_timeout()
+
+    try:
+      status, length, data = await fut
+    except asyncio.CancelledError:
+      if transfer.isSubmitted():
+        try:
+          transfer.cancel()
+        except usb1.USBError:
+          pass
+      raise
+
+    error: Exception | None = None
+    if status != usb1.TRANSFER_COMPLETED:
+      e = TRANSFER_ERRORS.get(status, usb1.USBErrorIO)()
+      e.transferred = length
+      error = e
+    self._record(name, code, st, 0 if error is not None else length if data is None else len(data), error)
+    if error is not None:
+      raise error
+    return length, data
+
+  def _record(self, name: str, code: int, st: int, nbytes: int, error: Exception | None) -> None:
+    end = time.perf_counter_ns()
+    stats = self._usb_handle.stats if self._usb_handle is not None else None
+    if stats is not None:
+      stats.record(INSTRUMENTED_METHODS[name][0], code, nbytes, (end - st) * 1e-9, error)
+    tracer = active_tracer()
+    if tracer is not None:
+      # the span runs from submit to completion, transfers on the loop thread can overlap
+      tracer.add(name, "usb", st, end, {"code": f"{code:#x}", "async": True})
+
+  async def control_read(self, request_type: int, request: int, value: int, index: int, length: int,
+                         timeout: int = TIMEOUT):
+    if self._watcher is None:
+      return await self._run(self.panda._handle.controlRead, request_type, request, value, index, length, timeout=timeout)
+    _, data = await self._submit("controlRead", request, lambda t, cb: t.setControl(request_type, request, value, index, length,
+                                                                                   callback=cb, timeout=timeout))
+    return data
+
+  async def control_write(self, request_type: int, request: int, value: int, index: int, data,
+                          timeout: int = TIMEOUT):
+    if self._watcher is None:
+      return await self._run(self.panda._handle.controlWrite, request_type, request, value, index, data, timeout=timeout)
+    length, _ = await self._submit("controlWrite", request, lambda t, cb: t.setControl(request_type, request, value, index, bytes(data),
+                                                                                     callback=cb, timeout=timeout))
+    return length
+
+  async def bulk_write(self, endpoint: int, data, timeout: int = TIMEOUT):
+    if self._watcher is None:
+      return await self._run(self.panda._handle.bulkWrite, endpoint, data, timeout=timeout)
+    length, _ = await self._submit("bulkWrite", endpoint, lambda t, cb: t.setBulk(endpoint | usb1.ENDPOINT_OUT, data, callback=cb, timeout=timeout))
+    return length
+
+  async def bulk_read(self, endpoint: int, length: int, timeout: int = TIMEOUT):
+    if self._watcher is None:
+      return await self._run(self.panda._handle.bulkRead, endpoint, length, timeout=timeout)
+    _, data = await self._submit("bulkRead", endpoint, lambda t, cb: t.setBulk(endpoint | usb1.ENDPOINT_IN, length, callback=cb, timeout=timeout))
+    return data
+
+  # ******************* health *******************
+
+  @ensure_health_packet_version
+  async def health(self):
+    dat = await self.control_read(Panda.REQUEST_IN, 0xd2, 0, 0, Panda.HEALTH_STRUCT.size)
+    return self.panda._parse_health(dat)
+
+  @ensure_can_health_packet_version
+  async def can_health(self, can_number):
+    dat = await self.control_read(Panda.REQUEST_IN, 0xc2, int(can_number), 0, Panda.CAN_HEALTH_STRUCT.size)
+    return self.panda._parse_can_health(dat)
+
+  async def telemetry(self):
+    dat = await self.control_read(Panda.REQUEST_IN, 0xc8, 0, 0, Panda.TELEMETRY_SIZE)
+    if len(dat) == 0:
+      return await self._run(self.panda.telemetry)
+    return self.panda._parse_telemetry(dat)
+
+  # ******************* can *******************
+
+  @ensure_can_packet_version
+  async def can_send_many(self, arr, *, fd=False, timeout=CAN_SEND_TIMEOUT_MS):
+    if self._watcher is None:
+      return await self._run(self.panda.can_send_many, arr, fd=fd, timeout=timeout)
+
+    await self._ensure_configured()
+    # the packer's buffer is reused between calls
+    async with self._can_tx_lock:
+      for tx in self._can_packer.pack(arr, fd=fd):
+        while len(tx) > 0:
+          bs = await self.bulk_write(3, tx, timeout=timeout)
+          tx = tx[bs:]
+      return self._can_packer.packet_count
+
+  async def can_send(self, addr, dat, bus, *, fd=False, timeout=CAN_SEND_TIMEOUT_MS):
+    await self.can_send_many([[addr, dat, bus]], fd=fd, timeout=timeout)
+
+  @ensure_can_packet_version
+  async def can_recv(self):
+    if self._watcher is None:
+      return await self._run(self.panda.can_recv)
+
+    await self._ensure_configured()
+    # reads have to be decoded in the order they completed
+    async with self._can_rx_lock:
+      while True:
+        try:
+          dat = await self.bulk_read(1, 16384)
+          break
+        except (usb1.USBErrorIO, usb1.USBErrorOverflow):
+          logger.error("CAN: BAD RECV, RETRYING")
+          if self._usb_handle.stats is not None:
+            self._usb_handle.stats.retry("bulk_read", 1)
+          await asyncio.sleep(0.1)
+      return self.panda._can_rx_decoder.feed(dat)
+
+  async def can_clear(self, bus):
+    await self._ensure_configured()
+    await self.control_write(Panda.REQUEST_OUT, 0xf1, bus, 0, b'')
+
+  # ******************* connection *******************
+
+  async def reconnect(self) -> None:
+    self._detach()
+    await self._run(self.panda.reconnect)
+    self._attach()
+
+  async def close(self) -> None:
+    self._detach()
+    self.panda.close()
+
+
+def _set_result(fut: asyncio.Future, result) -> None:
+  if not fut.done():
+    fut.set_result(result)
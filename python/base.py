@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
 
 from .constants import McuType
+from .stats import TransportStats
 
 TIMEOUT = int(15 * 1e3)  # default timeout, in milliseconds
 
@@ -10,6 +11,9 @@ class BaseHandle(ABC):
     Borrows heavily from the libusb1 handle API.
   """
 
+  # set by stats.instrument()
+  stats: TransportStats | None = None
+
   @abstractmethod
   def close(self) -> None:
     ...
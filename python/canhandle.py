@@ -2,6 +2,7 @@ import struct
 import signal
 
 from .base import BaseHandle
+from .tracing import traced
 
 
 class CanHandle(BaseHandle):
@@ -34,20 +35,24 @@ class CanHandle(BaseHandle):
   def close(self):
     pass
 
+  @traced("can", code_arg=1)
   def controlWrite(self, request_type, request, value, index, data, timeout=0, expect_disconnect=False):
     # ignore data in reply, panda doesn't use it
     return self.controlRead(request_type, request, value, index, 0, timeout)
 
+  @traced("can", code_arg=1)
   def controlRead(self, request_type, request, value, index, length, timeout=0):
     dat = struct.pack("HHBBHHH", 0, 0, request_type, request, value, index, length)
     return self.transact(dat)
 
+  @traced("can", code_arg=0)
   def bulkWrite(self, endpoint, data, timeout=0):
     if len(data) > 0x10:
       raise ValueError("Data must not be longer than 0x10")
     dat = struct.pack("HH", endpoint, len(data)) + data
     return self.transact(dat)
 
+  @traced("can", code_arg=0)
   def bulkRead(self, endpoint, length, timeout=0):
     dat = struct.pack("HH", endpoint, 0)
     return self.transact(dat)
@@ -4,16 +4,21 @@ import struct
 import binascii
 
 from .base import BaseSTBootloaderHandle
+from .discovery import PandaDevice, probe_concurrently, spi_negative_cache
 from .spi import STBootloaderSPIHandle, PandaSpiException
 from .usb import STBootloaderUSBHandle
 from .constants import FW_PATH, McuType
 
 
 class PandaDFU:
-  def __init__(self, dfu_serial: str | None):
+  # DFU serial by USB (bus, address), so listing doesn't reopen devices it has seen
+  _usb_serial_cache: dict[tuple[int, int], str] = {}
+
+  def __init__(self, dfu_serial: str | None, usb_context=None):
     # try USB, then SPI
     handle: BaseSTBootloaderHandle | None
-    self._context, handle = PandaDFU.usb_connect(dfu_serial)
+    self._usb_context = usb_context
+    self._context, handle = PandaDFU.usb_connect(dfu_serial, context=usb_context)
     if handle is None:
       self._context, handle = PandaDFU.spi_connect(dfu_serial)
 
@@ -33,18 +38,24 @@ class PandaDFU:
     if self._handle is not None:
       self._handle.close()
       self._handle = None
-      if self._context is not None:
+      # a shared context belongs to the caller
+      if self._context is not None and self._context is not self._usb_context:
         self._context.close()
 
   @staticmethod
-  def usb_connect(dfu_serial: str | None):
+  def usb_connect(dfu_serial: str | None, context=None):
     handle = None
-    context = usb1.USBContext()
-    context.open()
+    if context is None:
+      context = usb1.USBContext()
+      context.open()
     for device in context.getDeviceList(skip_on_error=True):
       if device.getVendorID() == 0x0483 and device.getProductID() == 0xdf11:
         try:
-          this_dfu_serial = device.open().getASCIIStringDescriptor(3)
+          h = device.open()
+          try:
+            this_dfu_serial = h.getASCIIStringDescriptor(3)
+          finally:
+            h.close()
         except Exception:
           continue
 
@@ -71,29 +82,60 @@ class PandaDFU:
     return None, handle
 
   @staticmethod
-  def usb_list() -> list[str]:
-    dfu_serials = []
+  def usb_list(context=None) -> list[str]:
+    return [d.serial for d in PandaDFU.usb_list_devices(context)]
+
+  @staticmethod
+  def usb_list_devices(context=None) -> list[PandaDevice]:
+    ret = []
+    seen = {}
+    own_context = context is None
     try:
-      with usb1.USBContext() as context:
-        for device in context.getDeviceList(skip_on_error=True):
-          if device.getVendorID() == 0x0483 and device.getProductID() == 0xdf11:
+      if own_context:
+        context = usb1.USBContext()
+        context.open()
+      for device in context.getDeviceList(skip_on_error=True):
+        if device.getVendorID() == 0x0483 and device.getProductID() == 0xdf11:
+          key = (device.getBusNumber(), device.getDeviceAddress())
+          dfu_serial = PandaDFU._usb_serial_cache.get(key)
+          if dfu_serial is None:
             try:
-              dfu_serials.append(device.open().getASCIIStringDescriptor(3))
+              h = device.open()
+              try:
+                dfu_serial = h.getASCIIStringDescriptor(3)
+              finally:
+                h.close()
             except Exception:
-              pass
+              continue
+          seen[key] = dfu_serial
+          ret.append(PandaDevice(dfu_serial, "usb", False, True, None))
+      # forget devices that are gone, their address can be reused
+      PandaDFU._usb_serial_cache = seen
     except Exception:
       pass
-    return dfu_serials
+    finally:
+      if own_context and context is not None:
+        context.close()
+    return ret
 
   @staticmethod
   def spi_list() -> list[str]:
+    return [d.serial for d in PandaDFU.spi_list_devices()]
+
+  @staticmethod
+  def spi_list_devices() -> list[PandaDevice]:
+    cache = spi_negative_cache(PandaDFU)
+    if cache.absent():
+      return []
     try:
       _, h = PandaDFU.spi_connect(None)
       if h is not None:
         dfu_serial = PandaDFU.st_serial_to_dfu_serial(h.get_uid(), h.get_mcu_type())
-        return [dfu_serial, ]
+        cache.update(True)
+        return [PandaDevice(dfu_serial, "spi", False, True, None), ]
     except PandaSpiException:
       pass
+    cache.update(False)
     return []
 
   @staticmethod
@@ -133,6 +175,17 @@ class PandaDFU:
 
   @staticmethod
   def list() -> list[str]:
-    ret = PandaDFU.usb_list()
-    ret += PandaDFU.spi_list()
-    return list(set(ret))
+    return list(dict.fromkeys(d.serial for d in PandaDFU.list_devices()))
+
+  @staticmethod
+  def list_devices(usb_timeout: float | None = None, spi_timeout: float | None = None):
+    """
+      Returns a PandaDevice record for every device found. USB and SPI are
+      probed at the same time, each with its own deadline in seconds, None
+      for no deadline.
+    """
+    ret = probe_concurrently({
+      "usb": (PandaDFU.usb_list_devices, usb_timeout),
+      "spi": (PandaDFU.spi_list_devices, spi_timeout),
+    })
+    return ret["usb"] + ret["spi"]
@@ -0,0 +1,291 @@
+import time
+import threading
+from collections import deque
+from collections.abc import Callable
+from typing import NamedTuple
+
+import usb1
+
+from .utils import logger
+
+PANDA_USB_VIDS = (0xbbaa, 0x3801)
+DFU_USB_ID = (0x0483, 0xdf11)
+
+# discovery events
+ARRIVED = "arrived"
+LEFT = "left"
+ENTERED_DFU = "dfu"
+
+# a device that just arrived can fail to report its serial for a bit
+READ_RETRIES = 20
+
+# how long listing skips the SPI probe after it found nothing
+SPI_NEGATIVE_TTL = 1.0
+
+
+def bcd_hw_type(bcd: int | None) -> bytes | None:
+  # bcdDevice wasn't always set to the hw type, ignore if it's the old constant
+  if bcd is None or bcd == 0x2300:
+    return None
+  return bytes([bcd >> 8, ])
+
+
+class PandaDevice(NamedTuple):
+  serial: str  # DFU serial for devices in DFU mode
+  transport: str  # "usb" or "spi"
+  bootstub: bool
+  dfu: bool
+  hw_type: bytes | None  # from bcdDevice, if set
+
+
+class UsbDeviceInfo(NamedTuple):
+  serial: str  # DFU serial for devices in DFU mode
+  dfu: bool
+  bootstub: bool
+  product_id: int
+  hw_type: bytes | None  # from bcdDevice, if set
+  bus: int
+  address: int
+
+
+class UsbDiscovery:
+  """
+    Keeps a table of the pandas and ST DFU devices on USB, updated from
+    libusb hotplug callbacks on a background thread, and notifies listeners
+    with (event, UsbDeviceInfo) when a device arrives, leaves or shows up in DFU.
+
+    Sync libusb calls aren't allowed in hotplug callbacks, so serials are read
+    after the callback returns. Without hotplug support, the device list is
+    polled instead, but only devices that weren't there before are opened.
+  """
+
+  _shared: "UsbDiscovery | None" = None
+  _shared_lock = threading.Lock()
+
+  def __init__(self, context=None, poll_interval: float = 0.1, hotplug: bool | None = None):
+    self._own_context = context is None
+    if context is None:
+      context = usb1.USBContext()
+      context.open()
+    self._context = context
+    self._poll_interval = poll_interval
+    self._hotplug = usb1.hasCapability(usb1.CAP_HAS_HOTPLUG) if hotplug is None else hotplug
+    self._hotplug_handle: int | None = None
+
+    self._cv = threading.Condition()
+    self._devices: dict[tuple[int, int], UsbDeviceInfo] = {}
+    self._generation = 0
+    self._pending: deque = deque()
+    self._listeners: list[Callable[[str, UsbDeviceInfo], None]] = []
+
+    self._stop = threading.Event()
+    self._thread: threading.Thread | None = None
+
+  @classmethod
+  def shared(cls) -> "UsbDiscovery":
+    """
+      Returns the process-wide discovery service, starting it on first use.
+    """
+    with cls._shared_lock:
+      if cls._shared is None:
+        cls._shared = cls()
+        cls._shared.start()
+      return cls._shared
+
+  def start(self) -> None:
+    if self._hotplug:
+      # also reports the devices that are already there
+      self._hotplug_handle = self._context.hotplugRegisterCallback(self._on_hotplug)
+    self._thread = threading.Thread(target=self._run, name="panda-usb-discovery", daemon=True)
+    self._thread.start()
+
+  def stop(self) -> None:
+    self._stop.set()
+    if self._thread is not None and self._thread.is_alive():
+      self._thread.join()
+    if self._hotplug_handle is not None:
+      self._context.hotplugDeregisterCallback(self._hotplug_handle)
+      self._hotplug_handle = None
+    if self._own_context:
+      self._context.close()
+
+  def add_listener(self, callback: Callable[[str, UsbDeviceInfo], None]) -> None:
+    """
+      callback(event, info) is called on the discovery thread, so it shouldn't block.
+    """
+    self._listeners.append(callback)
+
+  def remove_listener(self, callback: Callable[[str, UsbDeviceInfo], None]) -> None:
+    self._listeners.remove(callback)
+
+  @staticmethod
+  def _is_tracked(device) -> bool:
+    vid, pid = device.getVendorID(), device.getProductID()
+    return vid in PANDA_USB_VIDS or (vid, pid) == DFU_USB_ID
+
+  def _on_hotplug(self, context, device, event) -> bool:
+    if self._is_tracked(device):
+      key = (device.getBusNumber(), device.getDeviceAddress())
+      self._pending.append((event == usb1.HOTPLUG_EVENT_DEVICE_ARRIVED, key, device, 0))
+    return False
+
+  def _run(self) -> None:
+    while not self._stop.is_set():
+      if self._hotplug:
+        try:
+          self._context.handleEventsTimeout(tv=self._poll_interval)
+        except usb1.USBErrorInterrupted:
+          pass
+      else:
+        self._poll()
+      self._process_pending()
+      if not self._hotplug or len(self._pending) > 0:
+        self._stop.wait(self._poll_interval)
+
+  def _poll(self) -> None:
+    present = set()
+    queued = {key for _, key, _, _ in self._pending}
+    for device in self._context.getDeviceList(skip_on_error=True):
+      if self._is_tracked(device):
+        key = (device.getBusNumber(), device.getDeviceAddress())
+        present.add(key)
+        if key not in self._devices and key not in queued:
+          self._pending.append((True, key, device, 0))
+    for key in list(self._devices):
+      if key not in present:
+        self._pending.append((False, key, None, 0))
+
+  @staticmethod
+  def _read_info(key: tuple[int, int], device) -> UsbDeviceInfo:
+    pid = device.getProductID()
+    if (device.getVendorID(), pid) == DFU_USB_ID:
+      handle = device.open()
+      try:
+        dfu_serial = handle.getASCIIStringDescriptor(3)
+      finally:
+        handle.close()
+      return UsbDeviceInfo(dfu_serial, True, False, pid, None, *key)
+
+    return UsbDeviceInfo(device.getSerialNumber(), False, (pid & 0xF0) == 0xe0, pid, bcd_hw_type(device.getbcdDevice()), *key)
+
+  def _process_pending(self) -> None:
+    retry = []
+    while len(self._pending) > 0:
+      arrived, key, device, attempts = self._pending.popleft()
+      if arrived:
+        try:
+          info = self._read_info(key, device)
+        except Exception:
+          if attempts < READ_RETRIES:
+            retry.append((arrived, key, device, attempts + 1))
+          else:
+            logger.exception("discovery: failed to read device %s", key)
+          continue
+        with self._cv:
+          self._devices[key] = info
+          self._generation += 1
+          self._cv.notify_all()
+        self._emit(ENTERED_DFU if info.dfu else ARRIVED, info)
+      else:
+        # a device that left before it could be read was never announced
+        retry = [r for r in retry if r[1] != key]
+        with self._cv:
+          left = self._devices.pop(key) if key in self._devices else None
+          self._generation += 1
+          self._cv.notify_all()
+        if left is not None:
+          self._emit(LEFT, left)
+    self._pending.extend(retry)
+
+  def _emit(self, event: str, info: UsbDeviceInfo) -> None:
+    for callback in list(self._listeners):
+      try:
+        callback(event, info)
+      except Exception:
+        logger.exception("discovery: listener failed")
+
+  def devices(self) -> list[UsbDeviceInfo]:
+    with self._cv:
+      return list(self._devices.values())
+
+  def _find(self, serial: str | None, dfu: bool, product_ids) -> UsbDeviceInfo | None:
+    for info in self._devices.values():
+      if info.dfu != dfu or (serial is not None and info.serial != serial):
+        continue
+      if product_ids is not None and not dfu and info.product_id not in product_ids:
+        continue
+      return info
+    return None
+
+  def find(self, serial: str | None = None, dfu: bool = False, product_ids=None) -> UsbDeviceInfo | None:
+    with self._cv:
+      return self._find(serial, dfu, product_ids)
+
+  def wait_for(self, serial: str | None = None, dfu: bool = False, product_ids=None,
+               timeout: float | None = None) -> UsbDeviceInfo | None:
+    """
+      Waits up to timeout seconds for a matching device, any device if serial is None.
+    """
+    with self._cv:
+      self._cv.wait_for(lambda: self._find(serial, dfu, product_ids) is not None, timeout)
+      return self._find(serial, dfu, product_ids)
+
+  def wait_for_change(self, timeout: float | None = None) -> bool:
+    """
+      Waits up to timeout seconds for any device to arrive or leave.
+    """
+    with self._cv:
+      generation = self._generation
+      return self._cv.wait_for(lambda: self._generation != generation, timeout)
+
+
+def probe_concurrently(probes: dict[str, tuple[Callable[[], list], float | None]]) -> dict[str, list]:
+  """
+    Runs each probe function on its own thread and gives it until its deadline,
+    in seconds from now, or as long as it takes if it's None. A probe that
+    fails or doesn't finish in time returns [].
+  """
+  results: dict[str, list] = {}
+
+  def run(name, fn):
+    try:
+      results[name] = fn()
+    except Exception:
+      logger.exception("discovery: %s probe failed", name)
+
+  start = time.monotonic()
+  # daemon threads, so a stuck probe can't hold up the interpreter exiting
+  threads = {name: threading.Thread(target=run, args=(name, fn), daemon=True) for name, (fn, _) in probes.items()}
+  for t in threads.values():
+    t.start()
+  for name, (_, deadline) in probes.items():
+    threads[name].join(None if deadline is None else max(start + deadline - time.monotonic(), 0))
+    if threads[name].is_alive():
+      logger.warning("discovery: %s probe didn't finish within %.1fs, its devices aren't listed", name, deadline)
+  return {name: results.get(name, []) for name in probes}
+
+
+class SpiNegativeCache:
+  """
+    Remembers for a short while that an SPI probe found nothing, since the
+    full handshake with retries is slow on hosts without a panda on SPI.
+  """
+  def __init__(self, ttl: float = SPI_NEGATIVE_TTL):
+    self.ttl = ttl
+    self._absent_until = 0.0
+
+  def absent(self) -> bool:
+    return time.monotonic() < self._absent_until
+
+  def update(self, found: bool) -> None:
+    self._absent_until = 0.0 if found else time.monotonic() + self.ttl
+
+  def clear(self) -> None:
+    self._absent_until = 0.0
+
+
+_spi_negative_caches: dict[type, SpiNegativeCache] = {}
+
+def spi_negative_cache(cls: type) -> SpiNegativeCache:
+  # per class, PandaJungle never finds anything on SPI
+  return _spi_negative_caches.setdefault(cls, SpiNegativeCache())
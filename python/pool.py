@@ -0,0 +1,140 @@
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, NamedTuple
+
+import usb1
+
+from . import Panda
+from .utils import logger
+
+
+class PoolResult(NamedTuple):
+  value: Any
+  error: Exception | None
+
+  @property
+  def ok(self) -> bool:
+    return self.error is None
+
+
+def run_parallel(items: dict, fn: Callable, max_workers: int = 16) -> dict[Any, PoolResult]:
+  """
+    Calls fn(item) for every item at the same time, and returns a
+    PoolResult per key. An exception only fails its own item.
+  """
+  def call(item):
+    try:
+      return PoolResult(fn(item), None)
+    except Exception as e:
+      return PoolResult(None, e)
+
+  if len(items) == 0:
+    return {}
+  with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+    futures = {key: executor.submit(call, item) for key, item in items.items()}
+    return {key: f.result() for key, f in futures.items()}
+
+
+class PandaPool:
+  """
+    Opens a set of pandas on one shared USB context, and runs operations
+    across all of them in parallel. Results are returned per serial, so a
+    failing device doesn't stop the others.
+
+    with PandaPool() as pool:
+      for serial, r in pool.health().items():
+        print(serial, r.value if r.ok else r.error)
+
+    The pool opens its own USB context unless it's given usb_context, which
+    it leaves open. A pool of pandas that aren't on USB, like the sim panda,
+    can be given one that's never used, and doesn't need libusb.
+  """
+
+  def __init__(self, serials: Iterable[str] | None = None, max_workers: int = 16, panda_cls=Panda, usb_context=None, **panda_kwargs):
+    self._max_workers = max_workers
+    self._panda_cls = panda_cls
+    self._own_context = usb_context is None
+    if usb_context is None:
+      usb_context = usb1.USBContext()
+      usb_context.open()
+    self._context = usb_context
+
+    if serials is None:
+      serials = panda_cls.usb_list(context=self._context) + panda_cls.spi_list()
+
+    self.pandas: dict[str, Panda] = {}
+    self.errors: dict[str, Exception] = {}
+    self.open(serials, **panda_kwargs)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self) -> int:
+    return len(self.pandas)
+
+  def __iter__(self):
+    return iter(self.pandas.values())
+
+  def __getitem__(self, serial: str) -> Panda:
+    return self.pandas[serial]
+
+  def open(self, serials: Iterable[str], **panda_kwargs) -> dict[str, PoolResult]:
+    """
+      Connects to the pandas concurrently. Failures are kept in self.errors.
+    """
+    kwargs = {"cli": False, **panda_kwargs, "usb_context": self._context}
+    ret = run_parallel({s: s for s in dict.fromkeys(serials) if s not in self.pandas},
+                       lambda s: self._panda_cls(s, **kwargs), self._max_workers)
+    for serial, r in ret.items():
+      if r.ok:
+        self.pandas[serial] = r.value
+        self.errors.pop(serial, None)
+      elif r.error is not None:
+        logger.error("pool: failed to open %s: %s", serial, r.error)
+        self.errors[serial] = r.error
+    return ret
+
+  def run(self, op: Callable | str, *args, serials: Iterable[str] | None = None, **kwargs) -> dict[str, PoolResult]:
+    """
+      Runs op(panda, *args, **kwargs) on every panda, or only the given serials.
+      op can also be the name of a Panda method.
+    """
+    pandas = self.pandas if serials is None else {s: self.pandas[s] for s in serials}
+    if isinstance(op, str):
+      name = op
+      return run_parallel(pandas, lambda p: getattr(p, name)(*args, **kwargs), self._max_workers)
+    return run_parallel(pandas, lambda p: op(p, *args, **kwargs), self._max_workers)
+
+  def health(self) -> dict[str, PoolResult]:
+    return self.run("health")
+
+  def set_safety_mode(self, mode=0, param=0) -> dict[str, PoolResult]:
+    return self.run("set_safety_mode", mode, param)
+
+  def flash(self, fn=None, code=None) -> dict[str, PoolResult]:
+    return self.run("flash", fn=fn, code=code)
+
+  def recv_all(self) -> tuple[list[tuple[str, int, bytes, int]], dict[str, Exception]]:
+    """
+      Reads CAN from every panda, and merges it into (serial, address, data, bus)
+      messages, in order per panda. Pandas that failed are returned with their error.
+    """
+    msgs: list[tuple[str, int, bytes, int]] = []
+    errors: dict[str, Exception] = {}
+    for serial, r in self.run("can_recv").items():
+      if r.ok:
+        msgs.extend((serial, address, dat, bus) for address, dat, bus in r.value)
+      elif r.error is not None:
+        logger.error("pool: failed to read CAN from %s: %s", serial, r.error)
+        errors[serial] = r.error
+    return msgs, errors
+
+  def close(self) -> None:
+    run_parallel(self.pandas, lambda p: p.close(), self._max_workers)
+    self.pandas = {}
+    if self._context is not None and self._own_context:
+      self._context.close()
+    self._context = None
@@ -0,0 +1,109 @@
+import time
+import threading
+from collections import deque
+from collections.abc import Callable
+
+from .utils import logger
+
+
+class CanRxThread:
+  """
+    Continuously drains the panda's CAN RX endpoint on a background thread,
+    so the panda's can_rx_q doesn't overflow while the consumer is busy.
+
+    Each read is stored as a (time.monotonic(), msgs) batch in a bounded ring.
+    The ring is a deque, whose append/popleft are atomic, so the reader thread
+    and the consumer never take a lock. When the ring is full, the oldest
+    batch is dropped and counted.
+  """
+
+  def __init__(self, read_fn: Callable[[], list], maxlen: int = 1024, idle_sleep: float = 0.001):
+    self._read_fn = read_fn
+    self._maxlen = maxlen
+    self._idle_sleep = idle_sleep
+
+    self._ring: deque = deque()
+    self._new_data = threading.Event()
+    self._stop = threading.Event()
+
+    self.batches = 0
+    self.frames = 0
+    self.dropped_batches = 0
+    self.dropped_frames = 0
+    self.read_errors = 0
+
+    self._thread = threading.Thread(target=self._run, name="panda-can-rx", daemon=True)
+
+  def start(self) -> None:
+    self._thread.start()
+
+  def stop(self, timeout: float | None = 1.0) -> None:
+    self._stop.set()
+    self._new_data.set()
+    if self._thread.is_alive() and threading.current_thread() is not self._thread:
+      self._thread.join(timeout)
+
+  @property
+  def running(self) -> bool:
+    return self._thread.is_alive() and not self._stop.is_set()
+
+  def _run(self) -> None:
+    while not self._stop.is_set():
+      try:
+        msgs = self._read_fn()
+      except Exception:
+        if self._stop.is_set():
+          break
+        self.read_errors += 1
+        logger.exception("CAN RX thread: read failed")
+        time.sleep(0.1)
+        continue
+
+      # nothing pending on the panda, don't spin on empty reads
+      if len(msgs) == 0:
+        time.sleep(self._idle_sleep)
+        continue
+
+      t = time.monotonic()
+      while len(self._ring) >= self._maxlen:
+        try:
+          _, dropped = self._ring.popleft()
+        except IndexError:
+          break
+        self.dropped_batches += 1
+        self.dropped_frames += len(dropped)
+
+      self._ring.append((t, msgs))
+      self.batches += 1
+      self.frames += len(msgs)
+      self._new_data.set()
+
+  def get_batches(self, timeout: float | None = 0) -> list[tuple[float, list]]:
+    """
+      Returns all queued (timestamp, msgs) batches. Waits up to timeout
+      seconds for the first one, None waits forever.
+    """
+    self._new_data.clear()
+    if len(self._ring) == 0 and timeout != 0 and not self._stop.is_set():
+      self._new_data.wait(timeout)
+
+    ret = []
+    while True:
+      try:
+        ret.append(self._ring.popleft())
+      except IndexError:
+        break
+    return ret
+
+  def recv(self, timeout: float | None = 0) -> list:
+    return [m for _, msgs in self.get_batches(timeout) for m in msgs]
+
+  def stats(self) -> dict:
+    return {
+      "batches": self.batches,
+      "frames": self.frames,
+      "dropped_batches": self.dropped_batches,
+      "dropped_frames": self.dropped_frames,
+      "read_errors": self.read_errors,
+      "queued_batches": len(self._ring),
+    }
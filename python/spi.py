@@ -9,10 +9,13 @@ import threading
 from contextlib import contextmanager
 from functools import reduce
 from collections.abc import Callable
+from typing import TypeVar
 
 from .base import BaseHandle, BaseSTBootloaderHandle, TIMEOUT
 from .constants import McuType, MCU_TYPE_BY_IDCODE, USBPACKET_MAX_SIZE
-from .utils import logger
+from .stats import TransportStats
+from .tracing import traced
+from .utils import logger, xor_checksum
 
 try:
   import spidev
@@ -27,27 +30,63 @@ NACK = 0x1F
 CHECKSUM_START = 0xAB
 
 MIN_ACK_TIMEOUT_MS = 100
+SPI_MAX_HOLD_MS = 20
 MAX_XFER_RETRY_COUNT = 5
 
 XFER_SIZE = 0x40*31
 
 DEV_PATH = "/dev/spidev0.0"
+DRIVER_PATH = "/sys/bus/spi/devices/spi0.0/driver"
 
+# transports, see PandaSpiHandle
+SPI_MODE_SPIDEV = "spidev"
+SPI_MODE_KERNEL = "kernel"
+
+# largest bulk transfer the kernel buffers are sized for up front
+KERNEL_BULK_SIZE = 16384
+
+HEADER_STRUCT = struct.Struct("<BBHH")
+
+# clock speeds to fall back to when transfers are unreliable, fastest first.
+# 50MHz is the max of the 845
+SPI_SPEEDS = (50000000, 40000000, 30000000, 20000000, 10000000)
+
+# stats ops of the ACK waits
+ACK_WAIT_OPS = {HACK: "spi_header_ack", DACK: "spi_data_ack"}
+
+R = TypeVar("R")
+
+
+def _crc8_table(poly: int) -> bytes:
+  table = []
+  for i in range(256):
+    crc = i
+    for _ in range(8):
+      crc = ((crc << 1) ^ poly) & 0xFF if (crc & 0x80) != 0 else (crc << 1) & 0xFF
+    table.append(crc)
+  return bytes(table)
+
+# standard crc8: x8+x7+x6+x4+x2+1
+CRC8_TABLE = _crc8_table(0xD5)
 
 def crc8(data):
   crc = 0xFF    # standard init value
-  poly = 0xD5   # standard crc8: x8+x7+x6+x4+x2+1
-  size = len(data)
-  for i in range(size - 1, -1, -1):
-    crc ^= data[i]
-    for _ in range(8):
-      if ((crc & 0x80) != 0):
-        crc = ((crc << 1) ^ poly) & 0xFF
-      else:
-        crc <<= 1
+  for b in reversed(data):
+    crc = CRC8_TABLE[crc ^ b]
   return crc
 
 
+def read_into(spi, view: memoryview) -> None:
+  """
+    Reads len(view) bytes from the device straight into view. spidev's
+    readbytes() returns a new list, reading its fd doesn't.
+  """
+  readinto = getattr(spi, "readinto", None)
+  n = readinto(view) if readinto is not None else os.readv(spi.fileno(), [view])
+  if n != len(view):
+    raise PandaSpiException(f"short read ({n} of {len(view)} bytes)")
+
+
 class PandaSpiException(Exception):
   pass
 
@@ -82,8 +121,139 @@ class PandaSpiTransfer(ctypes.Structure):
   ]
 
 
+class PandaSpiBatch(ctypes.Structure):
+  _fields_ = [
+    ('transfers', ctypes.c_uint64),
+    ('results', ctypes.c_uint64),
+    ('count', ctypes.c_uint32),
+    ('flags', ctypes.c_uint32),
+  ]
+
+
+# ioctls of the spidev_panda kernel driver, see drivers/spi/spi_panda.h
+SPI_IOC_MAGIC = ord('k')
+
+def _ioc(direction: int, nr: int, size: int) -> int:
+  return (direction << 30) | (size << 16) | (SPI_IOC_MAGIC << 8) | nr
+
+SPI_IOC_PANDA_BATCH = _ioc(3, 0x50, ctypes.sizeof(PandaSpiBatch))
+SPI_PANDA_BATCH_STOP_ON_SHORT_READ = 1 << 0
+SPI_PANDA_BATCH_MAX = 64
+
+
+def kernel_driver_loaded() -> bool:
+  return os.path.basename(os.path.realpath(DRIVER_PATH)) == "spidev_panda"
+
+
+class AckPoller:
+  """
+    Paces the ACK polls of a handle. Polls spin around the time the ACK
+    usually arrives, learned per (ack, endpoint), sleep until then when
+    it's far off, and back off with growing sleeps, up to max_sleep_us,
+    once it's late. max_sleep_us=0 always spins.
+  """
+
+  def __init__(self, spin_us: float = 100, min_sleep_us: float = 20, max_sleep_us: float = 1000, backoff: float = 0.25, alpha: float = 0.2):
+    self.spin = spin_us * 1e-6
+    self.min_sleep = min_sleep_us * 1e-6
+    self.max_sleep = max_sleep_us * 1e-6
+    self.backoff = backoff
+    self.alpha = alpha
+    self._expected: dict[tuple[int, int], float] = {}
+
+  def expected(self, key: tuple[int, int]) -> float:
+    return self._expected.get(key, 0.)
+
+  def update(self, key: tuple[int, int], elapsed: float) -> None:
+    e = self._expected.get(key)
+    self._expected[key] = elapsed if e is None else e + self.alpha * (elapsed - e)
+
+  def delay(self, key: tuple[int, int], elapsed: float) -> float:
+    """
+      Seconds to sleep before the next poll, elapsed seconds into the wait.
+    """
+    if self.max_sleep <= 0:
+      return 0.
+    expected = self._expected.get(key, 0.)
+    if elapsed < expected - self.spin:
+      return min(expected - self.spin - elapsed, self.max_sleep)
+    if elapsed < expected + self.spin:
+      return 0.
+    return min(max((elapsed - expected) * self.backoff, self.min_sleep), self.max_sleep)
+
+
+class SpeedController:
+  """
+    Picks the clock speed of a handle from speeds. When more than
+    max_error_rate of a window of transfers fail with a bad checksum,
+    NACK or missing ACK, it drops to the next speed down. After
+    probe_interval seconds, it tries the next speed up again, and waits
+    twice as long before the next try if that one fails too.
+  """
+
+  def __init__(self, speeds: tuple[int, ...] = SPI_SPEEDS, window: int = 100, max_error_rate: float = 0.05, probe_interval: float = 30.):
+    self.speeds = sorted(speeds, reverse=True)
+    self.window = window
+    self.max_error_rate = max_error_rate
+    self.probe_interval = probe_interval
+    self.index = 0
+    self.error_rate = 0.  # of the last full window
+
+    self._transfers = 0
+    self._errors = 0
+    self._interval = probe_interval
+    self._next_probe = 0.
+    self._probing = False
+
+  @property
+  def speed(self) -> int:
+    return self.speeds[self.index]
+
+  def _set(self, index: int) -> None:
+    self.index = index
+    self._transfers = 0
+    self._errors = 0
+    self._next_probe = time.monotonic() + self._interval
+
+  def record(self, ok: bool) -> None:
+    self._transfers += 1
+    if not ok:
+      self._errors += 1
+
+    # past the max for the window already, no need to wait for the rest of it
+    if self._errors > self.window * self.max_error_rate:
+      self.error_rate = self._errors / self._transfers
+      if self._probing:
+        self._probing = False
+        self._interval *= 2
+      if self.index + 1 < len(self.speeds):
+        logger.warning("SPI: %d errors in %d transfers at %.0fMHz, dropping to %.0fMHz",
+                       self._errors, self._transfers, self.speed / 1e6, self.speeds[self.index + 1] / 1e6)
+      self._set(min(self.index + 1, len(self.speeds) - 1))
+      return
+
+    if self._transfers >= self.window:
+      self.error_rate = self._errors / self._transfers
+      if self._probing:
+        logger.info("SPI: running at %.0fMHz, error rate %.1f%%", self.speed / 1e6, self.error_rate * 100)
+        self._probing = False
+        self._interval = self.probe_interval
+      if self.index > 0 and time.monotonic() >= self._next_probe:
+        logger.info("SPI: error rate %.1f%% at %.0fMHz, trying %.0fMHz", self.error_rate * 100, self.speed / 1e6, self.speeds[self.index - 1] / 1e6)
+        self._probing = True
+        self._set(self.index - 1)
+      else:
+        self._transfers = 0
+        self._errors = 0
+
+
 SPI_LOCK = threading.Lock()
 SPI_DEVICES = {}
+
+# the device this thread holds in a transaction, if any
+_held = threading.local()
+
+
 class SpiDevice:
   """
   Provides locked, thread-safe access to a panda's SPI interface.
@@ -94,29 +264,83 @@ class SpiDevice:
   MAX_SPEED = 50000000
 
   def __init__(self, speed=MAX_SPEED):
-    assert speed <= self.MAX_SPEED
-
     if not os.path.exists(DEV_PATH):
       raise PandaSpiUnavailable(f"SPI device not found: {DEV_PATH}")
     if spidev is None:
       raise PandaSpiUnavailable("spidev is not installed")
 
+    self.set_speed(speed)
+
+  def set_speed(self, speed: int) -> None:
+    """
+      Switches to the device opened at speed. Not while it's held.
+    """
+    assert speed <= self.MAX_SPEED
+
     with SPI_LOCK:
       if speed not in SPI_DEVICES:
         SPI_DEVICES[speed] = spidev.SpiDev()  # pylint: disable=c-extension-no-member
         SPI_DEVICES[speed].open(0, 0)
         SPI_DEVICES[speed].max_speed_hz = speed
       self._spidev = SPI_DEVICES[speed]
+      self.speed = speed
+
+  def _lock(self, stats: TransportStats | None) -> None:
+    st = time.monotonic()
+    SPI_LOCK.acquire()
+    fcntl.flock(self._spidev, fcntl.LOCK_EX)
+    _held.start = time.monotonic()
+    if stats is not None:
+      stats.record("spi_lock_wait", 0, 0, _held.start - st)
+
+  def _unlock(self, stats: TransportStats | None) -> None:
+    fcntl.flock(self._spidev, fcntl.LOCK_UN)
+    SPI_LOCK.release()
+    if stats is not None:
+      stats.record("spi_lock_hold", 0, 0, time.monotonic() - _held.start)
+
+  @contextmanager
+  def acquire(self, stats: TransportStats | None = None):
+    if getattr(_held, "device", None) is None:
+      self._lock(stats)
+      try:
+        yield self._spidev
+      finally:
+        self._unlock(stats)
+      return
+
+    # inside a transaction, the device is already held. once it's been held
+    # for long enough, let other threads and processes have a turn
+    held = _held.device
+    if time.monotonic() - _held.start > _held.max_hold:
+      held._unlock(stats)
+      time.sleep(0)
+      held._lock(stats)
+    # every device is the same file, so the held one's flock covers this one too.
+    # taking it again through another fd would block on ourselves
+    yield self._spidev
 
   @contextmanager
-  def acquire(self):
+  def transaction(self, max_hold_ms: float = SPI_MAX_HOLD_MS, stats: TransportStats | None = None):
+    """
+      Holds the device for all transfers made on this thread inside the
+      block, instead of locking it for each one. To stay fair to other
+      users of the bus, it's released and taken again between transfers
+      once it's been held for max_hold_ms. Transactions don't nest, an
+      inner one just joins the outer one.
+    """
+    if getattr(_held, "device", None) is not None:
+      yield self
+      return
+
+    self._lock(stats)
+    _held.device = self
+    _held.max_hold = max_hold_ms * 1e-3
     try:
-      SPI_LOCK.acquire()
-      fcntl.flock(self._spidev, fcntl.LOCK_EX)
-      yield self._spidev
+      yield self
     finally:
-      fcntl.flock(self._spidev, fcntl.LOCK_UN)
-      SPI_LOCK.release()
+      _held.device = None
+      self._unlock(stats)
 
   def close(self):
     pass
@@ -125,124 +349,303 @@ class SpiDevice:
 class PandaSpiHandle(BaseHandle):
   """
   A class that mimics a libusb1 handle for panda SPI communications.
+
+  Transfers either go through spidev from userspace, or through the
+  spidev_panda kernel driver (drivers/spi), which runs the whole protocol,
+  and a batch of transfers, per ioctl. mode picks one, otherwise it's
+  taken from PANDA_SPI_MODE, and by default the kernel driver is used
+  when it's loaded and answers a probe.
   """
 
   PROTOCOL_VERSION = 2
 
-  def __init__(self) -> None:
-    self.dev = SpiDevice()
-
-    self._transfer_raw: Callable[[SpiDevice, int, bytes, int, int, bool], bytes] = self._transfer_spidev
-
-    if "KERN" in os.environ:
-      self._transfer_raw = self._transfer_kernel_driver
-
-      self.tx_buf = bytearray(1024)
-      self.rx_buf = bytearray(1024)
-      tx_buf_raw = ctypes.c_char.from_buffer(self.tx_buf)
-      rx_buf_raw = ctypes.c_char.from_buffer(self.rx_buf)
-
-      self.ioctl_data = PandaSpiTransfer()
-      self.ioctl_data.tx_buf = ctypes.addressof(tx_buf_raw)
-      self.ioctl_data.rx_buf = ctypes.addressof(rx_buf_raw)
-      self.fileno = self.dev._spidev.fileno()
+  def __init__(self, dev: SpiDevice | None = None, mode: str | None = None, ack_poller: AckPoller | None = None,
+               speed_controller: SpeedController | None = None) -> None:
+    self.dev = SpiDevice() if dev is None else dev
+    self.ack_poller = AckPoller() if ack_poller is None else ack_poller
+    self.speed_controller = SpeedController() if speed_controller is None else speed_controller
+
+    # reused by every transfer, only touched while holding the device
+    self._header = bytearray(HEADER_STRUCT.size + 1)
+    self._tx_buf = bytearray(XFER_SIZE + 1)
+    self._rx_buf = bytearray(3 + XFER_SIZE + 1)
+    self._tx_view = memoryview(self._tx_buf)
+    self._rx_view = memoryview(self._rx_buf)
+    self._bulk_rx = bytearray(0)
+    self._bulk_rx_view = memoryview(self._bulk_rx)
+    self._ack_polls: dict[tuple[int, int], list[int]] = {}
+
+    self.mode = SPI_MODE_SPIDEV
+    self._transfer_raw: Callable[[SpiDevice, int, bytes, int, int, bool], memoryview] = self._transfer_spidev
+
+    if mode is None:
+      # KERN is the old switch for the kernel driver
+      mode = os.environ.get("PANDA_SPI_MODE", SPI_MODE_KERNEL if "KERN" in os.environ else None)
+    if mode not in (None, SPI_MODE_SPIDEV, SPI_MODE_KERNEL):
+      raise ValueError(f"unknown SPI mode: {mode}")
+
+    if mode == SPI_MODE_KERNEL:
+      self._use_kernel_driver()
+    elif mode is None and kernel_driver_loaded():
+      self._use_kernel_driver()
+      if not self._probe_kernel_driver():
+        logger.warning("SPI: kernel driver probe failed, using spidev")
+        self.mode = SPI_MODE_SPIDEV
+        self._transfer_raw = self._transfer_spidev
+
+  def _use_kernel_driver(self) -> None:
+    self.mode = SPI_MODE_KERNEL
+    self._transfer_raw = self._transfer_kernel_driver
+
+    self._kern_transfers = (PandaSpiTransfer * SPI_PANDA_BATCH_MAX)()
+    self._kern_results = (ctypes.c_int32 * SPI_PANDA_BATCH_MAX)()
+    self._kern_batch = PandaSpiBatch(ctypes.addressof(self._kern_transfers), ctypes.addressof(self._kern_results), 0, 0)
+
+    # slot i of a bulk transfer is at i * XFER_SIZE, so reads land contiguously
+    bulk_size = math.ceil(KERNEL_BULK_SIZE / XFER_SIZE) * XFER_SIZE
+    self._kern_tx = self._kern_rx = bytearray(0)
+    self._kern_reserve(bulk_size, bulk_size)
+
+  def _probe_kernel_driver(self) -> bool:
+    try:
+      with self.dev.acquire() as spi:
+        self._transfer_kernel_driver(spi, 0, struct.pack("<BHHH", 0xc1, 0, 0, 0x40), TIMEOUT, 0x40)
+    except PandaSpiException:
+      logger.debug("SPI: kernel driver probe failed", exc_info=True)
+      return False
+    return True
 
   # helpers
-  def _calc_checksum(self, data: bytes) -> int:
-    cksum = CHECKSUM_START
-    for b in data:
-      cksum ^= b
-    return cksum
-
-  def _wait_for_ack(self, spi, ack_val: int, timeout: int, tx: int, length: int = 1) -> bytes:
+  def _calc_checksum(self, data) -> int:
+    return xor_checksum(data, CHECKSUM_START)
+
+  def _kern_reserve(self, tx_len: int, rx_len: int) -> None:
+    # the kernel driver gets raw pointers, so these are replaced, never resized
+    if len(self._kern_tx) < tx_len:
+      self._kern_tx = bytearray(tx_len)
+      self._kern_tx_view = memoryview(self._kern_tx)
+      self._kern_tx_addr = ctypes.addressof(ctypes.c_char.from_buffer(self._kern_tx))
+    if len(self._kern_rx) < rx_len:
+      self._kern_rx = bytearray(rx_len)
+      self._kern_rx_view = memoryview(self._kern_rx)
+      self._kern_rx_addr = ctypes.addressof(ctypes.c_char.from_buffer(self._kern_rx))
+
+  def _reserve(self, tx_len: int, rx_len: int) -> None:
+    # new buffers rather than a resize, the old ones have views exported
+    if len(self._tx_buf) < tx_len:
+      self._tx_buf = bytearray(tx_len)
+      self._tx_view = memoryview(self._tx_buf)
+    if len(self._rx_buf) < rx_len:
+      self._rx_buf = bytearray(rx_len)
+      self._rx_view = memoryview(self._rx_buf)
+
+  @traced("spi")
+  def _wait_for_ack(self, spi, ack_val: int, timeout: int, tx: int, length: int = 1, endpoint: int = 0) -> list[int]:
     timeout_s = max(MIN_ACK_TIMEOUT_MS, timeout) * 1e-3
 
+    # xfer2 doesn't modify its input, so the poll bytes are reused
+    poll = self._ack_polls.get((tx, length))
+    if poll is None:
+      poll = self._ack_polls[(tx, length)] = [tx, ] * length
+
+    key = (ack_val, endpoint)
+    poller = self.ack_poller
+    polls = 0
+    error: Exception | None = None
     start = time.monotonic()
-    while (timeout == 0) or ((time.monotonic() - start) < timeout_s):
-      dat = spi.xfer2([tx, ] * length)
-      if dat[0] == NACK:
-        raise PandaSpiNackResponse
-      elif dat[0] == ack_val:
-        return bytes(dat)
+    try:
+      while True:
+        dat: list[int] = spi.xfer2(poll)
+        polls += 1
+        elapsed = time.monotonic() - start
+        if dat[0] == NACK:
+          raise PandaSpiNackResponse
+        elif dat[0] == ack_val:
+          poller.update(key, elapsed)
+          return dat
+        if timeout != 0 and elapsed >= timeout_s:
+          raise PandaSpiMissingAck
 
-    raise PandaSpiMissingAck
+        delay = poller.delay(key, elapsed)
+        if delay > 0:
+          time.sleep(delay)
+    except PandaSpiException as e:
+      error = e
+      raise
+    finally:
+      if self.stats is not None:
+        self.stats.record(ACK_WAIT_OPS.get(ack_val, "spi_ack"), endpoint, polls * length, time.monotonic() - start, error, polls=polls)
 
-  def _transfer_spidev(self, spi, endpoint: int, data, timeout: int, max_rx_len: int = 1000, expect_disconnect: bool = False) -> bytes:
+  def _transfer_spidev(self, spi, endpoint: int, data, timeout: int, max_rx_len: int = 1000, expect_disconnect: bool = False) -> memoryview:
+    """
+      Returns a view into the handle's rx buffer, only valid until the next transfer.
+    """
     max_rx_len = max(USBPACKET_MAX_SIZE, max_rx_len)
+    data_len = len(data)
+    self._reserve(data_len + 1, 3 + max_rx_len + 1)
 
     logger.debug("- send header")
-    packet = struct.pack("<BBHH", SYNC, endpoint, len(data), max_rx_len)
-    packet += bytes([self._calc_checksum(packet), ])
-    spi.xfer2(packet)
+    header = self._header
+    HEADER_STRUCT.pack_into(header, 0, SYNC, endpoint, data_len, max_rx_len)
+    header[-1] = self._calc_checksum(memoryview(header)[:-1])
+    spi.writebytes2(header)
 
     logger.debug("- waiting for header ACK")
-    self._wait_for_ack(spi, HACK, MIN_ACK_TIMEOUT_MS, 0x11)
+    self._wait_for_ack(spi, HACK, MIN_ACK_TIMEOUT_MS, 0x11, endpoint=endpoint)
 
     logger.debug("- sending data")
-    packet = bytes([*data, self._calc_checksum(data)])
-    spi.xfer2(packet)
+    tx = self._tx_view
+    self._tx_buf[:data_len] = data
+    self._tx_buf[data_len] = self._calc_checksum(tx[:data_len])
+    spi.writebytes2(tx[:data_len + 1])
 
     if expect_disconnect:
       logger.debug("- expecting disconnect, returning")
-      return b""
+      return tx[:0]
     else:
       logger.debug("- waiting for data ACK")
       preread_len = USBPACKET_MAX_SIZE + 1  # read enough for a controlRead
-      dat = self._wait_for_ack(spi, DACK, timeout, 0x13, length=3 + preread_len)
+      dat = self._wait_for_ack(spi, DACK, timeout, 0x13, length=3 + preread_len, endpoint=endpoint)
+      rx = self._rx_view
+      self._rx_buf[:len(dat)] = dat
 
       # get response length, then response
-      response_len = struct.unpack("<H", dat[1:3])[0]
+      response_len = self._rx_buf[1] | (self._rx_buf[2] << 8)
       if response_len > max_rx_len:
         raise PandaSpiException(f"response length greater than max ({max_rx_len} {response_len})")
 
       # read rest
-      remaining = (response_len + 1) - preread_len
-      if remaining > 0:
-        dat += bytes(spi.readbytes(remaining))
-
+      end = 3 + response_len + 1
+      if end > len(dat):
+        read_into(spi, rx[len(dat):end])
 
-      dat = dat[:3 + response_len + 1]
-      if self._calc_checksum(dat) != 0:
+      if self._calc_checksum(rx[:end]) != 0:
         raise PandaSpiBadChecksum
 
-      return dat[3:-1]
-
-  def _transfer_kernel_driver(self, spi, endpoint: int, data, timeout: int, max_rx_len: int = 1000, expect_disconnect: bool = False) -> bytes:
-    import spidev2
-    self.tx_buf[:len(data)] = data
-    self.ioctl_data.endpoint = endpoint
-    self.ioctl_data.tx_length = len(data)
-    self.ioctl_data.rx_length_max = max_rx_len
-    self.ioctl_data.expect_disconnect = int(expect_disconnect)
-
-    # TODO: use our own ioctl request
+      return rx[3:end - 1]
+
+  def _kern_fill(self, i: int, endpoint: int, tx_off: int, tx_len: int, rx_off: int, max_rx_len: int, expect_disconnect: bool = False) -> None:
+    t = self._kern_transfers[i]
+    t.tx_buf = self._kern_tx_addr + tx_off
+    t.rx_buf = self._kern_rx_addr + rx_off
+    t.tx_length = tx_len
+    t.rx_length_max = max_rx_len
+    t.endpoint = endpoint
+    t.expect_disconnect = int(expect_disconnect)
+
+  @traced("spi")
+  def _kern_submit(self, spi, count: int, flags: int = 0) -> int:
+    """
+      Runs the first count filled transfers in one ioctl, and returns how
+      many completed. Their results are in _kern_results, see _kern_check.
+    """
+    ctypes.memset(self._kern_results, 0, ctypes.sizeof(self._kern_results))
+    self._kern_batch.count = count
+    self._kern_batch.flags = flags
     try:
-      ret = fcntl.ioctl(self.fileno, spidev2.SPI_IOC_RD_LSB_FIRST, self.ioctl_data)
+      return int(fcntl.ioctl(spi.fileno(), SPI_IOC_PANDA_BATCH, self._kern_batch))
     except OSError as e:
       raise PandaSpiException from e
-    if ret < 0:
-      raise PandaSpiException(f"ioctl returned {ret}")
-    return bytes(self.rx_buf[:ret])
-
-  def _transfer(self, endpoint: int, data, timeout: int, max_rx_len: int = 1000, expect_disconnect: bool = False) -> bytes:
-    logger.debug("starting transfer: endpoint=%d, max_rx_len=%d", endpoint, max_rx_len)
-    logger.debug("==============================================")
 
+  def _kern_check(self, n: int, count: int) -> None:
+    # the driver stops at the first failed transfer
+    if n < count and self._kern_results[n] < 0:
+      raise PandaSpiTransferFailed(f"kernel transfer {n} of {count} failed ({self._kern_results[n]})")
+    # nothing done and no error isn't progress either
+    if n == 0 and count > 0:
+      raise PandaSpiTransferFailed(f"kernel driver completed none of {count} transfers")
+
+  def _transfer_kernel_driver(self, spi, endpoint: int, data, timeout: int, max_rx_len: int = 1000, expect_disconnect: bool = False) -> memoryview:
+    data_len = len(data)
+    self._kern_reserve(data_len, max_rx_len)
+    self._kern_tx[:data_len] = data
+    self._kern_fill(0, endpoint, 0, data_len, 0, max_rx_len, expect_disconnect)
+    self._kern_check(self._kern_submit(spi, 1), 1)
+    return self._kern_rx_view[:self._kern_results[0]]
+
+  def _bulk_write_kernel(self, endpoint: int, data, timeout: int) -> int:
+    length = len(data)
+    chunks = math.ceil(length / XFER_SIZE)
+    self._kern_reserve(length, 1000)
+    self._kern_tx[:length] = data
+
+    # chunks that made it aren't sent again on a retry
+    done = 0
+    def write(spi) -> None:
+      nonlocal done
+      while done < chunks:
+        count = min(chunks - done, SPI_PANDA_BATCH_MAX)
+        for i in range(count):
+          off = (done + i) * XFER_SIZE
+          self._kern_fill(i, endpoint, off, min(XFER_SIZE, length - off), 0, 1000)
+        n = self._kern_submit(spi, count)
+        done += n
+        self._kern_check(n, count)
+    self._retry(endpoint, timeout, write)
+    return length
+
+  def _bulk_read_kernel(self, endpoint: int, length: int, timeout: int) -> bytes:
+    chunks = math.ceil(length / XFER_SIZE)
+    self._kern_reserve(0, chunks * XFER_SIZE)
+
+    # chunks that were read are kept across retries
+    done = 0
+    def read(spi) -> bytes:
+      nonlocal done
+      while done < chunks:
+        count = min(chunks - done, SPI_PANDA_BATCH_MAX)
+        for i in range(count):
+          self._kern_fill(i, endpoint, 0, 0, (done + i) * XFER_SIZE, XFER_SIZE)
+        n = self._kern_submit(spi, count, SPI_PANDA_BATCH_STOP_ON_SHORT_READ)
+        done += n
+        self._kern_check(n, count)
+        if self._kern_results[n - 1] < XFER_SIZE:
+          return bytes(self._kern_rx_view[:(done - 1) * XFER_SIZE + self._kern_results[n - 1]])
+      return bytes(self._kern_rx_view[:done * XFER_SIZE])
+    return self._retry(endpoint, timeout, read)
+
+  def _retry(self, endpoint: int, timeout: int, fn: Callable[[SpiDevice], R]) -> R:
     n = 0
     start_time = time.monotonic()
     exc = PandaSpiException()
     while (timeout == 0) or (time.monotonic() - start_time) < timeout*1e-3:
       n += 1
       logger.debug("\ntry #%d", n)
-      with self.dev.acquire() as spi:
+
+      # the kernel driver retries on its own, only spidev transfers are seen failing
+      speed = self.speed_controller.speed
+      if self.mode == SPI_MODE_SPIDEV and speed != self.dev.speed and getattr(_held, "device", None) is None:
+        self.dev.set_speed(speed)
+
+      with self.dev.acquire(self.stats) as spi:
         try:
-          return self._transfer_raw(spi, endpoint, data, timeout, max_rx_len, expect_disconnect)
+          ret = fn(spi)
         except PandaSpiException as e:
           exc = e
           logger.debug("SPI transfer failed, retrying", exc_info=True)
+          if self.stats is not None:
+            self.stats.retry("spi_transfer", endpoint)
+          if isinstance(e, (PandaSpiBadChecksum, PandaSpiNackResponse, PandaSpiMissingAck)):
+            self.speed_controller.record(False)
+          continue
+      self.speed_controller.record(True)
+      return ret
 
     raise exc
 
+  @traced("spi", code_arg=0)
+  def _transfer(self, endpoint: int, data, timeout: int, max_rx_len: int = 1000, expect_disconnect: bool = False) -> bytes:
+    logger.debug("starting transfer: endpoint=%d, max_rx_len=%d", endpoint, max_rx_len)
+    logger.debug("==============================================")
+    # copied out while the device is held, the rx buffer is reused by the next transfer
+    return self._retry(endpoint, timeout, lambda spi: bytes(self._transfer_raw(spi, endpoint, data, timeout, max_rx_len, expect_disconnect)))
+
+  def transaction(self, max_hold_ms: float = SPI_MAX_HOLD_MS):
+    """
+      Holds the SPI device across a sequence of transfers, see SpiDevice.transaction.
+    """
+    return self.dev.transaction(max_hold_ms, self.stats)
+
   def get_protocol_version(self) -> bytes:
     vers_str = b"VERSION"
     def _get_version(spi) -> bytes:
@@ -283,25 +686,45 @@ class PandaSpiHandle(BaseHandle):
   def close(self):
     self.dev.close()
 
+  @traced("spi", code_arg=1)
   def controlWrite(self, request_type: int, request: int, value: int, index: int, data, timeout: int = TIMEOUT, expect_disconnect: bool = False):
     return self._transfer(0, struct.pack("<BHHH", request, value, index, 0), timeout, expect_disconnect=expect_disconnect)
 
+  @traced("spi", code_arg=1)
   def controlRead(self, request_type: int, request: int, value: int, index: int, length: int, timeout: int = TIMEOUT):
     return self._transfer(0, struct.pack("<BHHH", request, value, index, length), timeout, max_rx_len=length)
 
+  @traced("spi", code_arg=0)
   def bulkWrite(self, endpoint: int, data: bytes, timeout: int = TIMEOUT) -> int:
+    if self.mode == SPI_MODE_KERNEL:
+      return self._bulk_write_kernel(endpoint, data, timeout)
     for x in range(math.ceil(len(data) / XFER_SIZE)):
       self._transfer(endpoint, data[XFER_SIZE*x:XFER_SIZE*(x+1)], timeout)
     return len(data)
 
+  @traced("spi", code_arg=0)
   def bulkRead(self, endpoint: int, length: int, timeout: int = TIMEOUT) -> bytes:
-    ret = b""
-    for _ in range(math.ceil(length / XFER_SIZE)):
-      d = self._transfer(endpoint, [], timeout, max_rx_len=XFER_SIZE)
-      ret += d
-      if len(d) < XFER_SIZE:
-        break
-    return ret
+    if self.mode == SPI_MODE_KERNEL:
+      return self._bulk_read_kernel(endpoint, length, timeout)
+
+    # the chunks go into the handle's bulk buffer, and the ones that
+    # were read are kept across retries
+    size = math.ceil(length / XFER_SIZE) * XFER_SIZE
+    pos = 0
+    def read(spi) -> bytes:
+      nonlocal pos
+      if len(self._bulk_rx) < size:
+        self._bulk_rx = bytearray(size)
+        self._bulk_rx_view = memoryview(self._bulk_rx)
+      while pos < size:
+        dat = self._transfer_raw(spi, endpoint, b"", timeout, XFER_SIZE, False)
+        self._bulk_rx_view[pos:pos + len(dat)] = dat
+        pos += len(dat)
+        if len(dat) < XFER_SIZE:
+          break
+      # the only copy, the buffer is reused by the next read
+      return bytes(self._bulk_rx_view[:pos])
+    return self._retry(endpoint, timeout, read)
 
 
 class STBootloaderSPIHandle(BaseSTBootloaderHandle):
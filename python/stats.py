@@ -0,0 +1,164 @@
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+from typing import NamedTuple
+
+import usb1
+
+# upper bounds of the latency histogram buckets, in microseconds. the last bucket has everything slower
+LATENCY_BUCKETS_US = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 1000000)
+
+TIMEOUT_ERRORS: tuple[type[Exception], ...] = (usb1.USBErrorTimeout, TimeoutError)
+
+# handle methods that get timed, and the argument used as the stats code
+INSTRUMENTED_METHODS = {
+  "controlRead": ("control_read", 1),
+  "controlWrite": ("control_write", 1),
+  "bulkRead": ("bulk_read", 0),
+  "bulkWrite": ("bulk_write", 0),
+}
+
+
+class OpStats(NamedTuple):
+  calls: int = 0
+  bytes: int = 0
+  errors: int = 0
+  timeouts: int = 0
+  retries: int = 0
+  latency_us: tuple[int, ...] = (0, ) * (len(LATENCY_BUCKETS_US) + 1)
+  total_us: int = 0
+  polls: int = 0  # status polls, like SPI ACK waits
+
+  def __sub__(self, other: "OpStats") -> "OpStats":
+    return OpStats(self.calls - other.calls, self.bytes - other.bytes, self.errors - other.errors,
+                   self.timeouts - other.timeouts, self.retries - other.retries,
+                   tuple(a - b for a, b in zip(self.latency_us, other.latency_us, strict=True)), self.total_us - other.total_us,
+                   self.polls - other.polls)
+
+  @property
+  def mean_us(self) -> float:
+    return self.total_us / self.calls if self.calls > 0 else 0.
+
+  def percentile_us(self, q: float) -> int | None:
+    """
+      Upper bound of the bucket holding the q-th percentile, None if
+      nothing was recorded or it's in the overflow bucket.
+    """
+    total = sum(self.latency_us)
+    if total == 0:
+      return None
+    target = q / 100 * total
+    n = 0
+    for i, c in enumerate(self.latency_us):
+      n += c
+      if n >= target and c > 0:
+        return LATENCY_BUCKETS_US[i] if i < len(LATENCY_BUCKETS_US) else None
+    return None
+
+
+class StatsSnapshot(dict):
+  """
+    OpStats keyed by (op, code), where code is the request for control
+    transfers and the endpoint for everything else. Subtracting an earlier
+    snapshot gives the stats since then.
+  """
+  def __init__(self, *args, timestamp: float | None = None, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.timestamp = time.monotonic() if timestamp is None else timestamp
+
+  def __sub__(self, other: "StatsSnapshot") -> "StatsSnapshot":
+    ret = {k: v - other.get(k, OpStats()) for k, v in self.items()}
+    return StatsSnapshot({k: v for k, v in ret.items() if v != OpStats()}, timestamp=self.timestamp - other.timestamp)
+
+
+class _Counters:
+  __slots__ = ("calls", "bytes", "errors", "timeouts", "retries", "latency_us", "total_us", "polls")
+
+  def __init__(self):
+    self.calls = 0
+    self.bytes = 0
+    self.errors = 0
+    self.timeouts = 0
+    self.retries = 0
+    self.latency_us = [0] * (len(LATENCY_BUCKETS_US) + 1)
+    self.total_us = 0
+    self.polls = 0
+
+
+class TransportStats:
+  """
+    Counters and latency histograms for the transfers of a handle.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counters: dict[tuple[str, int], _Counters] = {}
+
+  def _get(self, op: str, code: int) -> _Counters:
+    c = self._counters.get((op, code))
+    if c is None:
+      c = self._counters.setdefault((op, code), _Counters())
+    return c
+
+  def record(self, op: str, code: int, nbytes: int, elapsed: float, error: Exception | None = None, polls: int = 0) -> None:
+    us = int(elapsed * 1e6)
+    with self._lock:
+      c = self._get(op, code)
+      c.calls += 1
+      c.bytes += nbytes
+      c.total_us += us
+      c.polls += polls
+      c.latency_us[bisect_left(LATENCY_BUCKETS_US, us)] += 1
+      if error is not None:
+        c.errors += 1
+        if isinstance(error, TIMEOUT_ERRORS):
+          c.timeouts += 1
+
+  def retry(self, op: str, code: int) -> None:
+    with self._lock:
+      self._get(op, code).retries += 1
+
+  def snapshot(self) -> StatsSnapshot:
+    with self._lock:
+      return StatsSnapshot({k: OpStats(c.calls, c.bytes, c.errors, c.timeouts, c.retries, tuple(c.latency_us), c.total_us, c.polls)
+                            for k, c in self._counters.items()})
+
+  def reset(self) -> None:
+    with self._lock:
+      self._counters.clear()
+
+
+def _timed(stats: TransportStats, fn, op: str, code_arg: int):
+  @wraps(fn)
+  def wrapper(*args, **kwargs):
+    code = args[code_arg]
+    st = time.perf_counter()
+    try:
+      ret = fn(*args, **kwargs)
+    except Exception as e:
+      stats.record(op, code, 0, time.perf_counter() - st, e)
+      raise
+    # reads return the data, writes the length, if anything
+    nbytes = ret if isinstance(ret, int) else len(ret) if ret is not None else 0
+    stats.record(op, code, nbytes, time.perf_counter() - st)
+    return ret
+  return wrapper
+
+
+def instrument(handle, stats: TransportStats) -> None:
+  """
+    Times the transfer methods of a handle instance, and points its stats
+    attribute at stats for the retry counters. Nothing is wrapped on a
+    handle that was never instrumented.
+  """
+  uninstrument(handle)
+  for name, (op, code_arg) in INSTRUMENTED_METHODS.items():
+    setattr(handle, name, _timed(stats, getattr(handle, name), op, code_arg))
+  handle.stats = stats
+
+
+def uninstrument(handle) -> None:
+  for name in INSTRUMENTED_METHODS:
+    handle.__dict__.pop(name, None)
+  handle.stats = None
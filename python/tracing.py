@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import atexit
+import threading
+from collections.abc import Callable
+from functools import wraps
+from typing import ParamSpec, TypeVar
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+# the active tracer, None when tracing is off
+_tracer: "Tracer | None" = None
+
+
+class Tracer:
+  """
+    Records a complete event per traced call, with the thread it ran on,
+    and writes them out in the Chrome trace event format, which can be
+    loaded in chrome://tracing or Perfetto.
+  """
+
+  def __init__(self):
+    self._start_ns = time.perf_counter_ns()
+    self._pid = os.getpid()
+    # list.append is atomic, so threads can add events without a lock
+    self.events: list[dict] = []
+    self._thread_names: dict[int, str] = {}
+
+  def add(self, name: str, cat: str, start_ns: int, end_ns: int, args: dict | None = None) -> None:
+    tid = threading.get_ident()
+    if tid not in self._thread_names:
+      self._thread_names[tid] = threading.current_thread().name
+    event = {
+      "name": name,
+      "cat": cat,
+      "ph": "X",
+      "ts": (start_ns - self._start_ns) / 1e3,
+      "dur": (end_ns - start_ns) / 1e3,
+      "pid": self._pid,
+      "tid": tid,
+    }
+    if args is not None:
+      event["args"] = args
+    self.events.append(event)
+
+  def to_json(self) -> dict:
+    meta = [{"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": name}}
+            for tid, name in self._thread_names.items()]
+    return {"traceEvents": meta + self.events, "displayTimeUnit": "ms"}
+
+  def save(self, path: str) -> None:
+    with open(path, "w") as f:
+      json.dump(self.to_json(), f)
+
+
+def start_tracing() -> Tracer:
+  global _tracer
+  _tracer = Tracer()
+  return _tracer
+
+
+def stop_tracing(path: str | None = None) -> Tracer | None:
+  """
+    Stops tracing and returns the tracer, after saving it to path if given.
+  """
+  global _tracer
+  tracer, _tracer = _tracer, None
+  if tracer is not None and path is not None:
+    tracer.save(path)
+  return tracer
+
+
+def active_tracer() -> Tracer | None:
+  return _tracer
+
+
+def traced(cat: str, name: str | None = None, code_arg: int | None = None) -> Callable[[Callable[P, R]], Callable[P, R]]:
+  """
+    Traces every call of the decorated function. code_arg is the index of
+    the argument after self that's recorded as the request or endpoint.
+  """
+  def decorator(fn: Callable[P, R]) -> Callable[P, R]:
+    event_name = fn.__name__ if name is None else name
+
+    @wraps(fn)
+    def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+      tracer = _tracer
+      if tracer is None:
+        return fn(*args, **kwargs)
+
+      st = time.perf_counter_ns()
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        tracer.add(event_name, cat, st, time.perf_counter_ns(),
+                   {"code": f"{args[code_arg + 1]:#x}"} if code_arg is not None and len(args) > code_arg + 1 else None)
+    return wrapper
+  return decorator
+
+
+# PANDA_TRACE=trace.json traces the whole process
+if "PANDA_TRACE" in os.environ:
+  start_tracing()
+  atexit.register(stop_tracing, os.environ["PANDA_TRACE"])
@@ -1,27 +1,243 @@
+import time
+import usb1
 import struct
+from collections import deque
+from collections.abc import Callable
 
 from .base import BaseHandle, BaseSTBootloaderHandle, TIMEOUT
 from .constants import McuType
+from .tracing import traced
+from .utils import logger
 
 class PandaUsbHandle(BaseHandle):
-  def __init__(self, libusb_handle):
+  def __init__(self, libusb_handle, context=None):
     self._libusb_handle = libusb_handle
+    self._context = context
+
+  @property
+  def libusb_handle(self):
+    return self._libusb_handle
+
+  @property
+  def context(self):
+    return self._context
 
   def close(self):
     self._libusb_handle.close()
 
+  @traced("usb", code_arg=1)
   def controlWrite(self, request_type: int, request: int, value: int, index: int, data, timeout: int = TIMEOUT, expect_disconnect: bool = False):
     return self._libusb_handle.controlWrite(request_type, request, value, index, data, timeout)
 
+  @traced("usb", code_arg=1)
   def controlRead(self, request_type: int, request: int, value: int, index: int, length: int, timeout: int = TIMEOUT):
     return self._libusb_handle.controlRead(request_type, request, value, index, length, timeout)
 
+  @traced("usb", code_arg=0)
   def bulkWrite(self, endpoint: int, data: bytes, timeout: int = TIMEOUT) -> int:
     return self._libusb_handle.bulkWrite(endpoint, data, timeout)  # type: ignore
 
+  @traced("usb", code_arg=0)
   def bulkRead(self, endpoint: int, length: int, timeout: int = TIMEOUT) -> bytes:
     return self._libusb_handle.bulkRead(endpoint, length, timeout)  # type: ignore
 
+  @traced("usb", code_arg=0)
+  def bulk_write_pipelined(self, endpoint: int, chunks, timeout: int = TIMEOUT, depth: int = 4) -> int:
+    """
+      Writes chunks in order with up to depth bulk transfers in flight.
+      Instead of raising on a timeout, this stops and returns the number
+      of bytes the device accepted, counted from the start of the first chunk.
+    """
+    assert self._context is not None, "async transfers need the handle's USB context"
+    endpoint = endpoint | usb1.ENDPOINT_OUT
+    transferred = [0] * len(chunks)
+    next_chunk = 0
+    stop = False
+
+    def on_transfer(transfer):
+      nonlocal next_chunk, stop
+      i = transfer.getUserData()
+      transferred[i] = transfer.getActualLength()
+      if transfer.getStatus() != usb1.TRANSFER_COMPLETED or transferred[i] < len(chunks[i]):
+        stop = True
+      elif not stop and next_chunk < len(chunks):
+        transfer.setBulk(endpoint, chunks[next_chunk], callback=on_transfer, user_data=next_chunk)
+        next_chunk += 1
+        transfer.submit()
+
+    # no libusb timeouts, a timed out transfer would let the next queued one
+    # go out after a partial chunk. the deadline is handled here instead
+    transfers = [self._libusb_handle.getTransfer() for _ in range(min(depth, len(chunks)))]
+    for transfer in transfers:
+      transfer.setBulk(endpoint, chunks[next_chunk], callback=on_transfer, user_data=next_chunk)
+      next_chunk += 1
+      transfer.submit()
+
+    deadline = None if timeout == 0 else time.monotonic() + timeout * 1e-3
+    cancelled = False
+    try:
+      while any(t.isSubmitted() for t in transfers):
+        if not cancelled and (stop or (deadline is not None and time.monotonic() > deadline)):
+          stop = cancelled = True
+          # latest first, so nothing queued behind a partially sent chunk goes out
+          for transfer in sorted(transfers, key=lambda t: -t.getUserData()):
+            if transfer.isSubmitted():
+              try:
+                transfer.cancel()
+              except usb1.USBErrorNotFound:
+                pass
+        tv = 0.01 if deadline is None else min(max(deadline - time.monotonic(), 0), 0.01)
+        self._context.handleEventsTimeout(tv=tv)
+    finally:
+      for transfer in transfers:
+        if not transfer.isSubmitted():
+          transfer.close()
+
+    sent = 0
+    for i, chunk in enumerate(chunks):
+      sent += transferred[i]
+      if transferred[i] < len(chunk):
+        if any(transferred[i + 1:]):
+          logger.error("USB: pipelined write went out of order")
+        break
+    return sent
+
+  def bulk_reader(self, endpoint: int, num_transfers: int = 4, transfer_size: int = 16384,
+                  callback: Callable[[bytes], None] | None = None) -> "AsyncBulkReader":
+    assert self._context is not None, "async transfers need the handle's USB context"
+    return AsyncBulkReader(self._context, self._libusb_handle, endpoint, num_transfers, transfer_size, callback)
+
+
+class AsyncBulkReader:
+  """
+    Keeps num_transfers bulk IN transfers queued on an endpoint, so the
+    endpoint never sits idle between the end of one read and the next
+    submission like it does with synchronous bulkRead.
+
+    libusb completes the transfers of an endpoint in submission order.
+    Completed buffers are passed to callback, or queued for read(). Events
+    are handled on the thread calling read() or handle_events(), which
+    also raise a failed transfer's error.
+  """
+
+  ERRORS = {
+    usb1.TRANSFER_ERROR: usb1.USBErrorIO,
+    usb1.TRANSFER_STALL: usb1.USBErrorPipe,
+    usb1.TRANSFER_NO_DEVICE: usb1.USBErrorNoDevice,
+    usb1.TRANSFER_OVERFLOW: usb1.USBErrorOverflow,
+  }
+  # the endpoint recovers from these, the transfers are queued again once it's raised
+  RECOVERABLE = (usb1.TRANSFER_STALL, usb1.TRANSFER_OVERFLOW)
+
+  def __init__(self, context, libusb_handle, endpoint: int, num_transfers: int = 4, transfer_size: int = 16384,
+               callback: Callable[[bytes], None] | None = None):
+    assert num_transfers > 0
+    self._context = context
+    self._libusb_handle = libusb_handle
+    self._endpoint = endpoint | usb1.ENDPOINT_IN
+    self._callback = callback
+    self._completed: deque[bytes] = deque()
+    self._closing = False
+    self.error: int | None = None
+    self.timeouts = 0
+
+    # a transfer that came back empty isn't resubmitted until the next
+    # read(), otherwise an idle panda makes us spin on zero length packets
+    self._idle: list = []
+    # held back until the error is raised
+    self._failed: list = []
+
+    self._transfers = []
+    for _ in range(num_transfers):
+      transfer = libusb_handle.getTransfer()
+      transfer.setBulk(self._endpoint, transfer_size, callback=self._on_transfer)
+      self._transfers.append(transfer)
+      transfer.submit()
+
+  def _on_transfer(self, transfer) -> None:
+    status = transfer.getStatus()
+    if status == usb1.TRANSFER_COMPLETED:
+      length = transfer.getActualLength()
+      if length > 0:
+        dat = bytes(transfer.getBuffer()[:length])
+        if self._callback is not None:
+          self._callback(dat)
+        else:
+          self._completed.append(dat)
+    elif status == usb1.TRANSFER_TIMED_OUT:
+      # counted, not logged, a timeout on an idle endpoint isn't an error
+      self.timeouts += 1
+    elif status in self.ERRORS and self.error is None:
+      logger.error("USB: async bulk transfer failed with status %d", status)
+      self.error = status
+
+    if self._closing or status == usb1.TRANSFER_CANCELLED:
+      return
+    if self.error is not None:
+      self._failed.append(transfer)
+    elif status == usb1.TRANSFER_COMPLETED and transfer.getActualLength() == 0:
+      self._idle.append(transfer)
+    else:
+      transfer.submit()
+
+  def _resubmit_idle(self) -> None:
+    while len(self._idle) > 0:
+      self._idle.pop(0).submit()
+
+  def _raise_error(self) -> None:
+    error = self.error
+    assert error is not None
+    if error in self.RECOVERABLE:
+      self.error = None
+      if error == usb1.TRANSFER_STALL:
+        self._libusb_handle.clearHalt(self._endpoint)
+      self._idle += self._failed
+      self._failed = []
+    raise self.ERRORS[error]
+
+  def handle_events(self, timeout: float = 0.1) -> None:
+    if self.error is not None:
+      self._raise_error()
+    self._resubmit_idle()
+    self._context.handleEventsTimeout(tv=timeout)
+
+  def read(self, timeout: float = 0.1) -> bytes:
+    """
+      Returns all completed data, in order. Waits up to timeout seconds
+      for the first completion.
+    """
+    self._resubmit_idle()
+    deadline = time.monotonic() + timeout
+    while len(self._completed) == 0 and len(self._idle) < len(self._transfers):
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        break
+      if self.error is not None:
+        self._raise_error()
+      # empty transfers stay idle until the next read, once all are the panda has nothing
+      self._context.handleEventsTimeout(tv=remaining)
+    ret = []
+    while len(self._completed) > 0:
+      ret.append(self._completed.popleft())
+    return b''.join(ret)
+
+  def close(self) -> None:
+    self._closing = True
+    for transfer in self._transfers:
+      if transfer.isSubmitted():
+        try:
+          transfer.cancel()
+        except usb1.USBErrorNotFound:
+          pass
+    # wait for the cancellations to come back
+    deadline = time.monotonic() + 1
+    while any(t.isSubmitted() for t in self._transfers) and time.monotonic() < deadline:
+      self._context.handleEventsTimeout(tv=0.01)
+    for transfer in self._transfers:
+      if not transfer.isSubmitted():
+        transfer.close()
+    self._transfers = []
+
 
 
 class STBootloaderUSBHandle(BaseSTBootloaderHandle):
@@ -9,3 +9,20 @@ logger.setLevel(LOGLEVEL)
 handler = logging.StreamHandler()
 handler.setFormatter(logging.Formatter('%(message)s'))
 logger.addHandler(handler)
+
+
+def xor_checksum(data, start: int = 0) -> int:
+  # a plain loop is fastest for short buffers like a single CAN packet
+  n = len(data)
+  if n < 48:
+    for b in data:
+      start ^= b
+    return start
+
+  # otherwise XOR word-wide: load the whole buffer as one integer
+  # and fold it onto itself until a single byte is left
+  res = int.from_bytes(data, 'little')
+  while n > 1:
+    n = (n + 1) // 2
+    res = (res ^ (res >> (8 * n))) & ((1 << (8 * n)) - 1)
+  return res ^ start
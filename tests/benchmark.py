@@ -1,43 +1,337 @@
 #!/usr/bin/env python3
+"""
+  Benchmarks of the panda library, run against a panda or a simulated one.
+
+    ./benchmark.py --target sim --json results.json
+    ./benchmark.py --baseline results.json  # exits with 1 on a regression
+
+  Each scenario reports its throughput, the p50 and p99 latency of an
+  iteration, and the CPU time spent in this process, so a slower panda
+  and a slower library can be told apart.
+"""
+import sys
+import json
 import time
+import random
+import argparse
+import platform
+import threading
+from collections.abc import Callable
 from contextlib import contextmanager
+from dataclasses import dataclass, field
 
-from panda import Panda, PandaDFU
+from panda import Panda, pack_can_buffer, unpack_can_buffer
+from panda.python.isotp import isotp_send, isotp_recv
+from panda.python.spi import PandaSpiHandle, SPI_MODE_SPIDEV, SPI_MODE_KERNEL, kernel_driver_loaded
 from panda.tests.hitl.helpers import get_random_can_messages
 
+SAFETY_ALLOUTPUT = 17  # opendbc's Safety.SAFETY_ALLOUTPUT
 
-@contextmanager
-def print_time(desc):
-  start = time.perf_counter()
-  yield
-  end = time.perf_counter()
-  print(f"{end - start:.2f}s - {desc}")
+TARGETS = ("hw", "sim", "sim-spi")
+CAN_SEND_COUNTS = (1, 10, 100, 1000, 10000, 100000)
 
 
-if __name__ == "__main__":
-  with print_time("Panda()"):
-    p = Panda()
-
-  with print_time("PandaDFU.list()"):
-    PandaDFU.list()
-
-  fxn = [
-    'reset',
-    'reconnect',
-    'up_to_date',
-    'health',
-    #'flash',
-  ]
-  for f in fxn:
-    with print_time(f"Panda.{f}()"):
-      getattr(p, f)()
-
-  p.set_can_loopback(True)
-
-  for n in range(6):
-    msgs = get_random_can_messages(int(10**n))
-    with print_time(f"Panda.can_send_many() - {len(msgs)} msgs"):
+@dataclass
+class Result:
+  unit: str = "calls"
+  latencies: list[float] = field(default_factory=list)
+  items: int = 0
+  nbytes: int = 0
+  wall: float = 0.
+  cpu: float = 0.
+
+  @contextmanager
+  def measure(self, items: int = 1, nbytes: int = 0):
+    """
+      Times one iteration of a scenario, anything outside isn't counted.
+    """
+    st, cpu_st = time.perf_counter(), time.process_time()
+    yield
+    elapsed = time.perf_counter() - st
+    self.cpu += time.process_time() - cpu_st
+    self.wall += elapsed
+    self.latencies.append(elapsed)
+    self.items += items
+    self.nbytes += nbytes
+
+  def percentile_us(self, q: float) -> float:
+    lat = sorted(self.latencies)
+    return lat[min(len(lat) - 1, max(0, round(q / 100 * len(lat)) - 1))] * 1e6
+
+  def to_json(self) -> dict:
+    return {
+      "unit": self.unit,
+      "iterations": len(self.latencies),
+      "items": self.items,
+      "throughput": self.items / self.wall if self.wall > 0 else 0.,
+      "bytes_per_s": self.nbytes / self.wall if self.wall > 0 else 0.,
+      "p50_us": self.percentile_us(50),
+      "p99_us": self.percentile_us(99),
+      "cpu_s": self.cpu,
+      "wall_s": self.wall,
+    }
+
+
+class Target:
+  """
+    Where the scenarios run. connect() makes a new Panda, sim targets
+    share one simulated device between them.
+  """
+
+  def __init__(self, name: str, serial: str | None = None):
+    self.name = name
+    self.serial = serial
+    self.sim = name != "hw"
+    if name == "sim-spi":
+      from panda.tests.libpanda.sim_panda import SimSpi
+      self._spi = SimSpi()
+
+  def connect(self) -> Panda:
+    if self.name == "hw":
+      return Panda(self.serial)
+
+    from panda.tests.libpanda.sim_panda import SimPanda, sim_spi_handle
+    return SimPanda(sim_spi_handle(self._spi)) if self.name == "sim-spi" else SimPanda()
+
+
+@dataclass
+class Scenario:
+  fn: Callable[[Panda, Target, Result, float], None]
+  unit: str = "calls"
+  hw_only: bool = False
+  spi_only: bool = False
+  usb_only: bool = False
+  opt_in: bool = False
+
+
+SCENARIOS: dict[str, Scenario] = {}
+
+
+def scenario(name: str, **kwargs):
+  def decorator(fn):
+    SCENARIOS[name] = Scenario(fn, **kwargs)
+    return fn
+  return decorator
+
+
+def iterations(n: int, scale: float) -> int:
+  return max(1, int(n * scale))
+
+
+def setup_loopback(p: Panda, loopback: bool) -> None:
+  p.set_safety_mode(SAFETY_ALLOUTPUT)
+  p.set_can_loopback(loopback)
+  p.can_clear(0xFFFF)
+
+
+def drain(p: Panda) -> int:
+  n = 0
+  while len(r := p.can_recv()) > 0:
+    n += len(r)
+  return n
+
+
+# *** scenarios ***
+
+@scenario("connect")
+def bench_connect(p, target, result, scale):
+  for _ in range(iterations(10, scale)):
+    with result.measure():
+      target.connect().close()
+
+
+@scenario("health")
+def bench_health(p, target, result, scale):
+  for _ in range(iterations(1000, scale)):
+    with result.measure(nbytes=Panda.HEALTH_STRUCT.size):
+      p.health()
+
+
+def bench_can_send_many(n, p, target, result, scale):
+  setup_loopback(p, False)
+  msgs = get_random_can_messages(n)
+  nbytes = sum(len(m[1]) for m in msgs)
+  for _ in range(iterations(max(1, 10000 // n), scale)):
+    with result.measure(items=n, nbytes=nbytes):
       p.can_send_many(msgs)
+    # the TX receipts pile up otherwise
+    p.can_clear(0xFFFF)
+
+for _n in CAN_SEND_COUNTS:
+  SCENARIOS[f"can_send_many_{_n}"] = Scenario(lambda *args, n=_n: bench_can_send_many(n, *args), unit="frames")
+
+
+@scenario("can_recv_drain", unit="frames")
+def bench_can_recv_drain(p, target, result, scale):
+  setup_loopback(p, True)
+  msgs = get_random_can_messages(1000)
+  for _ in range(iterations(10, scale)):
+    p.can_send_many(msgs)
+    if not target.sim:
+      time.sleep(0.1)
+    with result.measure(items=0):
+      result.items += drain(p)
+
+
+def bench_can_recv_rx_thread(usb_transfers, p, target, result, scale):
+  setup_loopback(p, True)
+  msgs = get_random_can_messages(iterations(10000, scale))
+  p.start_rx_thread(usb_transfers=usb_transfers)
+  try:
+    # loopback echoes every message twice
+    with result.measure(items=0):
+      tx = threading.Thread(target=p.can_send_many, args=(msgs, ), kwargs={'timeout': 0})
+      tx.start()
+      start = time.perf_counter()
+      while result.items < 2 * len(msgs) and (time.perf_counter() - start) < 10:
+        result.items += len(p.can_recv())
+        time.sleep(0.001)
+      tx.join()
+  finally:
+    p.stop_rx_thread()
+
+SCENARIOS["can_recv_rx_thread"] = Scenario(lambda *args: bench_can_recv_rx_thread(0, *args), unit="frames")
+# the RX thread on async USB transfers against the sync reads above
+for _n in (2, 4, 8):
+  SCENARIOS[f"can_recv_rx_thread_async_{_n}"] = Scenario(lambda *args, n=_n: bench_can_recv_rx_thread(n, *args), unit="frames",
+                                                         hw_only=True, usb_only=True)
+
+
+@scenario("codec_pack", unit="frames")
+def bench_codec_pack(p, target, result, scale):
+  msgs = get_random_can_messages(1000)
+  nbytes = sum(len(m[1]) for m in msgs)
+  for _ in range(iterations(100, scale)):
+    with result.measure(items=len(msgs), nbytes=nbytes):
+      pack_can_buffer(msgs)
+
+
+@scenario("codec_unpack", unit="frames")
+def bench_codec_unpack(p, target, result, scale):
+  msgs = get_random_can_messages(1000)
+  dat = b"".join(pack_can_buffer(msgs))
+  for _ in range(iterations(100, scale)):
+    with result.measure(items=len(msgs), nbytes=len(dat)):
+      unpack_can_buffer(dat)
+
+
+@scenario("isotp_round_trip")
+def bench_isotp_round_trip(p, target, result, scale):
+  # a single frame echoed by loopback. multi-frame needs an ECU for flow control
+  setup_loopback(p, True)
+  for _ in range(iterations(100, scale)):
+    dat = bytes(random.getrandbits(8) for _ in range(7))
+    with result.measure(nbytes=len(dat)):
+      isotp_send(p, dat, 0x7e0)
+      assert isotp_recv(p, 0x7e0) == dat
+
+
+def bench_spi_transfer(mode, p, target, result, scale):
+  h = PandaSpiHandle(mode=mode)
+  for _ in range(iterations(1000, scale)):
+    with result.measure(nbytes=Panda.HEALTH_STRUCT.size):
+      h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, Panda.HEALTH_STRUCT.size)
+      result.nbytes += len(h.bulkRead(1, 16384))
+
+for _mode in (SPI_MODE_SPIDEV, SPI_MODE_KERNEL):
+  SCENARIOS[f"spi_transfer_{_mode}"] = Scenario(lambda *args, mode=_mode: bench_spi_transfer(mode, *args), hw_only=True, spi_only=True)
+
+
+@scenario("flash", hw_only=True, opt_in=True)
+def bench_flash(p, target, result, scale):
+  with result.measure():
+    p.reset(enter_bootstub=True)
+    p.flash()
+
+
+# *** running and comparing ***
+
+def available(name: str, s: Scenario, p: Panda, target: Target, opt_in: set[str]) -> bool:
+  if s.opt_in and name not in opt_in:
+    return False
+  if s.hw_only and target.sim:
+    return False
+  if s.spi_only and not p.is_connected_spi():
+    return False
+  if s.usb_only and not p.is_connected_usb():
+    return False
+  if name == f"spi_transfer_{SPI_MODE_KERNEL}":
+    return bool(kernel_driver_loaded())
+  return True
+
+
+def run(target: Target, names: list[str] | None = None, scale: float = 1.) -> dict:
+  p = target.connect()
+  try:
+    selected = SCENARIOS.keys() if names is None else names
+    results = {}
+    for name in selected:
+      s = SCENARIOS[name]
+      if not available(name, s, p, target, set(names or ())):
+        continue
+      result = Result(s.unit)
+      s.fn(p, target, result, scale)
+      r = results[name] = result.to_json()
+      print(f"{name:>28}: {r['throughput']:12.1f} {s.unit}/s  p50 {r['p50_us']:10.1f}us  p99 {r['p99_us']:10.1f}us  cpu {r['cpu_s']:.3f}s", file=sys.stderr)
+
+    return {
+      "meta": {
+        "target": target.name,
+        "version": p.get_version(),
+        "transport": "spi" if p.is_connected_spi() else "usb",
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "scale": scale,
+      },
+      "results": results,
+    }
+  finally:
+    p.close()
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.1) -> list[str]:
+  """
+    Returns the regressions against the baseline: a throughput lower, or
+    a p99 latency higher, by more than tolerance.
+  """
+  regressions = []
+  for name, r in results["results"].items():
+    b = baseline["results"].get(name)
+    if b is None:
+      continue
+    if r["throughput"] < b["throughput"] * (1 - tolerance):
+      regressions.append(f"{name}: throughput {r['throughput']:.1f} < {b['throughput']:.1f} {r['unit']}/s")
+    if r["p99_us"] > b["p99_us"] * (1 + tolerance):
+      regressions.append(f"{name}: p99 {r['p99_us']:.1f} > {b['p99_us']:.1f}us")
+  return regressions
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("scenarios", nargs="*", help=f"scenarios to run, from {', '.join(SCENARIOS)}. all but the opt-in ones by default")
+  parser.add_argument("--target", choices=TARGETS, default="hw")
+  parser.add_argument("--serial", help="panda to run on, for the hw target")
+  parser.add_argument("--scale", type=float, default=1., help="multiplies the iterations of every scenario")
+  parser.add_argument("--json", help="write the results here")
+  parser.add_argument("--baseline", help="results to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.1, help="relative change that counts as a regression")
+  args = parser.parse_args()
+
+  unknown = set(args.scenarios) - SCENARIOS.keys()
+  if unknown:
+    parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+  results = run(Target(args.target, args.serial), args.scenarios or None, args.scale)
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(results, f, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
 
-  with print_time("Panda.can_recv()"):
-    m = p.can_recv()
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare(results, json.load(f), args.tolerance)
+    for r in regressions:
+      print(f"REGRESSION {r}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
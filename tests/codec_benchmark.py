@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+  Microbenchmarks of the CAN packet codec on both sides of the link: the
+  Python packing and decoding, and the firmware's comms_can_write and
+  comms_can_read in the libpanda host build, called through cffi.
+
+    ./codec_benchmark.py --json codec.json
+    ./codec_benchmark.py py_decode/canfd --baseline codec.json
+
+  Scenarios are named path/mix/chunk, and are selected by prefix.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+from collections.abc import Callable
+
+from panda import DLC_TO_LEN, USBPACKET_MAX_SIZE, CAN_FRAME_DTYPE, CanPacker, CanStreamDecoder, unpack_can_buffer_array
+from panda.python import USB_CAN_CHUNK_SIZE
+from panda.python.spi import XFER_SIZE
+from panda.tests.benchmark import Result, compare, iterations
+from panda.tests.libpanda import libpanda_py
+
+try:
+  import numpy as np
+except ImportError:
+  np = None  # type: ignore[assignment]
+HAS_NUMPY = np is not None
+
+ffi = libpanda_py.ffi
+lpp = libpanda_py.libpanda
+
+SAFETY_ALLOUTPUT = 17  # opendbc's Safety.SAFETY_ALLOUTPUT
+TX_QUEUES = (lpp.tx1_q, lpp.tx2_q, lpp.tx3_q)
+
+# frames per iteration. spread over the buses, they fit in the firmware's TX queues
+BATCH_SIZE = 400
+
+# data lengths, and whether they're sent as CAN-FD
+MIXES = {
+  "can": (DLC_TO_LEN[:9], False),
+  "can_8": ((8, ), False),
+  "canfd": (DLC_TO_LEN, True),
+  "canfd_64": ((64, ), True),
+}
+
+# the host packs bulk transfers. the firmware gets those in USB packets or SPI transfers
+PACK_CHUNKS = {"usb": USB_CAN_CHUNK_SIZE, "spi": XFER_SIZE, "16k": 0x4000}
+STREAM_CHUNKS = {"usb_packet": USBPACKET_MAX_SIZE, "spi": XFER_SIZE, "16k": 0x4000}
+
+
+class Batch:
+  """
+    A batch of random frames of a mix, packed and as a numpy array.
+  """
+
+  def __init__(self, mix: str, n: int = BATCH_SIZE):
+    lengths, self.fd = MIXES[mix]
+    self.frames = [(random.randint(1, (1 << 29) - 1), random.randbytes(random.choice(lengths)), random.randrange(len(TX_QUEUES)))
+                   for _ in range(n)]
+    self.packed = b"".join(bytes(c) for c in CanPacker(0x4000).pack(self.frames, self.fd))
+    self.nbytes = len(self.packed)
+
+  def chunks(self, chunk_size: int) -> list[bytes]:
+    return [self.packed[i:i + chunk_size] for i in range(0, len(self.packed), chunk_size)]
+
+  def array(self):
+    arr = np.zeros(len(self.frames), dtype=CAN_FRAME_DTYPE)
+    for i, (address, dat, bus) in enumerate(self.frames):
+      arr[i]['address'] = address
+      arr[i]['bus'] = bus
+      arr[i]['fd'] = self.fd
+      arr[i]['length'] = len(dat)
+      arr[i]['data'][:len(dat)] = list(dat)
+    return arr
+
+
+# *** python ***
+
+def bench_py_pack(batch: Batch, chunk_size: int, result: Result, n: int) -> None:
+  packer = CanPacker(chunk_size)
+  for _ in range(n):
+    with result.measure(len(batch.frames), batch.nbytes):
+      packer.pack(batch.frames, batch.fd)
+
+
+def bench_py_pack_array(batch: Batch, chunk_size: int, result: Result, n: int) -> None:
+  packer = CanPacker(chunk_size)
+  arr = batch.array()
+  for _ in range(n):
+    with result.measure(len(batch.frames), batch.nbytes):
+      packer.pack(arr)
+
+
+def bench_py_decode(batch: Batch, chunk_size: int, result: Result, n: int) -> None:
+  chunks = batch.chunks(chunk_size)
+  decoder = CanStreamDecoder()
+  for _ in range(n):
+    with result.measure(len(batch.frames), batch.nbytes):
+      for c in chunks:
+        decoder.feed(c)
+
+
+def bench_py_decode_array(batch: Batch, chunk_size: int, result: Result, n: int) -> None:
+  for _ in range(n):
+    with result.measure(len(batch.frames), batch.nbytes):
+      unpack_can_buffer_array(batch.packed)
+
+
+# *** firmware ***
+
+def bench_c_write(batch: Batch, chunk_size: int, result: Result, n: int) -> None:
+  lpp.set_safety_hooks(SAFETY_ALLOUTPUT, 0)
+  lpp.comms_can_reset()
+  # the buffers outlive the calls, so cffi doesn't copy each time
+  chunks = [(ffi.from_buffer("uint8_t[]", c), len(c)) for c in batch.chunks(chunk_size)]
+  overflow = lpp.tx_buffer_overflow
+  for _ in range(n):
+    with result.measure(len(batch.frames), batch.nbytes):
+      for buf, length in chunks:
+        lpp.comms_can_write(buf, length)
+    for q in TX_QUEUES:
+      lpp.can_clear(q)
+  assert lpp.tx_buffer_overflow == overflow, "TX queues overflowed"
+
+
+def bench_c_read(batch: Batch, chunk_size: int, result: Result, n: int) -> None:
+  lpp.comms_can_reset()
+  lpp.can_clear(lpp.rx_q)
+  pkts = []
+  for address, dat, bus in batch.frames:
+    pkt = libpanda_py.make_CANPacket(address, bus, dat)
+    pkt[0].fd = batch.fd
+    lpp.can_set_checksum(pkt)
+    pkts.append(pkt)
+  buf = ffi.new("uint8_t[]", chunk_size)
+
+  for _ in range(n):
+    for pkt in pkts:
+      lpp.can_push(lpp.rx_q, pkt)
+    nbytes = 0
+    with result.measure(len(batch.frames), batch.nbytes):
+      while (r := lpp.comms_can_read(buf, chunk_size)) > 0:
+        nbytes += r
+    assert nbytes == batch.nbytes
+
+
+BenchFn = Callable[[Batch, int, Result, int], None]
+
+# path -> (function, chunk sizes, whether it needs numpy)
+PATHS: dict[str, tuple[BenchFn, dict[str, int] | None, bool]] = {
+  "py_pack": (bench_py_pack, PACK_CHUNKS, False),
+  "py_pack_array": (bench_py_pack_array, PACK_CHUNKS, True),
+  "py_decode": (bench_py_decode, STREAM_CHUNKS, False),
+  "py_decode_array": (bench_py_decode_array, None, True),
+  "c_write": (bench_c_write, STREAM_CHUNKS, False),
+  "c_read": (bench_c_read, STREAM_CHUNKS, False),
+}
+
+
+def scenarios() -> dict[str, tuple[BenchFn, str, int]]:
+  ret = {}
+  for path, (fn, chunks, needs_numpy) in PATHS.items():
+    if needs_numpy and not HAS_NUMPY:
+      continue
+    for mix in MIXES:
+      if chunks is None:
+        ret[f"{path}/{mix}"] = (fn, mix, 0)
+      else:
+        for chunk_name, chunk_size in chunks.items():
+          ret[f"{path}/{mix}/{chunk_name}"] = (fn, mix, chunk_size)
+  return ret
+
+
+def run(prefixes: list[str] | None = None, scale: float = 1.) -> dict:
+  results = {}
+  batches: dict[str, Batch] = {}
+  for name, (fn, mix, chunk_size) in scenarios().items():
+    if prefixes and not any(name.startswith(p) for p in prefixes):
+      continue
+    if mix not in batches:
+      batches[mix] = Batch(mix)
+    result = Result("frames")
+    fn(batches[mix], chunk_size, result, iterations(50, scale))
+    r = results[name] = result.to_json()
+    print(f"{name:>28}: {r['throughput']:12.0f} frames/s  {r['bytes_per_s'] / 1e6:8.1f} MB/s  p50 {r['p50_us']:9.1f}us", file=sys.stderr)
+
+  return {
+    "meta": {
+      "target": "codec",
+      "batch_size": BATCH_SIZE,
+      "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+      "python": platform.python_version(),
+      "host": platform.node(),
+      "scale": scale,
+    },
+    "results": results,
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("scenarios", nargs="*", help="prefixes of the scenarios to run, all by default")
+  parser.add_argument("--scale", type=float, default=1., help="multiplies the iterations of every scenario")
+  parser.add_argument("--json", help="write the results here")
+  parser.add_argument("--baseline", help="results to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.1, help="relative change that counts as a regression")
+  args = parser.parse_args()
+
+  results = run(args.scenarios, args.scale)
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(results, f, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare(results, json.load(f), args.tolerance)
+    for reg in regressions:
+      print(f"REGRESSION {reg}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
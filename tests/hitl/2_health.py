@@ -35,6 +35,32 @@ def test_hw_type(p):
     assert pp.get_mcu_type() == mcu_type, "Bootstub and app MCU type mismatch"
     assert pp.get_uid() == app_uid
 
+def test_identity_cache(p):
+  hw_type, uid, signature = p.get_type(), p.get_uid(), p.get_signature()
+
+  # cached, no control transfers
+  handle, p._handle = p._handle, None
+  try:
+    assert p.get_type() == hw_type
+    assert p.get_uid() == uid
+    assert p.get_signature() == signature
+    assert p.has_obd() == (hw_type in Panda.HAS_OBD)
+  finally:
+    p._handle = handle
+
+  p.refresh()
+  assert p.get_type() == hw_type
+  assert p.get_uid() == uid
+
+def test_telemetry(p):
+  t = p.telemetry()
+  h = p.health()
+  assert t.health.safety_mode == h['safety_mode']
+  assert 0 <= h['uptime'] - t.health.uptime <= 1
+  assert len(t.can_health) == 3
+  for bus, ch in enumerate(t.can_health):
+    assert ch.can_speed == p.can_health(bus)['can_speed']
+
 def test_heartbeat(p, panda_jungle):
   panda_jungle.set_ignition(True)
   # TODO: add more cases here once the tests aren't super slow
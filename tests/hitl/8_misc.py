@@ -11,3 +11,29 @@ def test_boot_time(p):
   # USB enumeration is slow, so SPI is faster
   assert time.monotonic() - st < (1.0 if p.spi else 5.0)
 
+
+def test_can_bus_config(p):
+  p.set_can_speed_kbps(0, 250)
+  p.set_canfd_auto(1, True)
+  cfg = p.get_can_bus_config()
+  assert cfg[0]["can_speed"] == 250
+  assert cfg[1]["canfd_auto"]
+  assert cfg[2]["can_speed"] == 500
+
+  # reconnecting restores the defaults
+  p.reconnect()
+  cfg = p.get_can_bus_config()
+  assert all(c["can_speed"] == 500 and not c["canfd_auto"] for c in cfg)
+
+def test_lazy_connect(p):
+  serial = p.get_usb_serial()
+  p.set_can_speed_kbps(0, 250)
+  p.close()
+
+  with Panda(serial, lazy=True) as lp:
+    # nothing applied before the first CAN call
+    assert lp.get_can_bus_config()[0]["can_speed"] == 250
+    lp.can_recv()
+    assert lp.get_can_bus_config()[0]["can_speed"] == 500
+
+  p.reconnect()
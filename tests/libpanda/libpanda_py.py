@@ -1,4 +1,5 @@
 import os
+import struct
 from cffi import FFI
 from typing import Any, Protocol
 
@@ -51,8 +52,68 @@ int comms_can_read(uint8_t *data, uint32_t max_len);
 void comms_can_write(uint8_t *data, uint32_t len);
 void comms_can_reset(void);
 uint32_t can_slots_empty(can_ring *q);
+void can_clear(can_ring *q);
+
+extern uint32_t safety_tx_blocked;
+extern uint32_t safety_rx_invalid;
+extern uint32_t tx_buffer_overflow;
+extern uint32_t rx_buffer_overflow;
+
+void sim_can_tx_all(bool loopback);
+""")
+
+ffi.cdef("""
+int get_telemetry_pkt(uint8_t *dat, const uint8_t *health, const uint8_t *can);
 """)
 
+ffi.cdef("""
+typedef struct {
+  uint64_t t;
+  uint32_t addr;
+  uint8_t bus;
+  uint8_t data_len_code;
+  uint8_t tx;
+  uint8_t data[64];
+} safety_replay_msg_t;
+
+typedef struct {
+  uint8_t flags;
+  uint8_t disengage_reason;
+} safety_replay_verdict_t;
+
+typedef struct {
+  uint32_t rx_total;
+  uint32_t rx_invalid;
+  uint32_t tx_total;
+  uint32_t tx_blocked;
+  uint32_t tx_controls;
+  uint32_t tx_controls_lat;
+  uint32_t tx_controls_blocked;
+  uint32_t tx_controls_lat_blocked;
+  uint32_t mads_mismatch;
+  uint32_t ticks;
+  bool tick_rx_invalid;
+  bool ticked;
+  uint64_t last_tick;
+} safety_replay_stats_t;
+
+void safety_replay(const safety_replay_msg_t *msgs, uint32_t n, uint64_t tick_start, uint64_t tick_end,
+                   safety_replay_verdict_t *verdicts, safety_replay_stats_t *stats);
+""")
+
+# safety_replay_verdict_t flags
+SAFETY_REPLAY_ALLOWED = 1 << 0
+SAFETY_REPLAY_CONTROLS_ALLOWED = 1 << 1
+SAFETY_REPLAY_CONTROLS_ALLOWED_LAT = 1 << 2
+SAFETY_REPLAY_CONTROLS_REQUESTED_LAT = 1 << 3
+SAFETY_REPLAY_LAT_ACTIVE = 1 << 4
+SAFETY_REPLAY_ACC_MAIN_ON = 1 << 5
+SAFETY_REPLAY_MADS_ACC_MAIN = 1 << 6
+SAFETY_REPLAY_MADS_MISMATCH = 1 << 7
+
+# safety_replay_msg_t, packed without a cffi field access per message
+SAFETY_REPLAY_MSG = struct.Struct("<QIBBB64sx")
+
 setup_safety_helpers(ffi)
 
 class CANPacket:
@@ -67,16 +128,30 @@ class CANPacket:
 
 class Panda(PandaSafety, Protocol):
   # CAN
+  rx_q: Any
   tx1_q: Any
   tx2_q: Any
   tx3_q: Any
+  safety_tx_blocked: int
+  safety_rx_invalid: int
+  tx_buffer_overflow: int
+  rx_buffer_overflow: int
   def can_set_checksum(self, p: CANPacket) -> None: ...
+  def can_clear(self, q: Any) -> None: ...
+  def comms_can_read(self, data, max_len: int) -> int: ...
+  def comms_can_write(self, data, length: int) -> None: ...
+  def comms_can_reset(self) -> None: ...
+  def sim_can_tx_all(self, loopback: bool) -> None: ...
+
+  # telemetry
+  def get_telemetry_pkt(self, dat, health: bytes, can: bytes) -> int: ...
 
   # safety
   def safety_rx_hook(self, to_send: CANPacket) -> int: ...
   def safety_tx_hook(self, to_push: CANPacket) -> int: ...
   def safety_fwd_hook(self, bus_num: int, addr: int) -> int: ...
   def set_safety_hooks(self, mode: int, param: int) -> int: ...
+  def safety_replay(self, msgs, n: int, tick_start: int, tick_end: int, verdicts, stats) -> None: ...
 
 
 libpanda: Panda = ffi.dlopen(libpanda_fn)
@@ -94,3 +169,15 @@ def make_CANPacket(addr: int, bus: int, dat):
   libpanda.can_set_checksum(ret)
 
   return ret
+
+
+def make_safety_replay_msgs(msgs):
+  """
+    A safety_replay_msg_t array of (t, addr, bus, dat, tx), where t is in ns.
+  """
+  ret = ffi.new("safety_replay_msg_t[]", len(msgs))
+  buf = ffi.buffer(ret)
+  size = SAFETY_REPLAY_MSG.size
+  for i, (t, addr, bus, dat, tx) in enumerate(msgs):
+    SAFETY_REPLAY_MSG.pack_into(buf, i * size, t, addr, bus, LEN_TO_DLC[len(dat)], tx, bytes(dat))
+  return ret
@@ -26,6 +26,127 @@ can_ring *tx3_q = &can_tx3_q;
 
 #include "comms_definitions.h"
 #include "can_comms.h"
+#include "telemetry.h"
+
+// simulated panda: sends everything queued for TX at once, pushing the TX
+// receipt, and with loopback the message as received, to the RX queue
+void sim_can_tx_all(bool loopback) {
+  CANPacket_t to_send;
+  for (uint8_t bus = 0U; bus < PANDA_BUS_CNT; bus++) {
+    while (can_pop(can_queues[bus], &to_send)) {
+      to_send.returned = 1U;
+      can_set_checksum(&to_send);
+      rx_buffer_overflow += can_push(&can_rx_q, &to_send) ? 0U : 1U;
+      if (loopback) {
+        to_send.returned = 0U;
+        can_set_checksum(&to_send);
+        rx_buffer_overflow += can_push(&can_rx_q, &to_send) ? 0U : 1U;
+      }
+    }
+  }
+}
 
 // libpanda stuff
 #include "safety_helpers.h"
+
+// safety replay: runs a log's CAN messages through the safety hooks in one
+// call, instead of a hook call and a few getter calls per message from python
+typedef struct {
+  uint64_t t;  // log time, in ns
+  uint32_t addr;
+  uint8_t bus;
+  uint8_t data_len_code;
+  uint8_t tx;  // sent by openpilot, otherwise received
+  uint8_t data[64];
+} safety_replay_msg_t;
+
+#define SAFETY_REPLAY_ALLOWED (1U << 0)  // accepted by the RX or TX hook
+#define SAFETY_REPLAY_CONTROLS_ALLOWED (1U << 1)
+#define SAFETY_REPLAY_CONTROLS_ALLOWED_LAT (1U << 2)
+#define SAFETY_REPLAY_CONTROLS_REQUESTED_LAT (1U << 3)
+#define SAFETY_REPLAY_LAT_ACTIVE (1U << 4)
+#define SAFETY_REPLAY_ACC_MAIN_ON (1U << 5)
+#define SAFETY_REPLAY_MADS_ACC_MAIN (1U << 6)
+#define SAFETY_REPLAY_MADS_MISMATCH (1U << 7)  // TX with controls allowed, but not lateral controls
+
+// the state after each message
+typedef struct {
+  uint8_t flags;
+  uint8_t disengage_reason;
+} safety_replay_verdict_t;
+
+// accumulated over calls, so a route can be replayed in parts
+typedef struct {
+  uint32_t rx_total;
+  uint32_t rx_invalid;
+  uint32_t tx_total;
+  uint32_t tx_blocked;
+  uint32_t tx_controls;
+  uint32_t tx_controls_lat;
+  uint32_t tx_controls_blocked;
+  uint32_t tx_controls_lat_blocked;
+  uint32_t mads_mismatch;
+  uint32_t ticks;
+  bool tick_rx_invalid;
+  bool ticked;
+  uint64_t last_tick;
+} safety_replay_stats_t;
+
+// safety_tick runs at 1Hz like on the panda, between tick_start and tick_end
+void safety_replay(const safety_replay_msg_t *msgs, uint32_t n, uint64_t tick_start, uint64_t tick_end,
+                   safety_replay_verdict_t *verdicts, safety_replay_stats_t *stats) {
+  CANPacket_t pkt;
+  for (uint32_t i = 0U; i < n; i++) {
+    const safety_replay_msg_t *m = &msgs[i];
+    set_timer((m->t / 1000U) % 0xFFFFFFFFU);
+
+    if ((m->t > tick_start) && (m->t < tick_end) && (!stats->ticked || ((m->t - stats->last_tick) >= 1000000000U))) {
+      safety_tick(&current_safety_config);
+      stats->tick_rx_invalid |= !safety_config_valid();
+      stats->ticked = true;
+      stats->last_tick = m->t;
+      stats->ticks += 1U;
+    }
+
+    (void)memset(&pkt, 0, sizeof(pkt));
+    pkt.extended = (m->addr >= 0x800U) ? 1U : 0U;
+    pkt.addr = m->addr;
+    pkt.bus = m->bus;
+    pkt.data_len_code = m->data_len_code;
+    (void)memcpy(pkt.data, m->data, dlc_to_len[m->data_len_code]);
+    can_set_checksum(&pkt);
+
+    uint8_t flags = 0U;
+    if (m->tx != 0U) {
+      bool sent = safety_tx_hook(&pkt);
+      bool mismatch = get_controls_allowed() && !get_controls_allowed_lat();
+      flags |= sent ? SAFETY_REPLAY_ALLOWED : 0U;
+      flags |= mismatch ? SAFETY_REPLAY_MADS_MISMATCH : 0U;
+      stats->mads_mismatch += mismatch ? 1U : 0U;
+      if (!sent) {
+        stats->tx_blocked += 1U;
+        stats->tx_controls_blocked += get_controls_allowed() ? 1U : 0U;
+        stats->tx_controls_lat_blocked += get_controls_allowed_lat() ? 1U : 0U;
+      }
+      stats->tx_controls += get_controls_allowed() ? 1U : 0U;
+      stats->tx_controls_lat += get_controls_allowed_lat() ? 1U : 0U;
+      stats->tx_total += 1U;
+    } else {
+      bool valid = safety_rx_hook(&pkt);
+      flags |= valid ? SAFETY_REPLAY_ALLOWED : 0U;
+      stats->rx_invalid += valid ? 0U : 1U;
+      stats->rx_total += 1U;
+    }
+
+    if (verdicts != NULL) {
+      flags |= get_controls_allowed() ? SAFETY_REPLAY_CONTROLS_ALLOWED : 0U;
+      flags |= get_controls_allowed_lat() ? SAFETY_REPLAY_CONTROLS_ALLOWED_LAT : 0U;
+      flags |= get_controls_requested_lat() ? SAFETY_REPLAY_CONTROLS_REQUESTED_LAT : 0U;
+      flags |= get_lat_active() ? SAFETY_REPLAY_LAT_ACTIVE : 0U;
+      flags |= get_acc_main_on() ? SAFETY_REPLAY_ACC_MAIN_ON : 0U;
+      flags |= get_mads_acc_main() ? SAFETY_REPLAY_MADS_ACC_MAIN : 0U;
+      verdicts[i].flags = flags;
+      verdicts[i].disengage_reason = mads_get_current_disengage_reason();
+    }
+  }
+}
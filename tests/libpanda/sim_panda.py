@@ -0,0 +1,451 @@
+import binascii
+import hashlib
+import random
+import struct
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+
+from panda import Panda
+from panda.python import HealthRecord, CanHealthRecord, PANDA_BUS_CNT
+from panda.python.base import BaseHandle, TIMEOUT
+from panda.python.spi import SpiDevice, PandaSpiHandle, AckPoller, SpeedController, crc8, SYNC, HACK, DACK, NACK, CHECKSUM_START, \
+                             HEADER_STRUCT, SPI_MODE_SPIDEV
+from panda.python.utils import xor_checksum
+from panda.tests.libpanda import libpanda_py
+
+ffi = libpanda_py.ffi
+lpp = libpanda_py.libpanda
+
+SIM_UID = bytes(range(0x10, 0x1c))
+SIM_SERIAL = binascii.hexlify(SIM_UID).decode()
+SIM_HW_TYPE = Panda.HW_TYPE_RED_PANDA
+SIM_VERSION = b"DEV-sim-DEBUG"
+SIM_DONGLE_ID = b"0000000000000000"
+SIM_PROVISION = (SIM_DONGLE_ID + b"0000000000").ljust(0x1c, b"\x00")
+SIM_PROVISION += hashlib.sha1(SIM_PROVISION).digest()[:4]
+
+SAFETY_SILENT = 0  # opendbc's Safety.SAFETY_SILENT
+SAFETY_ALLOUTPUT = 17  # opendbc's Safety.SAFETY_ALLOUTPUT
+
+TX_QUEUES = (lpp.tx1_q, lpp.tx2_q, lpp.tx3_q)
+
+# what the firmware's SPI sends when it has nothing queued, see llspi_init
+SPI_UNDERRUN = 0xcd
+SPI_HEADER_SIZE = HEADER_STRUCT.size + 1
+# ControlPacket_t
+CONTROL_STRUCT = struct.Struct("<BHHH")
+# states of board/drivers/spi.h
+SPI_STATE_HEADER, SPI_STATE_HEADER_ACK, SPI_STATE_HEADER_NACK, SPI_STATE_DATA_RX, SPI_STATE_DATA_TX = range(5)
+
+
+class SimDevice:
+  """
+    A panda simulated on the firmware's CAN comms code in the libpanda host
+    build. CAN from the host goes through comms_can_write and the safety TX
+    hook into the TX rings, and is sent right away: every message comes back
+    as a TX receipt, and again as received with loopback on. There's no bus
+    timing, so the numbers measure the host side of the stack.
+
+    libpanda is a single firmware instance, so there's one device per process.
+  """
+
+  def __init__(self):
+    # the firmware state isn't thread-safe, and cffi calls drop the GIL
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self) -> None:
+    with self.lock:
+      self._start = time.monotonic()
+      self.loopback = False
+      self.power_save = 0
+      self.heartbeat_disabled = False
+      self.bus_config = [{"can_speed": 5000, "can_data_speed": 20000, "canfd_auto": False, "canfd_non_iso": False} for _ in range(PANDA_BUS_CNT)]
+
+      lpp.set_safety_hooks(SAFETY_SILENT, 0)
+      lpp.comms_can_reset()
+      lpp.can_clear(lpp.rx_q)
+      for q in TX_QUEUES:
+        lpp.can_clear(q)
+      lpp.safety_tx_blocked = 0
+      lpp.safety_rx_invalid = 0
+      lpp.tx_buffer_overflow = 0
+      lpp.rx_buffer_overflow = 0
+      self._rx_buf = ffi.new("uint8_t[]", 0x4000)
+
+  # *** CAN ***
+
+  def can_write(self, data) -> int:
+    with self.lock:
+      lpp.comms_can_write(ffi.from_buffer("uint8_t[]", data), len(data))
+      lpp.sim_can_tx_all(self.loopback)
+    return len(data)
+
+  def can_read(self, length: int) -> bytes:
+    with self.lock:
+      if len(self._rx_buf) < length:
+        self._rx_buf = ffi.new("uint8_t[]", length)
+      n = lpp.comms_can_read(self._rx_buf, length)
+      return bytes(ffi.buffer(self._rx_buf, n))
+
+  # *** control ***
+
+  def _health(self) -> bytes:
+    h = HealthRecord._make([0] * len(HealthRecord._fields))._replace(
+      uptime=int(time.monotonic() - self._start),
+      voltage=12000,
+      safety_tx_blocked=lpp.safety_tx_blocked,
+      safety_rx_invalid=lpp.safety_rx_invalid,
+      tx_buffer_overflow=lpp.tx_buffer_overflow,
+      rx_buffer_overflow=lpp.rx_buffer_overflow,
+      controls_allowed=int(lpp.get_controls_allowed()),
+      car_harness_status=Panda.HARNESS_STATUS_NORMAL,
+      safety_mode=lpp.get_current_safety_mode(),
+      safety_param=lpp.get_current_safety_param(),
+      power_save_enabled=self.power_save,
+    )
+    return bytes(Panda.HEALTH_STRUCT.pack(*h))
+
+  def _can_health(self, bus: int) -> bytes:
+    cfg = self.bus_config[bus]
+    h = CanHealthRecord._make([0] * len(CanHealthRecord._fields))._replace(
+      can_speed=cfg["can_speed"] // 10,
+      can_data_speed=cfg["can_data_speed"] // 10,
+      canfd_enabled=int(cfg["can_data_speed"] >= cfg["can_speed"]),
+      brs_enabled=int(cfg["can_data_speed"] > cfg["can_speed"]),
+      canfd_non_iso=int(cfg["canfd_non_iso"]),
+    )
+    return bytes(Panda.CAN_HEALTH_STRUCT.pack(*h))
+
+  def control(self, request: int, value: int, index: int, length: int = 0) -> bytes:
+    """
+      Handles a control transfer like board/main_comms.h. Unknown
+      requests are ignored, and return nothing.
+    """
+    ret = b""
+    if request == 0xc0:
+      with self.lock:
+        lpp.comms_can_reset()
+    elif request == 0xc1:
+      ret = SIM_HW_TYPE
+    elif request == 0xc2:
+      ret = self._can_health(value) if value < PANDA_BUS_CNT else b""
+    elif request == 0xc3:
+      ret = SIM_UID
+    elif request == 0xc7:
+      ret = b"".join(Panda.CAN_BUS_CONFIG_STRUCT.pack(c["can_speed"] // 10, c["can_data_speed"] // 10, c["canfd_auto"], c["canfd_non_iso"])
+                     for c in self.bus_config)
+    elif request == 0xc8:
+      with self.lock:
+        ret = Panda.TELEMETRY_HEADER_STRUCT.pack(Panda.TELEMETRY_PACKET_VERSION, Panda.HEALTH_PACKET_VERSION, Panda.CAN_HEALTH_PACKET_VERSION, PANDA_BUS_CNT)
+        ret += self._health() + b"".join(self._can_health(bus) for bus in range(PANDA_BUS_CNT))
+    elif request == 0xd0:
+      ret = SIM_SERIAL.encode()[:0x10] if value == 1 else SIM_PROVISION
+    elif request == 0xd2:
+      with self.lock:
+        ret = self._health()
+    elif request == 0xd6:
+      ret = SIM_VERSION
+    elif request in (0xd1, 0xd8):
+      self.reset()
+    elif request == 0xdc:
+      with self.lock:
+        lpp.set_safety_hooks(value, index)
+    elif request == 0xdd:
+      ret = bytes([Panda.HEALTH_PACKET_VERSION, Panda.CAN_PACKET_VERSION, Panda.CAN_HEALTH_PACKET_VERSION])
+    elif request == 0xde and value < PANDA_BUS_CNT:
+      self.bus_config[value]["can_speed"] = index
+    elif request == 0xe5:
+      self.loopback = value > 0
+    elif request == 0xe7:
+      self.power_save = value
+    elif request == 0xe8 and value < PANDA_BUS_CNT:
+      self.bus_config[value]["canfd_auto"] = index > 0
+    elif request == 0xf1:
+      with self.lock:
+        if value == 0xFFFF:
+          lpp.can_clear(lpp.rx_q)
+        elif value < PANDA_BUS_CNT:
+          lpp.can_clear(TX_QUEUES[value])
+    elif request == 0xf3:
+      # a heartbeat turns the checks back on
+      self.heartbeat_disabled = False
+    elif request == 0xf8:
+      self.heartbeat_disabled = True
+    elif request == 0xf9 and value < PANDA_BUS_CNT:
+      self.bus_config[value]["can_data_speed"] = index
+    elif request == 0xfc and value < PANDA_BUS_CNT:
+      self.bus_config[value]["canfd_non_iso"] = index > 0
+    return ret[:length]
+
+
+class SimHandle(BaseHandle):
+  """
+    A USB-like handle to a SimDevice.
+  """
+
+  def __init__(self, device: SimDevice | None = None):
+    self.device = SimDevice() if device is None else device
+
+  def close(self) -> None:
+    pass
+
+  def controlWrite(self, request_type: int, request: int, value: int, index: int, data, timeout: int = TIMEOUT, expect_disconnect: bool = False):
+    self.device.control(request, value, index)
+
+  def controlRead(self, request_type: int, request: int, value: int, index: int, length: int, timeout: int = TIMEOUT) -> bytes:
+    return self.device.control(request, value, index, length)
+
+  def bulkWrite(self, endpoint: int, data: bytes, timeout: int = TIMEOUT) -> int:
+    assert endpoint == 3, f"unexpected bulk OUT endpoint {endpoint}"
+    return self.device.can_write(data)
+
+  def bulkRead(self, endpoint: int, length: int, timeout: int = TIMEOUT) -> bytes:
+    assert endpoint == 1, f"unexpected bulk IN endpoint {endpoint}"
+    return self.device.can_read(length)
+
+
+@dataclass
+class SpiFaults:
+  """
+    Faults a SimSpi injects, as the chance per transfer of each. Faults
+    are only injected while the clock is at least min_speed_hz, like signal
+    integrity problems that go away at a lower clock.
+  """
+  nack: float = 0.  # the data is NACKed, like CAN TX when the firmware's not ready
+  bad_checksum: float = 0.  # a bit flips on MOSI, the firmware NACKs the bad checksum
+  bad_reply: float = 0.  # a bit flips in the reply on MISO
+  ack_delay: int = 0  # polls every ACK is late by
+  min_speed_hz: int = 0
+  seed: int | None = None
+
+
+class SimSpi:
+  """
+    A spidev.SpiDev wired to a SimDevice through the protocol state
+    machine of board/drivers/spi.h: header and data checksums, HACK, DACK
+    and NACK, and the VERSION handshake. Every call is one chip select,
+    and MISO gives the underrun byte while nothing is queued. Bytes
+    clocked after a reply are drained, like the firmware does when it
+    sets up the next RX.
+
+    The device answers instantly unless faults delay it, and there's no
+    wire time, so the numbers measure the host side of the protocol.
+  """
+
+  def __init__(self, device: SimDevice | None = None, faults: SpiFaults | None = None):
+    self.device = SimDevice() if device is None else device
+    self.faults = SpiFaults() if faults is None else faults
+    self.max_speed_hz = SpiDevice.MAX_SPEED
+    self._rng = random.Random(self.faults.seed)
+    # something to flock
+    self._file = tempfile.TemporaryFile()
+
+    self.checksum_errors = 0
+    self.injected = dict.fromkeys(("nack", "bad_checksum", "bad_reply", "ack_delay"), 0)
+    self.reset()
+
+  def reset(self) -> None:
+    self._state = SPI_STATE_HEADER
+    self._rx = bytearray()
+    self._rx_len = SPI_HEADER_SIZE
+    self._header = (0, 0, 0, 0)
+    self._tx = b""
+    self._tx_pos = 0
+    self._tx_delay = 0
+
+  def _inject(self, fault: str) -> bool:
+    rate = getattr(self.faults, fault)
+    if rate <= 0 or self.max_speed_hz < self.faults.min_speed_hz or (rate < 1 and self._rng.random() >= rate):
+      return False
+    self.injected[fault] += 1
+    return True
+
+  def _flip_bit(self, data: bytearray, start: int = 0) -> None:
+    data[self._rng.randrange(start, len(data))] ^= 1 << self._rng.randrange(8)
+
+  def _version(self) -> bytes:
+    data = SIM_UID + bytes(SIM_HW_TYPE) + bytes([0xcc, PandaSpiHandle.PROTOCOL_VERSION])
+    ret = b"VERSION" + len(data).to_bytes(2, "little") + data
+    return ret + bytes([crc8(ret)])
+
+  def _handle(self, endpoint: int, data: bytes, max_rx_len: int) -> bytes | None:
+    """
+      Runs the data of a transfer, returns the reply or None to NACK it.
+    """
+    if endpoint == 0:
+      if len(data) < CONTROL_STRUCT.size:
+        return None
+      request, value, index, length = CONTROL_STRUCT.unpack(data[:CONTROL_STRUCT.size])
+      ret = self.device.control(request, value, index, length)
+      if request in (0xd1, 0xd8):
+        # the panda reboots
+        self.reset()
+        return None
+      return ret
+    elif endpoint in (1, 0x81):
+      return self.device.can_read(max_rx_len) if len(data) == 0 else None
+    elif endpoint == 2:
+      return b""
+    elif endpoint == 3:
+      if len(data) == 0:
+        return None
+      self.device.can_write(data)
+      return b""
+    elif endpoint == 0xab:
+      return bytes(max_rx_len)
+    return None
+
+  def _rx_done(self) -> None:
+    rx = self._rx
+    if rx[:7] == b"VERSION":
+      self._send(self._version(), SPI_STATE_HEADER_NACK)
+    elif self._state == SPI_STATE_HEADER:
+      if rx[0] == SYNC and xor_checksum(rx, CHECKSUM_START) == 0:
+        self._header = HEADER_STRUCT.unpack(rx[:HEADER_STRUCT.size])
+        self._send(bytes([HACK]), SPI_STATE_HEADER_ACK, self.faults.ack_delay)
+      else:
+        self.checksum_errors += 1
+        self._send(bytes([NACK]), SPI_STATE_HEADER_NACK)
+    elif self._state == SPI_STATE_DATA_RX:
+      _, endpoint, tx_len, max_rx_len = self._header
+      if self._inject("bad_checksum"):
+        self._flip_bit(rx)
+      reply = None
+      if xor_checksum(rx, CHECKSUM_START) != 0:
+        self.checksum_errors += 1
+      elif not self._inject("nack"):
+        reply = self._handle(endpoint, bytes(rx[:tx_len]), max_rx_len)
+
+      if self._state != SPI_STATE_DATA_RX:
+        # reset while handling
+        return
+      if reply is None:
+        self._send(bytes([NACK]), SPI_STATE_HEADER_NACK)
+      else:
+        pkt = bytearray([DACK, *len(reply).to_bytes(2, "little"), *reply])
+        pkt.append(xor_checksum(pkt, CHECKSUM_START))
+        if self._inject("bad_reply"):
+          self._flip_bit(pkt, 3)
+        self._send(bytes(pkt), SPI_STATE_DATA_TX, self.faults.ack_delay)
+
+  def _send(self, tx: bytes, state: int, delay: int = 0) -> None:
+    self._tx = tx
+    self._tx_pos = 0
+    self._state = state
+    if delay > 0 and self.max_speed_hz >= self.faults.min_speed_hz:
+      self.injected["ack_delay"] += 1
+      self._tx_delay = delay
+
+  def _tx_done(self) -> None:
+    self._tx = b""
+    self._rx = bytearray()
+    if self._state == SPI_STATE_HEADER_ACK:
+      self._state = SPI_STATE_DATA_RX
+      self._rx_len = self._header[2] + 1
+    else:
+      self._state = SPI_STATE_HEADER
+      self._rx_len = SPI_HEADER_SIZE
+
+  def _clock(self, mosi: bytes) -> bytes:
+    """
+      One chip select, clocks in mosi and returns what came out on MISO.
+    """
+    miso = bytearray([SPI_UNDERRUN]) * len(mosi)
+    if len(self._tx) > 0:
+      if self._tx_delay > 0:
+        self._tx_delay -= 1
+        return bytes(miso)
+      n = min(len(mosi), len(self._tx) - self._tx_pos)
+      miso[:n] = self._tx[self._tx_pos:self._tx_pos + n]
+      self._tx_pos += n
+      if self._tx_pos == len(self._tx):
+        self._tx_done()
+    else:
+      n = min(len(mosi), self._rx_len - len(self._rx))
+      self._rx += mosi[:n]
+      if len(self._rx) == self._rx_len:
+        self._rx_done()
+    return bytes(miso)
+
+  # *** spidev.SpiDev ***
+
+  def fileno(self) -> int:
+    return self._file.fileno()
+
+  def writebytes(self, data) -> None:
+    self._clock(bytes(data))
+
+  def writebytes2(self, data) -> None:
+    self._clock(bytes(data))
+
+  def xfer(self, data) -> list[int]:
+    return list(self._clock(bytes(data)))
+
+  def xfer2(self, data) -> list[int]:
+    return list(self._clock(bytes(data)))
+
+  def readbytes(self, length: int) -> list[int]:
+    return list(self._clock(bytes(length)))
+
+  def readinto(self, view) -> int:
+    view[:] = self._clock(bytes(len(view)))
+    return len(view)
+
+  def close(self) -> None:
+    self._file.close()
+
+
+class SimSpiDevice(SpiDevice):
+  """
+    A SpiDevice on a SimSpi. It's locked like the real one, so handles
+    and threads sharing a SimSpi contend for it the same way.
+  """
+
+  def __init__(self, spi: SimSpi, speed: int = SpiDevice.MAX_SPEED):
+    self._spidev = spi
+    self.set_speed(speed)
+
+  def set_speed(self, speed: int) -> None:
+    assert speed <= self.MAX_SPEED
+    self._spidev.max_speed_hz = speed
+    self.speed = speed
+
+
+def sim_spi_handle(spi: SimSpi | None = None, ack_poller: AckPoller | None = None, speed_controller: SpeedController | None = None) -> PandaSpiHandle:
+  """
+    A PandaSpiHandle on a SimSpi, over spidev, since there's no kernel driver to simulate.
+  """
+  return PandaSpiHandle(SimSpiDevice(SimSpi() if spi is None else spi), SPI_MODE_SPIDEV, ack_poller, speed_controller)
+
+
+class SimPanda(Panda):
+  """
+    A Panda connected to a simulated device, so the whole library can be
+    run, benchmarked and profiled without hardware. It's connected like
+    over USB, unless it's given a handle from sim_spi_handle.
+
+      p = SimPanda()
+      p.set_safety_mode(SAFETY_ALLOUTPUT)
+      p.set_can_loopback(True)
+
+      p = SimPanda(sim_spi_handle(SimSpi(faults=SpiFaults(nack=0.01))))
+  """
+
+  def __init__(self, handle: BaseHandle | None = None, **kwargs):
+    self._sim_handle = SimHandle() if handle is None else handle
+    super().__init__(SIM_SERIAL, cli=False, **kwargs)
+
+  def usb_connect(self, serial, claim=True, no_error=False, context=None):
+    if isinstance(self._sim_handle, PandaSpiHandle):
+      return None, None, None, False, None
+    return None, self._sim_handle, SIM_SERIAL, False, None
+
+  def spi_connect(self, serial, ignore_version=False):
+    if not isinstance(self._sim_handle, PandaSpiHandle):
+      return None, None, None, False, None
+    # identified by the VERSION handshake, like a real panda
+    dat = self._sim_handle.get_protocol_version()
+    return None, self._sim_handle, binascii.hexlify(dat[:12]).decode(), dat[13] == 0xee, None
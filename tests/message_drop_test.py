@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import os
-import usb1
 import time
 import struct
 import itertools
@@ -22,15 +21,11 @@ tx_messages = list(itertools.chain.from_iterable([[0xaa, msg, 0], [0xaa, msg, 1]
 def flood_tx(panda):
   print('Sending!')
   transferred = 0
-  while True:
-    try:
-      print(f"Sending block {transferred}-{len(tx_messages)}: ", end="")
-      panda.can_send_many(tx_messages[transferred:], timeout=10)
-      print("OK")
-      break
-    except usb1.USBErrorTimeout as e:
-      transferred += (e.transferred // 16)
-      print("timeout, transferred: ", transferred)
+  while transferred < len(tx_messages):
+    print(f"Sending block {transferred}-{len(tx_messages)}: ", end="")
+    sent = panda.can_send_many(tx_messages[transferred:], timeout=10, pipeline_depth=4)
+    transferred += sent
+    print("OK" if transferred == len(tx_messages) else f"timeout, transferred: {transferred}")
 
   print(f"Done sending {3*NUM_MESSAGES_PER_BUS} messages!")
 
@@ -3,25 +3,60 @@ import argparse
 import os
 from collections import Counter, defaultdict
 
+import numpy as np
+
 from opendbc.safety import ALTERNATIVE_EXPERIENCE
 from panda.tests.libpanda import libpanda_py
-from panda.tests.safety_replay.helpers import package_can_msg, init_segment
+from panda.tests.libpanda.libpanda_py import SAFETY_REPLAY_ALLOWED, SAFETY_REPLAY_CONTROLS_ALLOWED, SAFETY_REPLAY_CONTROLS_ALLOWED_LAT, \
+                                             SAFETY_REPLAY_CONTROLS_REQUESTED_LAT, SAFETY_REPLAY_LAT_ACTIVE, SAFETY_REPLAY_ACC_MAIN_ON, \
+                                             SAFETY_REPLAY_MADS_ACC_MAIN, SAFETY_REPLAY_MADS_MISMATCH
+from panda.tests.safety_replay.helpers import init_segment
+
+# messages replayed per safety_replay call
+REPLAY_PART_SIZE = 100000
 
-# Define debug variables and their getter methods
+# Define debug variables and how they're read from a message's verdict
 DEBUG_VARS = {
-  'lat_active': lambda safety: safety.get_lat_active(),
-  'controls_allowed': lambda safety: safety.get_controls_allowed(),
-  'controls_requested_lat': lambda safety: safety.get_controls_requested_lat(),
-  'controls_allowed_lat': lambda safety: safety.get_controls_allowed_lat(),
-  'current_disengage_reason': lambda safety: safety.mads_get_current_disengage_reason(),
-  'stock_acc_main': lambda safety: safety.get_acc_main_on(),
-  'mads_acc_main': lambda safety: safety.get_mads_acc_main(),
+  'lat_active': lambda v: bool(v.flags & SAFETY_REPLAY_LAT_ACTIVE),
+  'controls_allowed': lambda v: bool(v.flags & SAFETY_REPLAY_CONTROLS_ALLOWED),
+  'controls_requested_lat': lambda v: bool(v.flags & SAFETY_REPLAY_CONTROLS_REQUESTED_LAT),
+  'controls_allowed_lat': lambda v: bool(v.flags & SAFETY_REPLAY_CONTROLS_ALLOWED_LAT),
+  'current_disengage_reason': lambda v: v.disengage_reason,
+  'stock_acc_main': lambda v: bool(v.flags & SAFETY_REPLAY_ACC_MAIN_ON),
+  'mads_acc_main': lambda v: bool(v.flags & SAFETY_REPLAY_MADS_ACC_MAIN),
 }
 
 
+def replay_msgs(can_msgs):
+  """
+    The (t, addr, bus, dat, tx) of every message to replay, in log order.
+  """
+  for msg in can_msgs:
+    if msg.which() == 'sendcan':
+      for canmsg in msg.sendcan:
+        yield msg.logMonoTime, canmsg.address, canmsg.src % 4, canmsg.dat, 1
+    else:
+      # ignore msgs we sent
+      for canmsg in msg.can:
+        if canmsg.src < 128:
+          yield msg.logMonoTime, canmsg.address, canmsg.src % 4, canmsg.dat, 0
+
+
+def parts(it, size):
+  part = []
+  for x in it:
+    part.append(x)
+    if len(part) == size:
+      yield part
+      part = []
+  if len(part) > 0:
+    yield part
+
+
 # replay a drive to check for safety violations
 def replay_drive(lr, safety_mode, param, alternative_experience, segment=False):
   safety = libpanda_py.libpanda
+  ffi = libpanda_py.ffi
 
   err = safety.set_safety_hooks(safety_mode, param)
   assert err == 0, "invalid safety mode: %d" % safety_mode
@@ -38,8 +73,8 @@ def replay_drive(lr, safety_mode, param, alternative_experience, segment=False):
     init_segment(safety, lr, safety_mode, param)
     lr.reset()
 
-  rx_tot, rx_invalid, tx_tot, tx_blocked, tx_controls, tx_controls_lat, tx_controls_blocked, tx_controls_lat_blocked, mads_mismatch = 0, 0, 0, 0, 0, 0, 0, 0, 0
-  safety_tick_rx_invalid = False
+  stats = ffi.new("safety_replay_stats_t *")
+  mads_mismatch = 0
   blocked_addrs = Counter()
   invalid_addrs = set()
 
@@ -52,83 +87,68 @@ def replay_drive(lr, safety_mode, param, alternative_experience, segment=False):
   can_msgs = [m for m in lr if m.which() in ('can', 'sendcan')]
   start_t = can_msgs[0].logMonoTime
   end_t = can_msgs[-1].logMonoTime
-  for msg in can_msgs:
-    safety.set_timer((msg.logMonoTime // 1000) % 0xFFFFFFFF)
-
-    # skip start and end of route, warm up/down period
-    if msg.logMonoTime - start_t > 1e9 and end_t - msg.logMonoTime > 1e9:
-      safety.safety_tick_current_safety_config()
-      safety_tick_rx_invalid |= not safety.safety_config_valid() or safety_tick_rx_invalid
 
-    if msg.which() == 'sendcan':
-      for canmsg in msg.sendcan:
-        to_send = package_can_msg(canmsg)
-        sent = safety.safety_tx_hook(to_send)
-
-        # mismatched
-        if (safety.get_controls_allowed() and not safety.get_controls_allowed_lat()):
-          mads_mismatch += 1
-          print(f"controls allowed but not controls allowed lat [{mads_mismatch}]")
-          print(f"msg:{canmsg.address} ({hex(canmsg.address)})")
+  # the whole part runs in C, with safety_tick at 1Hz after the warm up and before the warm down
+  for part in parts(replay_msgs(can_msgs), REPLAY_PART_SIZE):
+    verdicts = ffi.new("safety_replay_verdict_t[]", len(part))
+    safety.safety_replay(libpanda_py.make_safety_replay_msgs(part), len(part), start_t + int(1e9), end_t - int(1e9), verdicts, stats)
+
+    flags = np.frombuffer(ffi.buffer(verdicts), dtype=np.uint8)[0::2]
+    for i in np.flatnonzero(flags & SAFETY_REPLAY_MADS_MISMATCH):
+      mads_mismatch += 1
+      print(f"controls allowed but not controls allowed lat [{mads_mismatch}]")
+      print(f"msg:{part[i][1]} ({hex(part[i][1])})")
+      for var, getter in DEBUG_VARS.items():
+        print(f"  {var}: {getter(verdicts[i])}")
+
+    for i in np.flatnonzero((flags & SAFETY_REPLAY_ALLOWED) == 0):
+      _, addr, _, _, tx = part[i]
+      if tx:
+        blocked_addrs[addr] += 1
+      else:
+        invalid_addrs.add(addr)
+
+    if "DEBUG" in os.environ:
+      for i, (t, addr, bus, _, tx) in enumerate(part):
+        if not tx:
+          continue
+        if not verdicts[i].flags & SAFETY_REPLAY_ALLOWED:
+          last_good = last_good_states[addr]
+          print(f"\nBlocked message at {(t - start_t) / 1e9:.3f}s:")
+          print(f"Address: {hex(addr)} (bus {bus})")
+          print("Current state:")
           for var, getter in DEBUG_VARS.items():
-            print(f"  {var}: {getter(safety)}")
-
-        if not sent:
-          tx_blocked += 1
-          tx_controls_blocked += safety.get_controls_allowed()
-          tx_controls_lat_blocked += safety.get_controls_allowed_lat()
-          blocked_addrs[canmsg.address] += 1
-
-          if "DEBUG" in os.environ:
-            last_good = last_good_states[canmsg.address]
-            print(f"\nBlocked message at {(msg.logMonoTime - start_t) / 1e9:.3f}s:")
-            print(f"Address: {hex(canmsg.address)} (bus {canmsg.src})")
-            print("Current state:")
-            for var, getter in DEBUG_VARS.items():
-              print(f"  {var}: {getter(safety)}")
-
-            if last_good['timestamp'] is not None:
-              print(f"\nLast good state ({last_good['timestamp']:.3f}s):")
-              for var in DEBUG_VARS:
-                print(f"  {var}: {last_good[var]}")
-            else:
-              print("\nNo previous good state found for this address")
-            print("-" * 80)
+            print(f"  {var}: {getter(verdicts[i])}")
+
+          if last_good['timestamp'] is not None:
+            print(f"\nLast good state ({last_good['timestamp']:.3f}s):")
+            for var in DEBUG_VARS:
+              print(f"  {var}: {last_good[var]}")
+          else:
+            print("\nNo previous good state found for this address")
+          print("-" * 80)
         else:  # Update last good state if message is allowed
-          last_good_states[canmsg.address].update({
-            'timestamp': (msg.logMonoTime - start_t) / 1e9,
-            **{var: getter(safety) for var, getter in DEBUG_VARS.items()}
+          last_good_states[addr].update({
+            'timestamp': (t - start_t) / 1e9,
+            **{var: getter(verdicts[i]) for var, getter in DEBUG_VARS.items()}
           })
 
-        tx_controls += safety.get_controls_allowed()
-        tx_controls_lat += safety.get_controls_allowed_lat()
-        tx_tot += 1
-    elif msg.which() == 'can':
-      # ignore msgs we sent
-      for canmsg in filter(lambda m: m.src < 128, msg.can):
-        to_push = package_can_msg(canmsg)
-        recv = safety.safety_rx_hook(to_push)
-        if not recv:
-          rx_invalid += 1
-          invalid_addrs.add(canmsg.address)
-        rx_tot += 1
-
   print("\nRX")
-  print("total rx msgs:", rx_tot)
-  print("invalid rx msgs:", rx_invalid)
-  print("safety tick rx invalid:", safety_tick_rx_invalid)
+  print("total rx msgs:", stats.rx_total)
+  print("invalid rx msgs:", stats.rx_invalid)
+  print("safety tick rx invalid:", stats.tick_rx_invalid)
   print("invalid addrs:", invalid_addrs)
   print("\nTX")
-  print("total openpilot msgs:", tx_tot)
-  print("total msgs with controls allowed:", tx_controls)
-  print("total msgs with controls_lat allowed:", tx_controls_lat)
-  print("blocked msgs:", tx_blocked)
-  print("blocked with controls allowed:", tx_controls_blocked)
-  print("blocked with controls_lat allowed:", tx_controls_lat_blocked)
+  print("total openpilot msgs:", stats.tx_total)
+  print("total msgs with controls allowed:", stats.tx_controls)
+  print("total msgs with controls_lat allowed:", stats.tx_controls_lat)
+  print("blocked msgs:", stats.tx_blocked)
+  print("blocked with controls allowed:", stats.tx_controls_blocked)
+  print("blocked with controls_lat allowed:", stats.tx_controls_lat_blocked)
   print("blocked addrs:", blocked_addrs)
   print("mads enabled:", safety.get_enable_mads())
 
-  return tx_controls_blocked == 0 and tx_controls_lat_blocked == 0 and rx_invalid == 0 and not safety_tick_rx_invalid
+  return stats.tx_controls_blocked == 0 and stats.tx_controls_lat_blocked == 0 and stats.rx_invalid == 0 and not stats.tick_rx_invalid
 
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import random
+import unittest
+
+from panda.tests.libpanda import libpanda_py
+from panda.tests.libpanda.libpanda_py import SAFETY_REPLAY_ALLOWED, SAFETY_REPLAY_CONTROLS_ALLOWED, SAFETY_REPLAY_CONTROLS_ALLOWED_LAT
+
+ffi = libpanda_py.ffi
+lpp = libpanda_py.libpanda
+
+SAFETY_SILENT = 0  # opendbc's Safety.SAFETY_SILENT
+SAFETY_ALLOUTPUT = 17  # opendbc's Safety.SAFETY_ALLOUTPUT
+
+
+def random_msgs(n, duration_s=10):
+  ts = sorted(random.randrange(int(duration_s * 1e9)) for _ in range(n))
+  return [(t, random.randint(1, 0x7ff), random.randrange(3), random.randbytes(random.randint(0, 8)), random.randrange(2)) for t in ts]
+
+
+def replay_reference(msgs, tick_start, tick_end):
+  """
+    The replay with a hook call per message, like replay_drive did.
+  """
+  verdicts, last_tick, ticks, tick_rx_invalid = [], None, 0, False
+  for t, addr, bus, dat, tx in msgs:
+    lpp.set_timer((t // 1000) % 0xFFFFFFFF)
+    if tick_start < t < tick_end and (last_tick is None or t - last_tick >= 1e9):
+      lpp.safety_tick_current_safety_config()
+      tick_rx_invalid |= not lpp.safety_config_valid()
+      last_tick = t
+      ticks += 1
+
+    pkt = libpanda_py.make_CANPacket(addr, bus, dat)
+    allowed = lpp.safety_tx_hook(pkt) if tx else lpp.safety_rx_hook(pkt)
+    verdicts.append((allowed, lpp.get_controls_allowed(), lpp.get_controls_allowed_lat()))
+  return verdicts, ticks, tick_rx_invalid
+
+
+class TestSafetyReplay(unittest.TestCase):
+  def setUp(self):
+    lpp.init_tests()
+
+  def replay(self, msgs, tick_start, tick_end, parts=1):
+    verdicts = ffi.new("safety_replay_verdict_t[]", len(msgs))
+    stats = ffi.new("safety_replay_stats_t *")
+    step = -(-len(msgs) // parts)
+    for i in range(0, len(msgs), step):
+      part = msgs[i:i + step]
+      lpp.safety_replay(libpanda_py.make_safety_replay_msgs(part), len(part), tick_start, tick_end, verdicts + i, stats)
+    return [(bool(v.flags & SAFETY_REPLAY_ALLOWED), bool(v.flags & SAFETY_REPLAY_CONTROLS_ALLOWED),
+             bool(v.flags & SAFETY_REPLAY_CONTROLS_ALLOWED_LAT)) for v in verdicts], stats[0]
+
+  def test_matches_reference(self):
+    msgs = random_msgs(2000)
+    tick_start, tick_end = int(1e9), int(9e9)
+    for mode in (SAFETY_SILENT, SAFETY_ALLOUTPUT):
+      for parts in (1, 7):
+        with self.subTest(mode=mode, parts=parts):
+          lpp.set_safety_hooks(mode, 0)
+          expected, ticks, tick_rx_invalid = replay_reference(msgs, tick_start, tick_end)
+          lpp.set_safety_hooks(mode, 0)
+          verdicts, stats = self.replay(msgs, tick_start, tick_end, parts)
+
+          self.assertEqual(verdicts, expected)
+          self.assertEqual(stats.ticks, ticks)
+          self.assertEqual(stats.tick_rx_invalid, tick_rx_invalid)
+
+          n_tx = sum(m[4] for m in msgs)
+          self.assertEqual((stats.tx_total, stats.rx_total), (n_tx, len(msgs) - n_tx))
+          self.assertEqual(stats.tx_blocked, sum(1 for m, v in zip(msgs, verdicts, strict=True) if m[4] and not v[0]))
+          self.assertEqual(stats.rx_invalid, sum(1 for m, v in zip(msgs, verdicts, strict=True) if not m[4] and not v[0]))
+
+  def test_tick_rate(self):
+    # a message every 10ms for 10s, ticks once a second inside the window
+    msgs = [(int(i * 1e7), 0x100, 0, b"", 0) for i in range(1000)]
+    lpp.set_safety_hooks(SAFETY_SILENT, 0)
+    _, stats = self.replay(msgs, int(1e9), int(9e9))
+    self.assertEqual(stats.ticks, 8)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+import os
+import select
+import asyncio
+import unittest
+
+from panda import Panda
+import usb1
+
+from panda.python import tracing
+from panda.python.asyncpanda import AsyncPanda, UsbEventLoopWatcher
+from panda.python.usb import PandaUsbHandle
+from panda.tests.libpanda.sim_panda import SimPanda, sim_spi_handle, SAFETY_ALLOUTPUT
+from panda.tests.usbprotocol.test_sim_panda import random_msgs
+
+
+class PipeContext:
+  """
+    Stands in for a usb1.USBContext whose only event source is a pipe.
+  """
+  def __init__(self):
+    self.r, self.w = os.pipe()
+    os.set_blocking(self.r, False)
+    self.handled = 0
+    self.next_timeout = None
+    self.notifiers = None
+
+  def getPollFDList(self):
+    return [(self.r, select.POLLIN)]
+
+  def setPollFDNotifiers(self, added_cb=None, removed_cb=None):
+    self.notifiers = (added_cb, removed_cb)
+
+  def getNextTimeout(self):
+    return self.next_timeout
+
+  def handleEventsTimeout(self, tv=0):
+    self.handled += 1
+    try:
+      os.read(self.r, 1)
+    except BlockingIOError:
+      pass
+
+  def close(self):
+    os.close(self.r)
+    os.close(self.w)
+
+
+class TestUsbEventLoopWatcher(unittest.TestCase):
+  def test_events_from_fd(self):
+    async def run():
+      context = PipeContext()
+      watcher = UsbEventLoopWatcher(asyncio.get_running_loop(), context)
+
+      # an event on libusb's fd gets handled on the loop
+      for i in range(3):
+        os.write(context.w, b'\x00')
+        await asyncio.sleep(0.01)
+        self.assertEqual(context.handled, i + 1)
+
+      # libusb timeouts without an fd
+      context.next_timeout = 0.01
+      watcher.schedule_timeout()
+      context.next_timeout = None
+      await asyncio.sleep(0.05)
+      self.assertEqual(context.handled, 4)
+
+      watcher.close()
+      self.assertEqual(context.notifiers, (None, None))
+      os.write(context.w, b'\x00')
+      await asyncio.sleep(0.01)
+      self.assertEqual(context.handled, 4)
+      context.close()
+
+    asyncio.run(run())
+
+  def test_fd_notifiers(self):
+    async def run():
+      context = PipeContext()
+      watcher = UsbEventLoopWatcher(asyncio.get_running_loop(), context)
+      added, removed = context.notifiers
+
+      r, w = os.pipe()
+      added(r, select.POLLIN, None)
+      await asyncio.sleep(0)
+      self.assertIn(r, watcher._fds)
+      removed(r, None)
+      await asyncio.sleep(0)
+      self.assertNotIn(r, watcher._fds)
+
+      watcher.close()
+      for fd in (r, w):
+        os.close(fd)
+      context.close()
+
+    asyncio.run(run())
+
+
+class FakeTransfer:
+  """
+    An async libusb transfer that completes as soon as it's submitted,
+    with respond(endpoint, data or length) as (status, data).
+  """
+  def __init__(self, respond):
+    self.respond = respond
+    self.submitted = False
+
+  def setControl(self, request_type, request, value, index, buffer_or_len, callback=None, timeout=0):
+    self.type = usb1.TRANSFER_TYPE_CONTROL
+    self.endpoint = request_type & usb1.ENDPOINT_IN
+    self.request = (request, buffer_or_len)
+    self.callback = callback
+
+  def setBulk(self, endpoint, buffer_or_len, callback=None, timeout=0):
+    self.type = usb1.TRANSFER_TYPE_BULK
+    self.endpoint = endpoint
+    self.request = (endpoint & 0x7f, buffer_or_len)
+    self.callback = callback
+
+  def submit(self):
+    self.status, self.data = self.respond(*self.request)
+    self.buffer = bytes(usb1.CONTROL_SETUP_SIZE if self.type == usb1.TRANSFER_TYPE_CONTROL else 0) + self.data
+    self.callback(self)
+
+  def isSubmitted(self):
+    return self.submitted
+
+  def getStatus(self):
+    return self.status
+
+  def getActualLength(self):
+    return len(self.data)
+
+  def getType(self):
+    return self.type
+
+  def getEndpoint(self):
+    return self.endpoint
+
+  def getBuffer(self):
+    return self.buffer
+
+  def doom(self):
+    pass
+
+
+class FakeLibusbHandle:
+  def __init__(self, respond=None):
+    self.closed = False
+    self.respond = respond
+
+  def getTransfer(self):
+    return FakeTransfer(self.respond)
+
+  def close(self):
+    self.closed = True
+
+
+class TestAsyncPanda(unittest.TestCase):
+  def run_sim(self, handle=None):
+    async def run():
+      async with AsyncPanda(SimPanda(handle)) as ap:
+        # the sim isn't a libusb device, neither is SPI
+        self.assertFalse(ap.is_async_usb)
+        self.assertEqual((await ap.health())["voltage"], 12000)
+        self.assertEqual((await ap.telemetry()).health.voltage, 12000)
+        self.assertEqual((await ap.can_health(0))["can_speed"], 500)
+
+        await ap.control_write(Panda.REQUEST_OUT, 0xdc, SAFETY_ALLOUTPUT, 0, b'')
+        await ap.control_write(Panda.REQUEST_OUT, 0xe5, 1, 0, b'')
+        msgs = random_msgs(100)
+        self.assertEqual(await ap.can_send_many(msgs), len(msgs))
+        rx = []
+        while len(r := await ap.can_recv()) > 0:
+          rx += r
+        self.assertEqual(sorted(m for m in rx if m[2] < 128), sorted(msgs))
+
+        await ap.can_send(0x100, b"\x01", 0)
+        await ap.can_clear(0xFFFF)
+        self.assertEqual(await ap.can_recv(), [])
+        return ap
+
+    ap = asyncio.run(run())
+    self.assertFalse(ap.panda.connected)
+
+  def test_sim_usb(self):
+    self.run_sim()
+
+  def test_sim_spi(self):
+    self.run_sim(sim_spi_handle())
+
+  def test_lazy(self):
+    async def run():
+      ap = AsyncPanda(SimPanda(lazy=True))
+      self.assertTrue(ap.panda._config_pending)
+      await ap.can_send_many([])
+      self.assertFalse(ap.panda._config_pending)
+      await ap.close()
+
+    asyncio.run(run())
+
+  def test_close_unregisters_fds(self):
+    async def run():
+      context = PipeContext()
+      p = SimPanda()
+      p.close()
+      p._handle = PandaUsbHandle(FakeLibusbHandle(), context)
+      p._handle_open = True
+
+      loop = asyncio.get_running_loop()
+      ap = AsyncPanda(p)
+      self.assertTrue(ap.is_async_usb)
+      self.assertIsNotNone(context.notifiers[0])
+
+      await ap.close()
+      self.assertFalse(ap.is_async_usb)
+      self.assertEqual(context.notifiers, (None, None))
+      # nothing is watching the fd anymore
+      self.assertFalse(loop.remove_reader(context.r))
+      self.assertTrue(p._handle.libusb_handle.closed)
+      context.close()
+
+    asyncio.run(run())
+
+  def test_stats_and_tracing(self):
+    def respond(code, dat):
+      # reads get zeros, endpoint 1 is stalled
+      return (usb1.TRANSFER_STALL, b"") if code == 1 else (usb1.TRANSFER_COMPLETED, bytes(dat))
+
+    async def run():
+      context = PipeContext()
+      p = SimPanda()
+      p.close()
+      p._handle = PandaUsbHandle(FakeLibusbHandle(respond), context)
+      p._handle_open = True
+      p.enable_stats()
+
+      ap = AsyncPanda(p)
+      self.assertTrue(ap.is_async_usb)
+      tracer = tracing.start_tracing()
+      try:
+        self.assertEqual(len(await ap.control_read(Panda.REQUEST_IN, 0xd2, 0, 0, 64)), 64)
+        self.assertEqual(await ap.bulk_write(3, b"\x00" * 10), 10)
+        with self.assertRaises(usb1.USBErrorPipe):
+          await ap.bulk_read(1, 16384)
+      finally:
+        tracing.stop_tracing()
+      await ap.close()
+      context.close()
+      return p.stats(), tracer
+
+    stats, tracer = asyncio.run(run())
+    self.assertEqual((stats[("control_read", 0xd2)].calls, stats[("control_read", 0xd2)].bytes), (1, 64))
+    self.assertEqual((stats[("bulk_write", 3)].calls, stats[("bulk_write", 3)].bytes), (1, 10))
+    self.assertEqual((stats[("bulk_read", 1)].calls, stats[("bulk_read", 1)].errors), (1, 1))
+
+    events = [(e["name"], e["args"]["code"]) for e in tracer.events if e["cat"] == "usb"]
+    self.assertEqual(events, [("controlRead", "0xd2"), ("bulkWrite", "0x3"), ("bulkRead", "0x1")])
+    self.assertTrue(all(e["args"]["async"] for e in tracer.events if e["cat"] == "usb"))
+
+
+if __name__ == '__main__':
+  unittest.main()
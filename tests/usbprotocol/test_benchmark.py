@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+import unittest
+
+from panda.tests import codec_benchmark
+from panda.tests.benchmark import SCENARIOS, Target, run, compare
+
+
+class TestBenchmark(unittest.TestCase):
+  def test_sim(self):
+    for target in ("sim", "sim-spi"):
+      results = run(Target(target), ["health", "can_send_many_100", "can_recv_drain", "isotp_round_trip", "flash"], scale=0.01)
+      self.assertEqual(results["meta"]["target"], target)
+      # flash only runs on hardware
+      self.assertEqual(set(results["results"]), {"health", "can_send_many_100", "can_recv_drain", "isotp_round_trip"})
+
+      r = results["results"]["can_recv_drain"]
+      self.assertEqual(r["items"], 2 * 1000)
+      self.assertGreater(r["throughput"], 0)
+      self.assertLessEqual(r["p50_us"], r["p99_us"])
+
+  def test_default_scenarios(self):
+    results = run(Target("sim"), scale=0.001)
+    self.assertNotIn("flash", results["results"])
+    self.assertFalse(any(name.startswith("spi_transfer") for name in results["results"]))
+    self.assertFalse(any(name.startswith("can_recv_rx_thread_async") for name in results["results"]))
+    self.assertIn("can_recv_rx_thread", results["results"])
+    self.assertEqual(len(results["results"]), len(SCENARIOS) - 6)
+
+  def test_compare(self):
+    r = {"unit": "calls", "throughput": 100., "p99_us": 100.}
+    baseline = {"results": {"a": r, "b": r}}
+    results = {"results": {"a": dict(r, throughput=95.), "b": dict(r, p99_us=150.), "c": r}}
+    self.assertEqual(compare(results, baseline), ["b: p99 150.0 > 100.0us"])
+    self.assertEqual(len(compare(results, baseline, tolerance=0.01)), 2)
+
+
+class TestCodecBenchmark(unittest.TestCase):
+  def test_run(self):
+    results = codec_benchmark.run(["c_read/canfd_64/", "c_write/can/usb_packet", "py_decode/"], scale=0.02)["results"]
+    self.assertEqual(set(results), {"c_read/canfd_64/usb_packet", "c_read/canfd_64/spi", "c_read/canfd_64/16k", "c_write/can/usb_packet",
+                                    *(f"py_decode/{mix}/{chunk}" for mix in codec_benchmark.MIXES for chunk in codec_benchmark.STREAM_CHUNKS)})
+    self.assertTrue(all(r["items"] == codec_benchmark.BATCH_SIZE for r in results.values()))
+
+  def test_batch(self):
+    batch = codec_benchmark.Batch("canfd_64", 10)
+    self.assertEqual(batch.nbytes, 10 * (6 + 64))
+    self.assertEqual(b"".join(batch.chunks(64)), batch.packed)
+    self.assertTrue(batch.array()['fd'].all())
+
+
+if __name__ == '__main__':
+  unittest.main()
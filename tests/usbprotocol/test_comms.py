@@ -3,7 +3,7 @@ import random
 import unittest
 
 from opendbc.safety import Safety
-from panda import DLC_TO_LEN, USBPACKET_MAX_SIZE, pack_can_buffer, unpack_can_buffer
+from panda import DLC_TO_LEN, USBPACKET_MAX_SIZE, CanStreamDecoder, pack_can_buffer, unpack_can_buffer
 from panda.tests.libpanda import libpanda_py
 
 lpp = libpanda_py.libpanda
@@ -156,6 +156,45 @@ class TestPandaComms(unittest.TestCase):
     self.assertEqual(len(rx_msgs), len(msgs))
     self.assertEqual(rx_msgs, msgs)
 
+  def test_can_receive_stream_decoder(self):
+    msgs = random_can_messages(10000)
+    packets = [libpanda_py.make_CANPacket(m[0], m[2], m[1]) for m in msgs]
+
+    rx_msgs = []
+    decoder = CanStreamDecoder()
+    dat = libpanda_py.ffi.new(f"uint8_t[{CHUNK_SIZE}]")
+    while len(packets) > 0:
+      while lpp.can_slots_empty(lpp.rx_q) > 0 and len(packets) > 0:
+        lpp.can_push(lpp.rx_q, packets.pop(0))
+
+      # odd chunk sizes split packets at every possible offset
+      while True:
+        rx_len = lpp.comms_can_read(dat, random.randint(1, CHUNK_SIZE))
+        if rx_len == 0:
+          break
+        rx_msgs.extend(decoder.feed(libpanda_py.ffi.buffer(dat, rx_len)))
+
+    self.assertEqual(decoder.tail, b"")
+    self.assertEqual(rx_msgs, msgs)
+
+  def test_can_receive_stream_decoder_reset(self):
+    test_msg = (0x100, b"test", 0)
+    for _ in range(10):
+      lpp.can_push(lpp.rx_q, libpanda_py.make_CANPacket(test_msg[0], test_msg[2], test_msg[1]))
+
+    # leave a partial packet on both sides, then reset like Panda.can_reset_communications
+    decoder = CanStreamDecoder()
+    dat = libpanda_py.ffi.new("uint8_t[16]")
+    rx_len = lpp.comms_can_read(dat, 16)
+    decoder.feed(libpanda_py.ffi.buffer(dat, rx_len))
+    assert len(decoder.tail) > 0
+    lpp.comms_can_reset()
+    decoder.reset()
+
+    dat = libpanda_py.ffi.new("uint8_t[512]")
+    rx_len = lpp.comms_can_read(dat, 512)
+    self.assertEqual(decoder.feed(libpanda_py.ffi.buffer(dat, rx_len)), [test_msg] * 8)
+
 
 if __name__ == "__main__":
   unittest.main()
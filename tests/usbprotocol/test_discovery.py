@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import time
+import unittest
+import usb1
+
+from panda import PandaDFU
+from panda.python.discovery import UsbDiscovery, SpiNegativeCache, probe_concurrently, ARRIVED, LEFT, ENTERED_DFU
+
+
+class FakeDevice:
+  def __init__(self, address, serial, vid=0xbbaa, pid=0xddcc, bcd=0x0900):
+    self.address = address
+    self.serial = serial
+    self.vid = vid
+    self.pid = pid
+    self.bcd = bcd
+    self.reads = 0
+    self.fail_reads = 0
+
+  def getVendorID(self):
+    return self.vid
+
+  def getProductID(self):
+    return self.pid
+
+  def getBusNumber(self):
+    return 1
+
+  def getDeviceAddress(self):
+    return self.address
+
+  def getbcdDevice(self):
+    return self.bcd
+
+  def getSerialNumber(self):
+    self.reads += 1
+    if self.fail_reads > 0:
+      self.fail_reads -= 1
+      raise OSError("not ready")
+    return self.serial
+
+  def open(self):
+    return self
+
+  def getASCIIStringDescriptor(self, index):
+    self.reads += 1
+    return self.serial
+
+  def close(self):
+    pass
+
+
+class FakeContext:
+  def __init__(self):
+    self.devices = []
+
+  def getDeviceList(self, skip_on_error=False):
+    return list(self.devices)
+
+
+class TestUsbDiscovery(unittest.TestCase):
+  def setUp(self):
+    self.context = FakeContext()
+    self.discovery = UsbDiscovery(self.context, hotplug=False)
+    self.events = []
+    self.discovery.add_listener(lambda event, info: self.events.append((event, info.serial)))
+
+  def update(self):
+    self.discovery._poll()
+    self.discovery._process_pending()
+
+  def test_poll_only_opens_new_devices(self):
+    panda = FakeDevice(2, "panda0")
+    other = FakeDevice(3, "mouse", vid=0x046d)
+    self.context.devices = [panda, other]
+    for _ in range(5):
+      self.update()
+    self.assertEqual(panda.reads, 1)
+    self.assertEqual(other.reads, 0)
+    self.assertEqual(self.events, [(ARRIVED, "panda0")])
+
+    info = self.discovery.find("panda0")
+    self.assertEqual(info.hw_type, b'\x09')
+    self.assertFalse(info.bootstub)
+
+    self.context.devices = [other]
+    self.update()
+    self.assertIsNone(self.discovery.find("panda0"))
+    self.assertEqual(self.events[-1], (LEFT, "panda0"))
+
+  def test_dfu(self):
+    self.context.devices = [FakeDevice(4, "dfu0", vid=0x0483, pid=0xdf11)]
+    self.update()
+    self.assertEqual(self.events, [(ENTERED_DFU, "dfu0")])
+    self.assertIsNone(self.discovery.find("dfu0"))
+    self.assertTrue(self.discovery.find("dfu0", dfu=True).dfu)
+
+  def test_product_ids(self):
+    self.context.devices = [FakeDevice(2, "jungle0", pid=0xddcf)]
+    self.update()
+    self.assertIsNone(self.discovery.find(None, product_ids=(0xddee, 0xddcc)))
+    self.assertIsNotNone(self.discovery.find(None, product_ids=(0xddef, 0xddcf)))
+
+  def test_retry_serial(self):
+    panda = FakeDevice(2, "panda0")
+    panda.fail_reads = 3
+    self.context.devices = [panda]
+    for _ in range(3):
+      self.update()
+      self.assertEqual(len(self.events), 0)
+    self.update()
+    self.assertEqual(self.events, [(ARRIVED, "panda0")])
+
+  def test_hotplug_events(self):
+    panda = FakeDevice(2, "panda0")
+    self.discovery._on_hotplug(self.context, panda, usb1.HOTPLUG_EVENT_DEVICE_ARRIVED)
+    self.discovery._process_pending()
+    self.assertTrue(self.discovery.wait_for("panda0", timeout=0))
+    self.assertFalse(self.discovery.wait_for_change(timeout=0))
+
+    self.discovery._on_hotplug(self.context, panda, usb1.HOTPLUG_EVENT_DEVICE_LEFT)
+    self.discovery._process_pending()
+    self.assertIsNone(self.discovery.wait_for("panda0", timeout=0))
+    self.assertEqual(self.events, [(ARRIVED, "panda0"), (LEFT, "panda0")])
+
+
+class TestListing(unittest.TestCase):
+  def test_probe_deadlines(self):
+    def slow():
+      time.sleep(1)
+      return ["slow"]
+
+    def broken():
+      raise OSError
+
+    st = time.monotonic()
+    with self.assertLogs("panda", level="WARNING") as logs:
+      ret = probe_concurrently({"fast": (lambda: ["fast"], 0.5), "slow": (slow, 0.2), "broken": (broken, 0.5)})
+    self.assertLess(time.monotonic() - st, 0.5)
+    self.assertEqual(ret, {"fast": ["fast"], "slow": [], "broken": []})
+    self.assertTrue(any("slow probe didn't finish" in line for line in logs.output))
+
+  def test_probe_no_deadline(self):
+    def slow():
+      time.sleep(0.3)
+      return ["slow"]
+
+    with self.assertNoLogs("panda", level="WARNING"):
+      ret = probe_concurrently({"slow": (slow, None), "fast": (lambda: ["fast"], 0.1)})
+    self.assertEqual(ret, {"slow": ["slow"], "fast": ["fast"]})
+
+  def test_spi_negative_cache(self):
+    cache = SpiNegativeCache(ttl=0.1)
+    self.assertFalse(cache.absent())
+    cache.update(False)
+    self.assertTrue(cache.absent())
+    time.sleep(0.15)
+    self.assertFalse(cache.absent())
+    cache.update(False)
+    cache.update(True)
+    self.assertFalse(cache.absent())
+
+  def test_dfu_serial_cache(self):
+    context = FakeContext()
+    dfu = FakeDevice(4, "dfu0", vid=0x0483, pid=0xdf11)
+    context.devices = [dfu]
+    for _ in range(3):
+      devices = PandaDFU.usb_list_devices(context)
+      self.assertEqual([(d.serial, d.transport, d.dfu) for d in devices], [("dfu0", "usb", True)])
+    self.assertEqual(dfu.reads, 1)
+
+    # gone, so a new device at the same address is read again
+    context.devices = []
+    self.assertEqual(PandaDFU.usb_list_devices(context), [])
+    context.devices = [FakeDevice(4, "dfu1", vid=0x0483, pid=0xdf11)]
+    self.assertEqual(PandaDFU.usb_list(context), ["dfu1"])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 import random
 import unittest
+import numpy as np
 
-from panda import pack_can_buffer, unpack_can_buffer, DLC_TO_LEN
+from panda import pack_can_buffer, unpack_can_buffer, unpack_can_buffer_array, CanStreamDecoder, CanPacker, DLC_TO_LEN, CAN_FRAME_DTYPE
+from panda.python import MAX_CAN_MSGS_PER_SPI_BULK_TRANSFER
+from panda.python.spi import XFER_SIZE
 
 class PandaTestPackUnpack(unittest.TestCase):
   def test_panda_lib_pack_unpack(self):
@@ -22,5 +25,137 @@ class PandaTestPackUnpack(unittest.TestCase):
 
     self.assertEqual(unpacked, to_pack)
 
+  def test_panda_lib_unpack_array(self):
+    overflow_buf = b''
+
+    to_pack = []
+    for _ in range(10000):
+      address = random.randint(1, (1 << 29) - 1)
+      data = bytes([random.getrandbits(8) for _ in range(DLC_TO_LEN[random.randrange(0, len(DLC_TO_LEN))])])
+      to_pack.append((address, data, random.randint(0, 2)))
+
+    packed = pack_can_buffer(to_pack)
+    unpacked = []
+    for dat in packed:
+      # split the chunks to check the partial tail is carried over
+      for part in (dat[:100], dat[100:]):
+        arr, overflow_buf = unpack_can_buffer_array(overflow_buf + part)
+        unpacked.extend((int(m['address']), bytes(m['data'][:m['length']]), int(m['bus'])) for m in arr)
+
+    self.assertEqual(overflow_buf, b'')
+    self.assertEqual(unpacked, to_pack)
+
+  def test_panda_lib_stream_decoder(self):
+    to_pack = []
+    for _ in range(10000):
+      address = random.randint(1, (1 << 29) - 1)
+      data = bytes([random.getrandbits(8) for _ in range(DLC_TO_LEN[random.randrange(0, len(DLC_TO_LEN))])])
+      to_pack.append((address, data, random.randint(0, 2)))
+    stream = b''.join(pack_can_buffer(to_pack))
+
+    for copy in (True, False):
+      with self.subTest(copy=copy):
+        decoder = CanStreamDecoder(size=512, copy=copy)
+        unpacked = []
+        pos = 0
+        while pos < len(stream):
+          # random transfer sizes, including ones bigger than the decoder's buffer
+          n = random.randint(1, 1024)
+          unpacked.extend((a, bytes(d), b) for a, d, b in decoder.feed(stream[pos:pos + n]))
+          pos += n
+
+        self.assertEqual(decoder.tail, b'')
+        self.assertEqual(unpacked, to_pack)
+
+  def test_panda_lib_stream_decoder_array(self):
+    to_pack = []
+    for _ in range(10000):
+      address = random.randint(1, (1 << 29) - 1)
+      data = bytes([random.getrandbits(8) for _ in range(DLC_TO_LEN[random.randrange(0, len(DLC_TO_LEN))])])
+      to_pack.append((address, data, random.randint(0, 2)))
+    stream = b''.join(pack_can_buffer(to_pack))
+
+    decoder = CanStreamDecoder()
+    buf = decoder._buf
+    unpacked = []
+    pos = 0
+    while pos < len(stream):
+      n = random.randint(1, 4096)
+      arr = decoder.feed_array(stream[pos:pos + n])
+      unpacked.extend((int(m['address']), bytes(m['data'][:m['length']]), int(m['bus'])) for m in arr)
+      pos += n
+
+    # the tail stays in the decoder's buffer
+    self.assertIs(decoder._buf, buf)
+    self.assertEqual(decoder.tail, b'')
+    self.assertEqual(unpacked, to_pack)
+
+  def test_panda_lib_packer(self):
+    to_pack = []
+    for _ in range(10000):
+      address = random.randint(1, (1 << 29) - 1)
+      data = bytes([random.getrandbits(8) for _ in range(DLC_TO_LEN[random.randrange(0, len(DLC_TO_LEN))])])
+      to_pack.append((address, data, random.randint(0, 2)))
+    expected = b''.join(pack_can_buffer(to_pack, fd=True))
+
+    arr = np.zeros(len(to_pack), dtype=CAN_FRAME_DTYPE)
+    for i, (address, data, bus) in enumerate(to_pack):
+      arr[i]['address'] = address
+      arr[i]['bus'] = bus
+      arr[i]['data'][:len(data)] = list(data)
+      arr[i]['length'] = len(data)
+
+    for chunk_size in (256, XFER_SIZE):
+      packer = CanPacker(chunk_size)
+      for inp in (to_pack, arr, expected):
+        with self.subTest(chunk_size=chunk_size, input=type(inp).__name__):
+          chunks = [bytes(c) for c in packer.pack(inp, fd=True)]
+          self.assertEqual(b''.join(chunks), expected)
+          for c in chunks:
+            # every chunk ends on a packet boundary
+            self.assertLessEqual(len(c), chunk_size)
+            self.assertEqual(unpack_can_buffer(c)[1], b'')
+
+  def test_panda_lib_packer_max_packets(self):
+    # short frames fill a whole SPI transfer with more packets than the firmware has TX slots for
+    msgs = [(0x100, b"", 0) for _ in range(500)] + [(0x200, b"\x00" * 5, 1) for _ in range(500)]
+    expected = b''.join(pack_can_buffer(msgs))
+    packer = CanPacker(XFER_SIZE, max_packets=MAX_CAN_MSGS_PER_SPI_BULK_TRANSFER)
+
+    arr = np.zeros(len(msgs), dtype=CAN_FRAME_DTYPE)
+    for i, (address, data, bus) in enumerate(msgs):
+      arr[i]['address'] = address
+      arr[i]['bus'] = bus
+      arr[i]['length'] = len(data)
+
+    for inp in (msgs, arr, expected):
+      with self.subTest(input=type(inp).__name__):
+        chunks = [bytes(c) for c in packer.pack(inp)]
+        self.assertEqual(b''.join(chunks), expected)
+        for c in chunks:
+          self.assertLessEqual(len(c), XFER_SIZE)
+          self.assertLessEqual(len(unpack_can_buffer(c)[0]), MAX_CAN_MSGS_PER_SPI_BULK_TRANSFER)
+        self.assertEqual(len(unpack_can_buffer(chunks[0])[0]), MAX_CAN_MSGS_PER_SPI_BULK_TRANSFER)
+
+  def test_panda_lib_packer_packets_in(self):
+    msgs = [(0x100, b"\x00" * random.choice(DLC_TO_LEN), 0) for _ in range(100)]
+    packer = CanPacker()
+    stream = b''.join(bytes(c) for c in packer.pack(msgs))
+    self.assertEqual(packer.packet_count, len(msgs))
+
+    for length in range(len(stream) + 1):
+      count, rest = packer.packets_in(length)
+      # the complete packets plus the cut off one make up the whole prefix
+      msgs_out, tail = unpack_can_buffer(stream[:length] + bytes(rest))
+      self.assertEqual(tail, b'')
+      self.assertEqual(len(msgs_out), count + (1 if len(rest) > 0 else 0))
+      self.assertEqual(unpack_can_buffer(stream[:length])[0], msgs[:count])
+
+  def test_panda_lib_unpack_array_checksum(self):
+    packed = bytearray(pack_can_buffer([(0x100, b"test", 0)])[0])
+    packed[-1] ^= 0xFF
+    with self.assertRaises(AssertionError):
+      unpack_can_buffer_array(packed)
+
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import time
+import unittest
+
+from panda.python.pool import PandaPool, run_parallel
+from panda.tests.libpanda.sim_panda import SimPanda, SAFETY_ALLOUTPUT
+
+
+class TestRunParallel(unittest.TestCase):
+  def test_results_and_errors(self):
+    def fn(x):
+      if x == 3:
+        raise ValueError("bad device")
+      return x * 2
+
+    ret = run_parallel({f"p{i}": i for i in range(6)}, fn)
+    self.assertEqual(set(ret), {f"p{i}" for i in range(6)})
+    for i in range(6):
+      r = ret[f"p{i}"]
+      if i == 3:
+        self.assertFalse(r.ok)
+        self.assertIsInstance(r.error, ValueError)
+      else:
+        self.assertTrue(r.ok)
+        self.assertEqual(r.value, i * 2)
+
+  def test_concurrent(self):
+    st = time.monotonic()
+    ret = run_parallel(dict.fromkeys(range(10), 0.2), time.sleep)
+    self.assertEqual(len(ret), 10)
+    self.assertLess(time.monotonic() - st, 1.0)
+
+  def test_empty(self):
+    self.assertEqual(run_parallel({}, lambda x: x), {})
+
+
+class FakePanda:
+  """
+    A pool member. Opening fails for serials in fail_open, and
+    calls fail once the serial is in fail.
+  """
+  fail_open: set[str] = set()
+  fail: set[str] = set()
+
+  def __init__(self, serial, **kwargs):
+    if serial in self.fail_open:
+      raise OSError(f"{serial} not found")
+    self.serial = serial
+    self.kwargs = kwargs
+    self.closed = False
+    self.safety_mode = None
+    self.rx = []
+
+  def check(self):
+    assert not self.closed
+    if self.serial in self.fail:
+      raise OSError(f"{self.serial} disconnected")
+
+  def health(self):
+    self.check()
+    return {"serial": self.serial}
+
+  def set_safety_mode(self, mode=0, param=0):
+    self.check()
+    self.safety_mode = (mode, param)
+
+  def can_recv(self):
+    self.check()
+    ret, self.rx = self.rx, []
+    return ret
+
+  def close(self):
+    self.closed = True
+
+
+class UnusedContext:
+  """
+    A USB context for pools of pandas that aren't on USB, so they don't need libusb.
+  """
+  closed = False
+
+  def close(self):
+    self.closed = True
+
+
+class SimPoolPanda(SimPanda):
+  def __init__(self, serial, cli=False, **kwargs):
+    super().__init__(**kwargs)
+
+
+class TestPandaPool(unittest.TestCase):
+  serials = [f"p{i}" for i in range(5)]
+
+  def setUp(self):
+    FakePanda.fail_open = set()
+    FakePanda.fail = set()
+    self.context = UnusedContext()
+
+  def test_open_close(self):
+    FakePanda.fail_open = {"p2"}
+    pool = PandaPool(self.serials + ["p0"], panda_cls=FakePanda, usb_context=self.context, lazy=True)
+    self.assertEqual(sorted(pool.pandas), ["p0", "p1", "p3", "p4"])
+    self.assertEqual(list(pool.errors), ["p2"])
+    self.assertIsInstance(pool.errors["p2"], OSError)
+    # every member is on the pool's USB context
+    members = list(pool)
+    self.assertTrue(all(p.kwargs == {"cli": False, "lazy": True, "usb_context": self.context} for p in members))
+
+    # opening it again once it's back
+    FakePanda.fail_open = set()
+    self.assertEqual(list(pool.open(self.serials)), ["p2"])
+    self.assertEqual(len(pool), 5)
+    self.assertEqual(pool.errors, {})
+
+    pool.close()
+    self.assertTrue(all(p.closed for p in members))
+    self.assertEqual(len(pool), 0)
+    self.assertIsNone(pool._context)
+    # a context it was given is left open
+    self.assertFalse(self.context.closed)
+
+  def test_broadcast_failure(self):
+    with PandaPool(self.serials, panda_cls=FakePanda, usb_context=self.context) as pool:
+      FakePanda.fail = {"p3"}
+      ret = pool.set_safety_mode(SAFETY_ALLOUTPUT)
+      self.assertEqual(set(ret), set(self.serials))
+      self.assertFalse(ret["p3"].ok)
+      self.assertIsInstance(ret["p3"].error, OSError)
+      # the others still got it
+      for s in self.serials:
+        if s != "p3":
+          self.assertTrue(ret[s].ok)
+          self.assertEqual(pool[s].safety_mode, (SAFETY_ALLOUTPUT, 0))
+
+      ret = pool.health()
+      self.assertEqual({s: r.value for s, r in ret.items() if r.ok}, {s: {"serial": s} for s in self.serials if s != "p3"})
+
+  def test_recv_all(self):
+    with PandaPool(self.serials, panda_cls=FakePanda, usb_context=self.context) as pool:
+      for i, p in enumerate(pool):
+        p.rx = [(0x100 + i, bytes([j]), i % 3) for j in range(i)]
+      FakePanda.fail = {"p4"}
+      with self.assertLogs("panda", level="ERROR"):
+        msgs, errors = pool.recv_all()
+
+      self.assertEqual(list(errors), ["p4"])
+      # in order per panda, and tagged with its serial
+      for i, s in enumerate(self.serials[:4]):
+        self.assertEqual([m[1:] for m in msgs if m[0] == s], [(0x100 + i, bytes([j]), i % 3) for j in range(i)])
+      self.assertEqual(len(msgs), sum(range(4)))
+
+  def test_sim_panda(self):
+    with PandaPool(["sim"], panda_cls=SimPoolPanda, usb_context=self.context) as pool:
+      self.assertTrue(all(r.ok for r in pool.set_safety_mode(SAFETY_ALLOUTPUT).values()))
+      pool["sim"].set_can_loopback(True)
+      pool["sim"].can_send(0x123, b"test", 0)
+      msgs, errors = pool.recv_all()
+      self.assertEqual(errors, {})
+      self.assertIn(("sim", 0x123, b"test", 0), msgs)
+      self.assertEqual(pool.health()["sim"].value["safety_mode"], SAFETY_ALLOUTPUT)
+
+
+if __name__ == '__main__':
+  unittest.main()
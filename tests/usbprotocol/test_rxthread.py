@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import time
+import unittest
+
+from panda.python.rxthread import CanRxThread
+from panda.tests.libpanda.sim_panda import SimPanda, SAFETY_ALLOUTPUT
+from panda.tests.usbprotocol.test_sim_panda import random_msgs
+
+
+class ScriptedReader:
+  """
+    Returns the given batches one per read, then nothing.
+  """
+  def __init__(self, batches):
+    self.batches = list(batches)
+    self.reads = 0
+
+  def __call__(self):
+    self.reads += 1
+    if len(self.batches) == 0:
+      return []
+    ret = self.batches.pop(0)
+    if isinstance(ret, Exception):
+      raise ret
+    return ret
+
+
+def wait_for(cond, timeout=1.0):
+  deadline = time.monotonic() + timeout
+  while not cond() and time.monotonic() < deadline:
+    time.sleep(0.001)
+  return cond()
+
+
+class TestCanRxThread(unittest.TestCase):
+  def start(self, batches, **kwargs):
+    reader = ScriptedReader(batches)
+    t = CanRxThread(reader, **kwargs)
+    t.start()
+    self.addCleanup(t.stop)
+    return t, reader
+
+  def test_drain_order(self):
+    batches = [[(i, bytes([j]), 0) for j in range(i % 3 + 1)] for i in range(50)]
+    t, _ = self.start(batches)
+    self.assertTrue(wait_for(lambda: t.batches == len(batches)))
+
+    got = t.get_batches()
+    self.assertEqual([msgs for _, msgs in got], batches)
+    stamps = [ts for ts, _ in got]
+    self.assertEqual(stamps, sorted(stamps))
+    self.assertEqual(t.frames, sum(len(b) for b in batches))
+    self.assertEqual(t.get_batches(), [])
+
+  def test_overflow(self):
+    batches = [[(i, b"", 0)] * (i + 1) for i in range(10)]
+    t, _ = self.start(batches, maxlen=3)
+    self.assertTrue(wait_for(lambda: t.batches == len(batches)))
+
+    # the oldest are dropped
+    self.assertEqual(t.recv(), [m for b in batches[-3:] for m in b])
+    self.assertEqual(t.dropped_batches, 7)
+    self.assertEqual(t.dropped_frames, sum(range(1, 8)))
+    self.assertEqual(t.stats()["queued_batches"], 0)
+
+  def test_get_batches_timeout(self):
+    t, _ = self.start([])
+    st = time.monotonic()
+    self.assertEqual(t.get_batches(0.05), [])
+    self.assertGreaterEqual(time.monotonic() - st, 0.04)
+
+    # wakes up as soon as a batch arrives
+    t2, reader = self.start([])
+    reader.batches.append([(1, b"", 0)])
+    self.assertEqual(len(t2.get_batches(1.0)), 1)
+
+  def test_read_errors(self):
+    t, reader = self.start([OSError("gone"), [(1, b"", 0)]])
+    self.assertTrue(wait_for(lambda: t.frames == 1))
+    self.assertEqual(t.read_errors, 1)
+    self.assertEqual(t.recv(), [(1, b"", 0)])
+
+  def test_stop(self):
+    t, reader = self.start([])
+    self.assertTrue(t.running)
+    t.stop()
+    self.assertFalse(t.running)
+    self.assertFalse(t._thread.is_alive())
+
+    # nothing reads after stopping, and waiting returns right away
+    reads = reader.reads
+    st = time.monotonic()
+    self.assertEqual(t.get_batches(None), [])
+    self.assertLess(time.monotonic() - st, 0.1)
+    time.sleep(0.01)
+    self.assertEqual(reader.reads, reads)
+
+
+class TestPandaRxThread(unittest.TestCase):
+  def setUp(self):
+    self.p = SimPanda()
+    self.addCleanup(self.p.close)
+    self.p.set_safety_mode(SAFETY_ALLOUTPUT)
+    self.p.set_can_loopback(True)
+
+  def test_iter_frames(self):
+    p = self.p
+    msgs = random_msgs(100)
+    p.start_rx_thread()
+    p.can_send_many(msgs)
+
+    # every message comes back as a TX receipt and as received, then it times out
+    st = time.monotonic()
+    frames = list(p.iter_frames(timeout=0.1))
+    self.assertLess(time.monotonic() - st, 1.0)
+    self.assertEqual(len(frames), 2 * len(msgs))
+    self.assertEqual(sorted(f[1:] for f in frames if f[3] < 128), sorted(msgs))
+
+  def test_single_reader(self):
+    p = self.p
+    rx_thread = p.start_rx_thread()
+    self.assertIs(p.start_rx_thread(), rx_thread)
+    with self.assertRaises(RuntimeError):
+      p.can_recv_array()
+    with self.assertRaises(RuntimeError):
+      p.can_reset_communications()
+
+    p.stop_rx_thread()
+    self.assertFalse(rx_thread.running)
+    p.can_reset_communications()
+    self.assertEqual(len(p.can_recv_array()), 0)
+
+  def test_close_stops(self):
+    rx_thread = self.p.start_rx_thread()
+    self.p.close()
+    self.assertFalse(rx_thread._thread.is_alive())
+    with self.assertRaises(AssertionError):
+      next(self.p.iter_frames())
+
+
+if __name__ == '__main__':
+  unittest.main()
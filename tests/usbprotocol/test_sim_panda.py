@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import random
+import unittest
+from collections import Counter
+
+from panda import Panda
+from panda.python import PANDA_BUS_CNT
+from panda.tests.libpanda.sim_panda import SimPanda, SimHandle, SIM_SERIAL, SIM_UID, SAFETY_ALLOUTPUT
+
+
+def random_msgs(n):
+  return [(random.randint(1, 0x7ff), bytes(random.getrandbits(8) for _ in range(random.randint(0, 8))), random.randrange(PANDA_BUS_CNT))
+          for _ in range(n)]
+
+
+class TestSimPanda(unittest.TestCase):
+  def setUp(self):
+    self.p = SimPanda()
+    self.addCleanup(self.p.close)
+
+  def test_connect(self):
+    p = self.p
+    self.assertEqual(p.get_usb_serial(), SIM_SERIAL)
+    self.assertEqual(p.get_type(), Panda.HW_TYPE_RED_PANDA)
+    self.assertEqual(p.get_packets_versions(), (Panda.HEALTH_PACKET_VERSION, Panda.CAN_PACKET_VERSION, Panda.CAN_HEALTH_PACKET_VERSION))
+    self.assertEqual([c["can_speed"] for c in p.get_can_bus_config()], [500] * PANDA_BUS_CNT)
+    self.assertEqual(p.health()["safety_mode"], 0)
+    self.assertEqual(p.telemetry().can_health[0].can_speed, 500)
+
+  def test_lazy_connect(self):
+    p = SimPanda(lazy=True)
+    self.addCleanup(p.close)
+    device = p._sim_handle.device
+    device.bus_config[0]["can_speed"] = 2500
+
+    # the heartbeat checks are off before any CAN call, so the safety mode sticks
+    p.set_safety_mode(SAFETY_ALLOUTPUT)
+    self.assertTrue(device.heartbeat_disabled)
+    self.assertEqual(p.health()["safety_mode"], SAFETY_ALLOUTPUT)
+    self.assertEqual(device.bus_config[0]["can_speed"], 2500)
+
+    # the bus setup waits for the first CAN call
+    p.can_send_many(random_msgs(10))
+    self.assertEqual(device.bus_config[0]["can_speed"], 5000)
+
+  def test_loopback(self):
+    p = self.p
+    p.set_safety_mode(SAFETY_ALLOUTPUT)
+    msgs = random_msgs(1000)
+
+    # every message comes back as a TX receipt, and with loopback also as received.
+    # the buses are drained one after the other, so only the order per bus is kept
+    for loopback in (False, True):
+      p.set_can_loopback(loopback)
+      self.assertEqual(p.can_send_many(msgs), len(msgs))
+      rx = []
+      while len(r := p.can_recv()) > 0:
+        rx += r
+      receipts = [(addr, dat, bus - 128) for addr, dat, bus in rx if bus >= 128]
+      by_bus = sorted(msgs, key=lambda m: m[2])
+      self.assertEqual(sorted(receipts, key=lambda m: m[2]), by_bus)
+      self.assertEqual(sorted([m for m in rx if m[2] < 128], key=lambda m: m[2]), by_bus if loopback else [])
+
+  def test_safety_blocks_tx(self):
+    p = self.p
+    p.set_can_loopback(True)
+    p.can_send_many(random_msgs(10))
+    self.assertEqual(p.health()["safety_tx_blocked"], 10)
+    self.assertTrue(all(bus >= 192 for _, _, bus in p.can_recv()))
+
+  def test_clear_and_overflow(self):
+    p = self.p
+    p.set_safety_mode(SAFETY_ALLOUTPUT)
+    p.set_can_loopback(True)
+    p.can_send_many(random_msgs(100))
+    p.can_clear(0xFFFF)
+    self.assertEqual(p.can_recv(), [])
+
+    # nothing reads the RX queue, so it overflows like it does on the device
+    for _ in range(5):
+      p.can_send_many(random_msgs(1000))
+    self.assertGreater(p.health()["rx_buffer_overflow"], 0)
+
+
+class CountingHandle(SimHandle):
+  def __init__(self) -> None:
+    super().__init__()
+    self.reads: Counter = Counter()
+
+  def controlRead(self, request_type, request, value, index, length, timeout=0):
+    self.reads[request] += 1
+    return super().controlRead(request_type, request, value, index, length, timeout)
+
+
+class TestIdentityCache(unittest.TestCase):
+  # request of every identity field
+  IDENTITY = {"get_type": 0xc1, "get_uid": 0xc3, "get_serial": 0xd0, "get_packets_versions": 0xdd, "get_signature": 0xd3}
+
+  def setUp(self):
+    self.handle = CountingHandle()
+    self.p = SimPanda(self.handle)
+    self.addCleanup(self.p.close)
+
+  def read_all(self):
+    return {name: getattr(self.p, name)() for name in self.IDENTITY}
+
+  def test_read_once(self):
+    first = self.read_all()
+    self.assertEqual(first["get_uid"], SIM_UID.hex())
+    for _ in range(5):
+      self.assertEqual(self.read_all(), first)
+    for name, request in self.IDENTITY.items():
+      self.assertEqual(self.handle.reads[request], 1, name)
+    self.assertEqual(self.handle.reads[0xd4], 1)
+
+    # the returned lists are copies
+    self.p.get_serial().append("x")
+    self.assertEqual(self.p.get_serial(), first["get_serial"])
+
+  def test_cleared_on_reconnect(self):
+    self.read_all()
+    self.p.connect()
+    self.read_all()
+    for name, request in self.IDENTITY.items():
+      self.assertEqual(self.handle.reads[request], 2, name)
+
+
+if __name__ == '__main__':
+  unittest.main()
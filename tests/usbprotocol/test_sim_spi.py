@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import struct
+import threading
+import unittest
+
+from panda import Panda
+from panda.python.spi import SpeedController, PandaSpiNackResponse, XFER_SIZE, NACK
+from panda.tests.libpanda.sim_panda import SimPanda, SimSpi, SpiFaults, sim_spi_handle, SIM_SERIAL, SIM_UID, SAFETY_ALLOUTPUT
+from panda.tests.usbprotocol.test_sim_panda import random_msgs
+
+
+class TestSimSpi(unittest.TestCase):
+  def test_version(self):
+    h = sim_spi_handle()
+    dat = h.get_protocol_version()
+    self.assertEqual(dat[:12], SIM_UID)
+    self.assertEqual(dat[12:], bytes([Panda.HW_TYPE_RED_PANDA[0], 0xcc, h.PROTOCOL_VERSION]))
+
+  def test_bad_header(self):
+    spi = SimSpi()
+    spi.writebytes2(struct.pack("<BBHHB", 0x5a, 0, 0, 0x40, 0))
+    self.assertEqual(spi.xfer2([0x11]), [NACK])
+    self.assertEqual(spi.checksum_errors, 1)
+
+    # back to waiting for a header
+    h = sim_spi_handle(spi)
+    self.assertEqual(h.controlRead(Panda.REQUEST_IN, 0xc1, 0, 0, 0x40), Panda.HW_TYPE_RED_PANDA)
+
+  def test_bulk(self):
+    h = sim_spi_handle()
+    self.assertEqual(h.bulkRead(0xab, 3 * XFER_SIZE), bytes(3 * XFER_SIZE))
+
+    # CAN TX goes through the whole firmware path
+    h.controlWrite(Panda.REQUEST_OUT, 0xdc, SAFETY_ALLOUTPUT, 0, b'')
+    h.controlWrite(Panda.REQUEST_OUT, 0xe5, 1, 0, b'')
+    p = SimPanda(h)
+    self.addCleanup(p.close)
+    msgs = random_msgs(500)
+    p.can_send_many(msgs)
+    rx = []
+    while len(r := p.can_recv()) > 0:
+      rx += r
+    self.assertEqual(len(rx), 2 * len(msgs))
+
+
+class TestSimPandaSpi(unittest.TestCase):
+  def test_connect(self):
+    p = SimPanda(sim_spi_handle())
+    self.addCleanup(p.close)
+    self.assertTrue(p.spi)
+    self.assertEqual(p.get_usb_serial(), SIM_SERIAL)
+    self.assertEqual(p.get_type(), Panda.HW_TYPE_RED_PANDA)
+    self.assertEqual(p.health()["safety_mode"], 0)
+
+  def test_faults(self):
+    spi = SimSpi(faults=SpiFaults(nack=0.1, bad_checksum=0.1, bad_reply=0.1, ack_delay=3, seed=0))
+    p = SimPanda(sim_spi_handle(spi), stats=True)
+    self.addCleanup(p.close)
+
+    # every fault is retried, and nothing is lost on the way
+    for _ in range(100):
+      self.assertEqual(p.health()["voltage"], 12000)
+
+    s = p.stats()
+    self.assertGreater(min(spi.injected.values()), 0)
+    self.assertEqual(spi.checksum_errors, spi.injected["bad_checksum"])
+    self.assertEqual(sum(v.retries for v in s.values()), spi.injected["nack"] + spi.injected["bad_checksum"] + spi.injected["bad_reply"])
+    acks = s[("spi_data_ack", 0)]
+    self.assertEqual(acks.errors, spi.injected["nack"] + spi.injected["bad_checksum"])
+    # NACKs aren't late, ACKs are
+    self.assertGreaterEqual(acks.polls, 4 * (acks.calls - acks.errors))
+
+  def test_nack(self):
+    spi = SimSpi(faults=SpiFaults(nack=1.))
+    h = sim_spi_handle(spi)
+    with self.assertRaises(PandaSpiNackResponse):
+      h.controlRead(Panda.REQUEST_IN, 0xc1, 0, 0, 0x40, timeout=10)
+
+  def test_speed_fallback(self):
+    spi = SimSpi(faults=SpiFaults(bad_checksum=0.5, min_speed_hz=40000000, seed=0))
+    p = SimPanda(sim_spi_handle(spi, speed_controller=SpeedController(window=10, max_error_rate=0.2, probe_interval=60)))
+    self.addCleanup(p.close)
+    for _ in range(100):
+      p.health()
+    self.assertEqual(spi.max_speed_hz, 30000000)
+
+    # clean at the lower clock
+    errors = spi.checksum_errors
+    for _ in range(100):
+      p.health()
+    self.assertEqual(spi.checksum_errors, errors)
+
+  def test_lock_contention(self):
+    spi = SimSpi()
+    pandas = [SimPanda(sim_spi_handle(spi), stats=True) for _ in range(2)]
+    for p in pandas:
+      self.addCleanup(p.close)
+
+    def run(p):
+      for _ in range(200):
+        self.assertEqual(p.health()["voltage"], 12000)
+    threads = [threading.Thread(target=run, args=(p, )) for p in pandas]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+
+    for p in pandas:
+      s = p.stats()
+      self.assertGreaterEqual(s[("spi_lock_wait", 0)].calls, 200)
+      self.assertEqual(sum(v.retries for v in s.values()), 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
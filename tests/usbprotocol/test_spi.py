@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+import ctypes
+import errno
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from panda import Panda
+from panda.python import spi
+from panda.python.spi import AckPoller, SpeedController, SpiDevice, PandaSpiHandle, PandaSpiBadChecksum, PandaSpiTransfer, PandaSpiTransferFailed, crc8, \
+                             SYNC, HACK, DACK, CHECKSUM_START, XFER_SIZE, SPI_SPEEDS, SPI_IOC_PANDA_BATCH, SPI_PANDA_BATCH_STOP_ON_SHORT_READ, \
+                             SPI_MODE_SPIDEV, SPI_MODE_KERNEL
+from panda.python.stats import TransportStats, instrument
+
+
+def crc8_bitwise(data):
+  crc = 0xFF
+  for b in reversed(data):
+    crc ^= b
+    for _ in range(8):
+      crc = ((crc << 1) ^ 0xD5) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+  return crc
+
+
+def xor(data, start=CHECKSUM_START):
+  for b in data:
+    start ^= b
+  return start
+
+
+class FakeSpi:
+  """
+    Answers panda SPI transfers with respond(endpoint, data, max_rx_len).
+  """
+  def __init__(self, respond):
+    self.respond = respond
+    self.header = None
+    self.pending = b""
+    self.corrupt = 0
+    # polls the data ACK is late by
+    self.busy = 0
+    # something to flock
+    self.file = tempfile.TemporaryFile()
+
+  def fileno(self):
+    return self.file.fileno()
+
+  def writebytes2(self, dat):
+    dat = bytes(dat)
+    if self.header is None:
+      assert dat[0] == SYNC and xor(dat) == 0
+      self.header = struct.unpack("<BBHH", dat[:6])
+      return
+    _, endpoint, tx_len, max_rx_len = self.header
+    self.header = None
+    assert len(dat) == tx_len + 1 and xor(dat) == 0
+    resp = self.respond(endpoint, dat[:-1], max_rx_len)
+    pkt = bytes([DACK, *struct.pack("<H", len(resp)), *resp])
+    self.pending = pkt + bytes([xor(pkt) ^ (1 if self.corrupt > 0 else 0)])
+    self.corrupt = max(self.corrupt - 1, 0)
+
+  def xfer2(self, dat):
+    if self.header is not None:
+      return [HACK] * len(dat)
+    if self.busy > 0:
+      self.busy -= 1
+      return [0] * len(dat)
+    ret = list(self.pending[:len(dat)].ljust(len(dat), b'\x00'))
+    self.pending = self.pending[len(dat):]
+    return ret
+
+  def readinto(self, view):
+    n = min(len(view), len(self.pending))
+    view[:n] = self.pending[:n]
+    self.pending = self.pending[n:]
+    return n
+
+
+class FakeKernelDriver:
+  """
+    Runs batches of the spidev_panda ioctl with respond(endpoint, data, max_rx_len).
+  """
+  def __init__(self, respond):
+    self.respond = respond
+    self.ioctls = 0
+    self.transfers = 0
+    # transfer numbers that fail, counted over all batches
+    self.fail: set[int] = set()
+    # when set, batches stop before their first transfer without an error
+    self.stall = False
+
+  def ioctl(self, fd, request, batch):
+    if request != SPI_IOC_PANDA_BATCH:
+      raise OSError(errno.ENOTTY, os.strerror(errno.ENOTTY))
+    self.ioctls += 1
+    if self.stall:
+      return 0
+    transfers = (PandaSpiTransfer * batch.count).from_address(batch.transfers)
+    results = (ctypes.c_int32 * batch.count).from_address(batch.results)
+    for i, t in enumerate(transfers):
+      self.transfers += 1
+      if self.transfers in self.fail:
+        results[i] = -1
+        return i
+      resp = self.respond(t.endpoint, ctypes.string_at(t.tx_buf, t.tx_length), t.rx_length_max)
+      ctypes.memmove(t.rx_buf, resp, len(resp))
+      results[i] = len(resp)
+      if (batch.flags & SPI_PANDA_BATCH_STOP_ON_SHORT_READ) and len(resp) < t.rx_length_max:
+        return i + 1
+    return batch.count
+
+
+def make_handle(respond, mode=None, **kwargs):
+  dev = SpiDevice.__new__(SpiDevice)
+  dev._spidev = FakeSpi(respond)
+  dev.speed = SpiDevice.MAX_SPEED
+  return PandaSpiHandle(dev, mode, **kwargs)
+
+
+def health_responder(ep, dat, max_rx_len):
+  request, _, _, length = struct.unpack("<BHHH", dat)
+  return bytes(length)
+
+
+class TestSpiHandle(unittest.TestCase):
+  def test_crc8(self):
+    for _ in range(1000):
+      dat = bytes(random.getrandbits(8) for _ in range(random.randint(0, 40)))
+      self.assertEqual(crc8(dat), crc8_bitwise(dat))
+
+  def test_control(self):
+    def respond(ep, dat, max_rx_len):
+      request, _, _, length = struct.unpack("<BHHH", dat)
+      return bytes(range(length)) if request == 0xd2 else b""
+
+    h = make_handle(respond)
+    # fits in the data ACK, and doesn't
+    for length in (10, Panda.TELEMETRY_SIZE):
+      dat = h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, length)
+      self.assertIsInstance(dat, bytes)
+      self.assertEqual(dat, bytes(range(length)))
+    self.assertEqual(h.controlWrite(Panda.REQUEST_OUT, 0xf1, 0, 0, b""), b"")
+
+  def test_bulk(self):
+    rx = bytes(random.getrandbits(8) for _ in range(XFER_SIZE * 2 + 100))
+    written = []
+
+    def respond(ep, dat, max_rx_len):
+      nonlocal rx
+      if ep == 1:
+        ret, rx = rx[:max_rx_len], rx[max_rx_len:]
+        return ret
+      written.append(dat)
+      return b""
+
+    h = make_handle(respond)
+    expected = rx
+    first = h.bulkRead(1, 16384)
+    self.assertEqual(first, expected)
+
+    # the next read reuses the handle's buffer, and doesn't change what was returned
+    buf = h._bulk_rx
+    rx = expected2 = bytes(100)
+    self.assertEqual(h.bulkRead(1, 16384), expected2)
+    self.assertIs(h._bulk_rx, buf)
+    self.assertEqual(first, expected)
+
+    tx = bytes(random.getrandbits(8) for _ in range(XFER_SIZE + 10))
+    self.assertEqual(h.bulkWrite(3, memoryview(tx)), len(tx))
+    self.assertEqual(b"".join(written), tx)
+
+  def test_bad_checksum_retry(self):
+    h = make_handle(lambda ep, dat, max_rx_len: b"\x01\x02")
+    dev = h.dev._spidev
+    dev.corrupt = 2
+    self.assertEqual(h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 2), b"\x01\x02")
+
+    # slowing down doesn't help either
+    dev.corrupt = 1000
+    with patch.dict(spi.SPI_DEVICES, dict.fromkeys(SPI_SPEEDS, dev)), self.assertRaises(PandaSpiBadChecksum):
+      h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 2, timeout=10)
+
+
+class TestAckPolling(unittest.TestCase):
+  def test_delay(self):
+    poller = AckPoller(spin_us=100, min_sleep_us=20, max_sleep_us=1000, backoff=0.25, alpha=0.5)
+    key = (DACK, 0)
+    # nothing learned yet, spin then back off
+    self.assertEqual(poller.delay(key, 50e-6), 0)
+    self.assertAlmostEqual(poller.delay(key, 120e-6), 30e-6)
+    self.assertAlmostEqual(poller.delay(key, 1e-3), 250e-6)
+    self.assertAlmostEqual(poller.delay(key, 1.0), 1e-3)
+
+    poller.update(key, 2e-3)
+    poller.update(key, 1e-3)
+    self.assertAlmostEqual(poller.expected(key), 1.5e-3)
+    # sleeps until it's due, spins around when it is
+    self.assertAlmostEqual(poller.delay(key, 0), 1.4e-3 - 0.4e-3)
+    self.assertAlmostEqual(poller.delay(key, 1e-3), 0.4e-3)
+    self.assertEqual(poller.delay(key, 1.5e-3), 0)
+    self.assertEqual(poller.delay((DACK, 1), 50e-6), 0)
+
+    self.assertEqual(AckPoller(max_sleep_us=0).delay(key, 1.0), 0)
+
+  def test_stats(self):
+    h = make_handle(health_responder)
+    stats = TransportStats()
+    instrument(h, stats)
+    h.dev._spidev.busy = 5
+    h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 10)
+    h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 10)
+
+    s = stats.snapshot()
+    self.assertEqual(s[("spi_header_ack", 0)].polls, 2)
+    self.assertEqual(s[("spi_data_ack", 0)].calls, 2)
+    self.assertEqual(s[("spi_data_ack", 0)].polls, 6 + 1)
+    self.assertGreater(h.ack_poller.expected((DACK, 0)), 0)
+
+
+class TestSpeedController(unittest.TestCase):
+  def test_drop_and_probe(self):
+    c = SpeedController(speeds=(10, 30, 20), window=10, max_error_rate=0.2, probe_interval=0)
+    self.assertEqual(c.speed, 30)
+    for ok in (True, False, False, True, False):
+      c.record(ok)
+    self.assertEqual(c.speed, 20)
+
+    # clean window, try going back up
+    for _ in range(10):
+      c.record(True)
+    self.assertEqual(c.speed, 30)
+    for _ in range(3):
+      c.record(False)
+    self.assertEqual(c.speed, 20)
+
+    # never past the slowest
+    for _ in range(10):
+      c.record(False)
+    self.assertEqual(c.speed, 10)
+    self.assertEqual(c.error_rate, 1.)
+
+  def test_probe_interval(self):
+    c = SpeedController(speeds=(30, 20), window=10, max_error_rate=0.2, probe_interval=60)
+    for _ in range(3):
+      c.record(False)
+    for _ in range(100):
+      c.record(True)
+    self.assertEqual(c.speed, 20)
+    self.assertEqual(c.error_rate, 0.)
+
+  def test_handle(self):
+    fast, slow = FakeSpi(health_responder), FakeSpi(health_responder)
+    fast.corrupt = 1000
+    with patch.dict(spi.SPI_DEVICES, {50000000: fast, 40000000: slow}):
+      h = make_handle(health_responder, speed_controller=SpeedController(speeds=(50000000, 40000000), window=10, max_error_rate=0.2))
+      h.dev.set_speed(50000000)
+      self.assertEqual(h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 10), bytes(10))
+      self.assertEqual(h.dev.speed, 40000000)
+      self.assertIs(h.dev._spidev, slow)
+
+
+class TestSpiKernelDriver(unittest.TestCase):
+  def setUp(self):
+    self.rx = b""
+    self.written = []
+    self.driver = FakeKernelDriver(self.respond)
+    p = patch.object(spi.fcntl, "ioctl", self.driver.ioctl)
+    p.start()
+    self.addCleanup(p.stop)
+
+  def respond(self, ep, dat, max_rx_len):
+    if ep == 0:
+      return health_responder(ep, dat, max_rx_len)
+    if ep == 1:
+      ret, self.rx = self.rx[:max_rx_len], self.rx[max_rx_len:]
+      return ret
+    self.written.append(dat)
+    return b""
+
+  def test_ioctl_number(self):
+    # _IOWR('k', 0x50, struct spi_panda_batch)
+    self.assertEqual(SPI_IOC_PANDA_BATCH, 0xc0186b50)
+
+  def test_control(self):
+    h = make_handle(self.respond, SPI_MODE_KERNEL)
+    self.assertEqual(h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, Panda.TELEMETRY_SIZE), bytes(Panda.TELEMETRY_SIZE))
+    self.assertEqual(self.driver.ioctls, 1)
+
+  def test_bulk_batched(self):
+    h = make_handle(self.respond, SPI_MODE_KERNEL)
+    self.rx = expected = bytes(random.getrandbits(8) for _ in range(XFER_SIZE * 3 + 100))
+    self.assertEqual(h.bulkRead(1, 16384), expected)
+    self.assertEqual(self.driver.ioctls, 1)
+
+    # a multiple of the chunk size ends on an empty read
+    self.rx = expected = bytes(XFER_SIZE * 2)
+    self.assertEqual(h.bulkRead(1, 16384), expected)
+
+    tx = bytes(random.getrandbits(8) for _ in range(XFER_SIZE * 4 + 10))
+    self.assertEqual(h.bulkWrite(3, tx), len(tx))
+    self.assertEqual(self.written, [tx[i:i + XFER_SIZE] for i in range(0, len(tx), XFER_SIZE)])
+    self.assertEqual(self.driver.ioctls, 3)
+
+  def test_partial_batch_retry(self):
+    h = make_handle(self.respond, SPI_MODE_KERNEL)
+    tx = bytes(random.getrandbits(8) for _ in range(XFER_SIZE * 4))
+    self.driver.fail = {3}
+    self.assertEqual(h.bulkWrite(3, tx), len(tx))
+    # the chunks before the failed one aren't sent again
+    self.assertEqual(b"".join(self.written), tx)
+    self.assertEqual(self.driver.ioctls, 2)
+
+    self.rx = expected = bytes(random.getrandbits(8) for _ in range(XFER_SIZE * 2 + 10))
+    self.driver.fail = {self.driver.transfers + 2}
+    self.assertEqual(h.bulkRead(1, 16384), expected)
+
+  def test_no_progress(self):
+    h = make_handle(self.respond, SPI_MODE_KERNEL)
+    self.rx = expected = bytes(XFER_SIZE + 10)
+    self.driver.stall = True
+    for fn in (lambda: h.bulkRead(1, 16384, timeout=20), lambda: h.bulkWrite(3, bytes(10), timeout=20),
+               lambda: h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 0x40, timeout=20)):
+      with self.assertRaises(PandaSpiTransferFailed):
+        fn()
+
+    self.driver.stall = False
+    self.assertEqual(h.bulkRead(1, 16384), expected)
+
+  def test_mode_selection(self):
+    with patch.object(spi, "kernel_driver_loaded", return_value=False):
+      self.assertEqual(make_handle(self.respond).mode, SPI_MODE_SPIDEV)
+      with patch.dict(os.environ, {"PANDA_SPI_MODE": SPI_MODE_KERNEL}):
+        self.assertEqual(make_handle(self.respond).mode, SPI_MODE_KERNEL)
+
+    with patch.object(spi, "kernel_driver_loaded", return_value=True):
+      self.assertEqual(make_handle(self.respond).mode, SPI_MODE_KERNEL)
+      self.assertEqual(make_handle(self.respond, SPI_MODE_SPIDEV).mode, SPI_MODE_SPIDEV)
+      with patch.dict(os.environ, {"PANDA_SPI_MODE": SPI_MODE_SPIDEV}):
+        self.assertEqual(make_handle(self.respond).mode, SPI_MODE_SPIDEV)
+
+      # an old driver without the batch ioctl fails the probe
+      with patch.object(spi.fcntl, "ioctl", side_effect=OSError(errno.ENOTTY, "")):
+        self.assertEqual(make_handle(self.respond).mode, SPI_MODE_SPIDEV)
+
+    with self.assertRaises(ValueError):
+      make_handle(self.respond, "usb")
+
+
+class TestSpiTransaction(unittest.TestCase):
+  def setUp(self):
+    self.h = make_handle(health_responder)
+    self.stats = TransportStats()
+    instrument(self.h, self.stats)
+
+  def holds(self):
+    return self.stats.snapshot()[("spi_lock_hold", 0)].calls
+
+  def test_single_lock(self):
+    with self.h.transaction():
+      for _ in range(5):
+        self.h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 10)
+      with self.h.transaction():
+        self.h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 10)
+    self.assertEqual(self.holds(), 1)
+
+    self.h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 10)
+    self.h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 10)
+    self.assertEqual(self.holds(), 3)
+
+  def test_other_threads(self):
+    other = make_handle(health_responder)
+    done = []
+    t = threading.Thread(target=lambda: done.append(other.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 10)))
+    with self.h.transaction(max_hold_ms=1000):
+      t.start()
+      time.sleep(0.05)
+      self.assertEqual(done, [])
+      self.h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 10)
+    t.join()
+    self.assertEqual(len(done), 1)
+
+  def test_max_hold(self):
+    with self.h.transaction(max_hold_ms=0):
+      for _ in range(3):
+        time.sleep(0.001)
+        self.h.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 10)
+    # given up before each transfer
+    self.assertEqual(self.holds(), 4)
+
+
+if __name__ == '__main__':
+  unittest.main()
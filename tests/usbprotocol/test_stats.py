@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import unittest
+import usb1
+
+from panda import Panda
+from panda.python.base import BaseHandle
+from panda.python.stats import TransportStats, OpStats, LATENCY_BUCKETS_US, instrument, uninstrument
+
+
+class FakeHandle(BaseHandle):
+  def __init__(self):
+    self.errors = []
+
+  def close(self):
+    pass
+
+  def controlWrite(self, request_type, request, value, index, data, timeout=0, expect_disconnect=False):
+    return len(data)
+
+  def controlRead(self, request_type, request, value, index, length, timeout=0):
+    if len(self.errors) > 0:
+      raise self.errors.pop(0)
+    return b'\x00' * length
+
+  def bulkWrite(self, endpoint, data, timeout=0):
+    return len(data)
+
+  def bulkRead(self, endpoint, length, timeout=0):
+    if len(self.errors) > 0:
+      raise self.errors.pop(0)
+    return b'\x01' * 10
+
+
+class TestStats(unittest.TestCase):
+  def setUp(self):
+    self.handle = FakeHandle()
+    self.stats = TransportStats()
+    instrument(self.handle, self.stats)
+
+  def test_counts(self):
+    for _ in range(3):
+      self.handle.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 58)
+    self.handle.bulkWrite(3, b'\x00' * 100)
+    self.handle.controlWrite(Panda.REQUEST_OUT, 0xf1, 0, 0, b'')
+
+    self.handle.errors = [usb1.USBErrorTimeout(), usb1.USBErrorIO()]
+    for _ in range(2):
+      with self.assertRaises(usb1.USBError):
+        self.handle.controlRead(Panda.REQUEST_IN, 0xd2, 0, 0, 58)
+
+    s = self.stats.snapshot()
+    self.assertEqual(set(s), {("control_read", 0xd2), ("bulk_write", 3), ("control_write", 0xf1)})
+    health = s[("control_read", 0xd2)]
+    self.assertEqual((health.calls, health.bytes, health.errors, health.timeouts), (5, 3 * 58, 2, 1))
+    self.assertEqual(sum(health.latency_us), 5)
+    self.assertEqual(s[("bulk_write", 3)].bytes, 100)
+    self.assertEqual(s[("control_write", 0xf1)].calls, 1)
+
+  def test_delta(self):
+    self.handle.bulkRead(1, 16384)
+    before = self.stats.snapshot()
+    self.handle.bulkRead(1, 16384)
+    self.handle.bulkWrite(3, b'\x00')
+    delta = self.stats.snapshot() - before
+    self.assertEqual(delta[("bulk_read", 1)].calls, 1)
+    self.assertEqual(delta[("bulk_write", 3)].calls, 1)
+
+    # nothing happened, nothing in the delta
+    self.assertEqual(dict(self.stats.snapshot() - self.stats.snapshot()), {})
+
+  def test_percentile(self):
+    s = OpStats(calls=4, latency_us=(1, 2, 0, 1) + (0, ) * (len(LATENCY_BUCKETS_US) - 3))
+    self.assertEqual(s.percentile_us(25), LATENCY_BUCKETS_US[0])
+    self.assertEqual(s.percentile_us(50), LATENCY_BUCKETS_US[1])
+    self.assertEqual(s.percentile_us(100), LATENCY_BUCKETS_US[3])
+    self.assertIsNone(OpStats().percentile_us(50))
+
+  def test_uninstrument(self):
+    uninstrument(self.handle)
+    self.handle.bulkRead(1, 16384)
+    self.assertEqual(len(self.stats.snapshot()), 0)
+    self.assertIsNone(self.handle.stats)
+    self.assertNotIn("bulkRead", self.handle.__dict__)
+
+  def test_can_recv_retries(self):
+    p = Panda.__new__(Panda)
+    p._handle = self.handle
+    self.handle.errors = [usb1.USBErrorIO()]
+    self.assertEqual(len(p._can_bulk_read()), 10)
+    s = self.stats.snapshot()[("bulk_read", 1)]
+    self.assertEqual((s.calls, s.errors, s.retries), (2, 1, 1))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import random
+import unittest
+
+from panda import Panda, Telemetry
+from panda.python import PANDA_BUS_CNT
+from panda.tests.libpanda import libpanda_py
+
+ffi = libpanda_py.ffi
+lpp = libpanda_py.libpanda
+
+
+def random_struct(s):
+  vals = []
+  for c in s.format[1:]:
+    if c == 'f':
+      vals.append(random.choice([0.0, 0.5, 12.25]))
+    elif c == 'B':
+      vals.append(random.randint(0, 7))
+    elif c == 'H':
+      vals.append(random.randint(0, 0xFFFF))
+    else:
+      vals.append(random.randint(0, 0xFFFFFFFF))
+  return s.pack(*vals)
+
+
+class FakeHandle:
+  def __init__(self, responses):
+    self.responses = responses
+    self.requests = []
+
+  def controlRead(self, request_type, request, value, index, length, timeout=0):
+    self.requests.append(request)
+    return self.responses[(request, value)]
+
+
+def make_panda(handle):
+  p = Panda.__new__(Panda)
+  p._handle = handle
+  p.health_version = Panda.HEALTH_PACKET_VERSION
+  p.can_health_version = Panda.CAN_HEALTH_PACKET_VERSION
+  return p
+
+
+class TestTelemetry(unittest.TestCase):
+  def setUp(self):
+    self.health = random_struct(Panda.HEALTH_STRUCT)
+    self.can_health = [random_struct(Panda.CAN_HEALTH_STRUCT) for _ in range(PANDA_BUS_CNT)]
+
+  def firmware_pkt(self):
+    buf = ffi.new("uint8_t[]", 0x100)
+    n = lpp.get_telemetry_pkt(buf, self.health, b''.join(self.can_health))
+    return bytes(ffi.buffer(buf, n))
+
+  def test_firmware_pkt(self):
+    dat = self.firmware_pkt()
+    self.assertEqual(len(dat), Panda.TELEMETRY_SIZE)
+
+    p = make_panda(FakeHandle({(0xc8, 0): dat}))
+    t = p.telemetry()
+    self.assertEqual(t.health._asdict(), p._parse_health(self.health))
+    self.assertEqual(len(t.can_health), PANDA_BUS_CNT)
+    for rec, raw in zip(t.can_health, self.can_health, strict=True):
+      self.assertEqual(rec._asdict(), p._parse_can_health(raw))
+
+  def test_version_mismatch(self):
+    dat = bytearray(self.firmware_pkt())
+    dat[1] += 1
+    p = make_panda(FakeHandle({(0xc8, 0): bytes(dat)}))
+    with self.assertRaises(RuntimeError):
+      p.telemetry()
+
+  def test_old_firmware(self):
+    responses = {(0xc8, 0): b'', (0xd2, 0): self.health}
+    responses.update({(0xc2, bus): dat for bus, dat in enumerate(self.can_health)})
+    handle = FakeHandle(responses)
+    t = make_panda(handle).telemetry()
+    self.assertIsInstance(t, Telemetry)
+    self.assertEqual(handle.requests, [0xc8, 0xd2, 0xc2, 0xc2, 0xc2])
+    self.assertEqual(t, make_panda(FakeHandle({(0xc8, 0): self.firmware_pkt()})).telemetry())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import os
+import json
+import tempfile
+import threading
+import unittest
+
+from panda import Panda
+from panda.python import tracing
+from panda.python.usb import PandaUsbHandle
+
+
+class FakeLibusbHandle:
+  def controlRead(self, request_type, request, value, index, length, timeout=0):
+    return b'\x00' * length
+
+  def bulkWrite(self, endpoint, data, timeout=0):
+    return len(data)
+
+
+def make_panda():
+  p = Panda.__new__(Panda)
+  p._handle = PandaUsbHandle(FakeLibusbHandle())
+  p.health_version = Panda.HEALTH_PACKET_VERSION
+  return p
+
+
+class TestTracing(unittest.TestCase):
+  def tearDown(self):
+    tracing.stop_tracing()
+
+  def test_disabled(self):
+    tracing.stop_tracing()
+    make_panda().health()
+    tracer = tracing.start_tracing()
+    self.assertEqual(tracer.events, [])
+
+  def test_events(self):
+    p = make_panda()
+    tracer = tracing.start_tracing()
+    p.health()
+    t = threading.Thread(target=p._handle.bulkWrite, args=(3, b'\x00' * 16), name="tx")
+    t.start()
+    t.join()
+
+    events = {e["name"]: e for e in tracer.events}
+    self.assertEqual(set(events), {"health", "controlRead", "bulkWrite"})
+    health, control = events["health"], events["controlRead"]
+    self.assertEqual(control["args"], {"code": "0xd2"})
+    self.assertEqual(events["bulkWrite"]["args"], {"code": "0x3"})
+
+    # nested in the Panda call, on the same thread
+    self.assertEqual(health["tid"], control["tid"])
+    self.assertLessEqual(health["ts"], control["ts"])
+    self.assertGreaterEqual(health["ts"] + health["dur"], control["ts"] + control["dur"])
+    self.assertNotEqual(events["bulkWrite"]["tid"], health["tid"])
+
+    with tempfile.TemporaryDirectory() as d:
+      path = os.path.join(d, "trace.json")
+      self.assertIs(tracing.stop_tracing(path), tracer)
+      with open(path) as f:
+        trace = json.load(f)
+    names = [e["args"]["name"] for e in trace["traceEvents"] if e["ph"] == "M"]
+    self.assertIn("tx", names)
+    self.assertEqual(len([e for e in trace["traceEvents"] if e["ph"] == "X"]), 3)
+
+
+if __name__ == '__main__':
+  unittest.main()
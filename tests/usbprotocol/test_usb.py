@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+import time
+import threading
+import unittest
+
+import usb1
+
+from panda import Panda, CanPacker
+from panda.python.usb import AsyncBulkReader, PandaUsbHandle
+
+
+class FakeTransfer:
+  """
+    Stands in for a usb1.USBTransfer. The test, or the context's device,
+    completes it with complete().
+  """
+  def __init__(self, handle):
+    self.handle = handle
+    self.submitted = False
+    self.closed = False
+    self.cancelling = False
+    # bytes that went out before it was cancelled
+    self.progress = 0
+    self.status = None
+    self.length = 0
+    self.buffer = bytearray()
+    self.callback = None
+    self.user_data = None
+
+  def setBulk(self, endpoint, buffer_or_len, callback=None, user_data=None, timeout=0):
+    assert not self.submitted
+    self.endpoint = endpoint
+    self.buffer = bytearray(buffer_or_len)
+    self.callback = callback
+    self.user_data = user_data
+
+  def submit(self):
+    assert not self.submitted and not self.closed
+    self.submitted = True
+    self.cancelling = False
+    self.progress = 0
+    self.handle.submitted.append(self)
+
+  def isSubmitted(self):
+    return self.submitted
+
+  def cancel(self):
+    if not self.submitted:
+      raise usb1.USBErrorNotFound
+    self.cancelling = True
+
+  def close(self):
+    assert not self.submitted
+    self.closed = True
+
+  def getStatus(self):
+    return self.status
+
+  def getActualLength(self):
+    return self.length
+
+  def getBuffer(self):
+    return self.buffer
+
+  def getUserData(self):
+    return self.user_data
+
+  def complete(self, status=usb1.TRANSFER_COMPLETED, data=b"", length=None):
+    assert self.submitted
+    self.submitted = False
+    self.handle.submitted.remove(self)
+    self.status = status
+    self.length = len(data) if length is None else length
+    self.buffer[:len(data)] = data
+    self.callback(self)
+
+
+class FakeLibusbHandle:
+  def __init__(self):
+    self.transfers = []
+    # in submission order
+    self.submitted = []
+    self.halts_cleared = []
+    # synchronous bulkWrite(endpoint, data, timeout)
+    self.bulk_write = None
+
+  def getTransfer(self):
+    t = FakeTransfer(self)
+    self.transfers.append(t)
+    return t
+
+  def clearHalt(self, endpoint):
+    self.halts_cleared.append(endpoint)
+
+  def bulkWrite(self, endpoint, data, timeout=0):
+    return self.bulk_write(endpoint, data, timeout)
+
+
+class FakeContext:
+  """
+    Handling events completes cancelled transfers, and passes the
+    oldest other one to device(transfer), which can complete it.
+  """
+  def __init__(self, handle, device=None):
+    self.handle = handle
+    self.device = device
+    self.handled = 0
+
+  def handleEventsTimeout(self, tv=0):
+    self.handled += 1
+    for t in list(self.handle.submitted):
+      if t.cancelling:
+        t.complete(usb1.TRANSFER_CANCELLED, length=t.progress)
+    if self.device is not None and len(self.handle.submitted) > 0:
+      self.device(self.handle.submitted[0])
+
+
+class TestAsyncBulkReader(unittest.TestCase):
+  def setUp(self):
+    self.handle = FakeLibusbHandle()
+    self.context = FakeContext(self.handle)
+    self.reader = AsyncBulkReader(self.context, self.handle, 1, num_transfers=3, transfer_size=64)
+    self.addCleanup(self.reader.close)
+
+  def test_completed(self):
+    t = self.handle.transfers
+    self.assertTrue(all(x.submitted for x in t))
+    self.assertEqual(t[0].endpoint, 1 | usb1.ENDPOINT_IN)
+
+    t[0].complete(data=b"abc")
+    t[1].complete(data=b"def")
+    self.assertEqual(self.reader.read(0), b"abcdef")
+    # queued again right away
+    self.assertTrue(all(x.submitted for x in t))
+    self.assertEqual(self.handle.submitted[-2:], t[:2])
+
+  def test_callback(self):
+    got = []
+    reader = AsyncBulkReader(self.context, self.handle, 1, num_transfers=1, callback=got.append)
+    self.handle.transfers[-1].complete(data=b"abc")
+    self.assertEqual(got, [b"abc"])
+    self.assertEqual(reader.read(0), b"")
+    reader.close()
+
+  def test_empty(self):
+    t = self.handle.transfers
+    t[0].complete(data=b"")
+    # an idle panda doesn't get polled until the next read
+    self.assertFalse(t[0].submitted)
+    self.reader.handle_events(0)
+    self.assertTrue(t[0].submitted)
+
+    # every transfer came back empty, so the read returns before its timeout
+    self.context.device = lambda x: x.complete(data=b"")
+    st = time.monotonic()
+    self.assertEqual(self.reader.read(1.0), b"")
+    self.assertLess(time.monotonic() - st, 0.5)
+
+  def test_cancelled(self):
+    t = self.handle.transfers
+    t[0].complete(usb1.TRANSFER_CANCELLED)
+    self.assertFalse(t[0].submitted)
+    self.assertIsNone(self.reader.error)
+    self.assertEqual(self.reader.read(0), b"")
+    self.assertFalse(t[0].submitted)
+
+  def test_timed_out(self):
+    t = self.handle.transfers
+    with self.assertNoLogs("panda"):
+      for _ in range(100):
+        t[0].complete(usb1.TRANSFER_TIMED_OUT)
+    self.assertEqual(self.reader.timeouts, 100)
+    self.assertTrue(t[0].submitted)
+    self.assertIsNone(self.reader.error)
+
+  def test_recoverable_errors(self):
+    t = self.handle.transfers
+    for status, exc in ((usb1.TRANSFER_STALL, usb1.USBErrorPipe), (usb1.TRANSFER_OVERFLOW, usb1.USBErrorOverflow)):
+      with self.subTest(status=status):
+        # logged once, and nothing is resubmitted until it's raised
+        with self.assertLogs("panda", level="ERROR") as logs:
+          t[0].complete(status)
+          t[1].complete(data=b"abc")
+          t[2].complete(status)
+        self.assertEqual(len(logs.records), 1)
+        self.assertFalse(any(x.submitted for x in t))
+
+        self.assertEqual(self.reader.read(0), b"abc")
+        with self.assertRaises(exc):
+          self.reader.read(0.1)
+        self.assertIsNone(self.reader.error)
+
+        self.assertEqual(self.reader.read(0), b"")
+        self.assertTrue(all(x.submitted for x in t))
+    self.assertEqual(self.handle.halts_cleared, [1 | usb1.ENDPOINT_IN])
+
+  def test_fatal_errors(self):
+    for status, exc in ((usb1.TRANSFER_NO_DEVICE, usb1.USBErrorNoDevice), (usb1.TRANSFER_ERROR, usb1.USBErrorIO)):
+      with self.subTest(status=status):
+        handle = FakeLibusbHandle()
+        reader = AsyncBulkReader(FakeContext(handle), handle, 1, num_transfers=2)
+        with self.assertLogs("panda", level="ERROR"):
+          handle.transfers[0].complete(status)
+        handle.transfers[1].complete(data=b"abc")
+        self.assertEqual(reader.read(0), b"abc")
+        for _ in range(2):
+          with self.assertRaises(exc):
+            reader.read(0.1)
+        self.assertFalse(any(x.submitted for x in handle.transfers))
+        reader.close()
+
+  def test_close(self):
+    t = self.handle.transfers
+    t[0].complete(data=b"")
+    self.reader.close()
+    self.assertTrue(all(x.closed and not x.submitted for x in t))
+
+
+class FakeOutEndpoint:
+  """
+    A bulk OUT endpoint taking a transfer on each event, up to accept(chunk number, data) bytes of it. A short count stays pending
+    until it's cancelled, None takes nothing, and (count, status) fails it.
+  """
+  def __init__(self, handle, accept=None):
+    self.handle = handle
+    self.accept = (lambda i, data: len(data)) if accept is None else accept
+    self.received = bytearray()
+    self.max_in_flight = 0
+
+  def __call__(self, t):
+    self.max_in_flight = max(self.max_in_flight, len(self.handle.submitted))
+    if t.progress > 0:
+      return
+    n = self.accept(t.user_data, bytes(t.buffer))
+    if n is None:
+      return
+    status = usb1.TRANSFER_COMPLETED
+    if isinstance(n, tuple):
+      n, status = n
+    self.received += t.buffer[:n]
+    if status != usb1.TRANSFER_COMPLETED:
+      t.complete(status, length=n)
+    elif n < len(t.buffer):
+      # the rest is NAKed until the transfer is cancelled
+      t.progress = n
+    else:
+      t.complete(data=bytes(t.buffer))
+
+
+class TestBulkWritePipelined(unittest.TestCase):
+  def setUp(self):
+    self.handle = FakeLibusbHandle()
+    self.context = FakeContext(self.handle)
+    self.usb_handle = PandaUsbHandle(self.handle, self.context)
+    self.chunks = [bytes([i]) * (10 + i) for i in range(10)]
+
+  def write(self, accept=None, **kwargs):
+    self.context.device = endpoint = FakeOutEndpoint(self.handle, accept)
+    sent = self.usb_handle.bulk_write_pipelined(3, self.chunks, **kwargs)
+    self.assertFalse(any(t.submitted for t in self.handle.transfers))
+    self.assertTrue(all(t.closed for t in self.handle.transfers))
+    return sent, endpoint
+
+  def test_order(self):
+    sent, endpoint = self.write(depth=3)
+    self.assertEqual(sent, sum(len(c) for c in self.chunks))
+    self.assertEqual(bytes(endpoint.received), b"".join(self.chunks))
+    self.assertEqual(endpoint.max_in_flight, 3)
+    # the transfers are reused for the later chunks
+    self.assertEqual(len(self.handle.transfers), 3)
+    self.assertTrue(all(t.endpoint == 3 | usb1.ENDPOINT_OUT for t in self.handle.transfers))
+
+  def test_partial(self):
+    # chunk 4 fails partway, nothing after it may go out
+    sent, endpoint = self.write(lambda i, data: (3, usb1.TRANSFER_ERROR) if i == 4 else len(data), depth=4)
+    expected = sum(len(c) for c in self.chunks[:4]) + 3
+    self.assertEqual(sent, expected)
+    self.assertEqual(bytes(endpoint.received), b"".join(self.chunks)[:expected])
+
+  def test_timeout(self):
+    # chunk 2 is NAKed partway until the deadline
+    for accept, extra in ((None, 0), (5, 5)):
+      with self.subTest(extra=extra):
+        self.handle.transfers.clear()
+        st = time.monotonic()
+        sent, endpoint = self.write(lambda i, data, accept=accept: accept if i == 2 else len(data), depth=4, timeout=50)
+        self.assertGreaterEqual(time.monotonic() - st, 0.05)
+        self.assertLess(time.monotonic() - st, 1.0)
+        self.assertEqual(sent, len(self.chunks[0]) + len(self.chunks[1]) + extra)
+        self.assertEqual(len(endpoint.received), sent)
+
+  def test_depth_one(self):
+    sent, endpoint = self.write(depth=1)
+    self.assertEqual(sent, sum(len(c) for c in self.chunks))
+    self.assertEqual(endpoint.max_in_flight, 1)
+
+
+class TestCanSendPipelined(unittest.TestCase):
+  def setUp(self):
+    self.handle = FakeLibusbHandle()
+    self.context = FakeContext(self.handle)
+    p = self.p = Panda.__new__(Panda)
+    p._handle = PandaUsbHandle(self.handle, self.context)
+    p._can_tx_lock = threading.Lock()
+    p._can_packer = CanPacker()
+    p._config_pending = False
+    p.can_version = Panda.CAN_PACKET_VERSION
+    # 10 packets of 14 bytes, the panda takes 4.5 of them
+    self.msgs = [(0x100 + i, bytes(8), 0) for i in range(10)]
+    self.context.device = FakeOutEndpoint(self.handle, lambda i, data: 63)
+
+  def test_completes_cut_off_packet(self):
+    rest = []
+    def bulk_write(endpoint, data, timeout):
+      rest.append(bytes(data))
+      return len(data)
+    self.handle.bulk_write = bulk_write
+    self.assertEqual(self.p.can_send_many(self.msgs, pipeline_depth=2), 5)
+    self.assertEqual([len(r) for r in rest], [14 * 5 - 63])
+
+  def test_cut_off_packet_deadline(self):
+    def bulk_write(endpoint, data, timeout):
+      # NAKed for the whole timeout, a byte at a time
+      time.sleep(timeout * 1e-3)
+      e = usb1.USBErrorTimeout()
+      e.transferred = 1
+      raise e
+    self.handle.bulk_write = bulk_write
+
+    st = time.monotonic()
+    with self.assertLogs("panda", level="ERROR"), self.assertRaises(usb1.USBErrorTimeout):
+      self.p.can_send_many(self.msgs, pipeline_depth=2, timeout=20)
+    # the pipelined part waits out one timeout, the cut off packet another
+    self.assertLess(time.monotonic() - st, 0.5)
+
+
+if __name__ == '__main__':
+  unittest.main()